@@ -0,0 +1,599 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import unittest.mock as mock
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory isn't measured
+    resource = None
+
+import PIL
+from PIL import Image
+
+from inbac import cropping, image_index, rename_planner
+from inbac.controller import Controller
+from inbac.model import Model
+from inbac.output_index import OutputIndex
+from inbac.parse_arguments import parse_arguments
+
+RESULTS_VERSION: int = 1
+DEFAULT_MEGAPIXELS: List[float] = [2.0, 8.0, 24.0, 50.0, 100.0]
+DEFAULT_FILE_COUNTS: List[int] = [1000, 10000, 100000]
+DEFAULT_FORMATS: List[str] = ["JPEG", "PNG"]
+DEFAULT_CANVAS_SIZE: Tuple[int, int] = (1600, 900)
+# Canvas the image is rescaled to when timing the redraw after a window resize
+RESIZED_CANVAS_SIZE: Tuple[int, int] = (1280, 720)
+# Medians below this are dominated by timer and scheduling noise, they are not checked for regressions
+DEFAULT_MIN_SECONDS: float = 0.001
+DEFAULT_THRESHOLD: float = 1.25
+# Sizes crops are resized to when timing the crop pipelines: the default of the application and a thumbnail
+CROP_RESIZES: List[Tuple[int, int]] = [(1080, 1920), (270, 480)]
+# Pipelines cropping an already decoded image (like the application) and a file (like the batch cropper)
+IN_MEMORY_CROP_PIPELINES: Tuple[str, ...] = ("copy_crop_resize", "reduce_resample")
+FILE_CROP_PIPELINES: Tuple[str, ...] = ("decode_reduce_resample", "draft_reduce_resample")
+
+
+class StubPhotoImage():
+    """
+    Replaces ImageTk.PhotoImage, which needs a running Tk interpreter. The conversion into a Tk image isn't timed
+    """
+
+    def __init__(self, image: Image):
+        self.image: Image = image
+
+
+class StubCanvas():
+    def __init__(self, size: Tuple[int, int]):
+        self.size: Tuple[int, int] = size
+
+    def winfo_width(self) -> int:
+        return self.size[0]
+
+    def winfo_height(self) -> int:
+        return self.size[1]
+
+
+class StubView():
+    """
+    Stands in for the Tk view: canvas objects are only tracked by their coordinates and callbacks meant
+    for the UI thread are run right away
+    """
+
+    def __init__(self, canvas_size: Tuple[int, int]):
+        self.image_canvas: StubCanvas = StubCanvas(canvas_size)
+        self.object_coords: Dict[int, Tuple[int, ...]] = {}
+        self.object_ids = itertools.count(1)
+        self.title: str = ""
+
+    def add_object(self, coords: Tuple[int, ...]) -> int:
+        obj: int = next(self.object_ids)
+        self.object_coords[obj] = tuple(coords)
+        return obj
+
+    def run_on_ui_thread(self, callback: Callable[[], Any]):
+        callback()
+
+    def schedule(self, delay_ms: int, callback: Callable[[], Any]) -> Any:
+        return None
+
+    def schedule_idle(self, callback: Callable[[], Any]) -> Any:
+        return None
+
+    def cancel_scheduled(self, job: Any):
+        pass
+
+    def show_error(self, title: str, message: str):
+        raise RuntimeError(f"{title}: {message}")
+
+    def ask_directory(self) -> str:
+        return ""
+
+    def set_title(self, title: str):
+        self.title = title
+
+    def update_filmstrip(self, count: int, current: int, reset: bool):
+        pass
+
+    def show_thumbnail(self, position: int, thumbnail: Image.Image):
+        pass
+
+    def display_image(self, image: StubPhotoImage) -> Any:
+        return self.add_object((0, 0))
+
+    def remove_from_canvas(self, obj: Any):
+        self.object_coords.pop(obj, None)
+
+    def create_line(self, coords: Tuple[int, int, int, int], fill="gold", dash=(4, 2)) -> Any:
+        return self.add_object(coords)
+
+    def create_rectangle(self, box: Tuple[int, int, int, int], outline_color: str, dash: Tuple[int, ...] = ()) -> Any:
+        return self.add_object(box)
+
+    def create_overlay(self, box: Tuple[int, int, int, int], outline="", fill="black", stipple="gray25") -> Any:
+        return self.add_object(box)
+
+    def change_canvas_object_coords(self, obj: Any, coords: Tuple[int, ...]):
+        self.object_coords[obj] = tuple(coords)
+
+    def change_canvas_overlay_coords(self, obj: Any, coords: Tuple[int, int, int, int]):
+        self.object_coords[obj] = tuple(coords)
+
+    def update_canvas_object(self, obj: Any, **kwargs):
+        pass
+
+    def get_canvas_object_coords(self, obj: Any) -> Any:
+        return self.object_coords[obj]
+
+    def tag_raise(self, obj: Any):
+        pass
+
+    def move_canvas_object_by_offset(self, obj: Any, offset_x: int, offset_y: int):
+        coords: Tuple[int, ...] = self.object_coords[obj]
+        self.object_coords[obj] = tuple(
+            coord + (offset_x if index % 2 == 0 else offset_y) for index, coord in enumerate(coords))
+
+
+def create_controller(input_dir: str, output_dir: str, canvas_size: Tuple[int, int]) -> Controller:
+    # Without prefetching, only the timed image is decoded
+    args = parse_arguments([input_dir, output_dir, "--prefetch", "0", "--no_index_cache"])
+    controller: Controller = Controller(Model(args))
+    controller.view = StubView(canvas_size)
+    return controller
+
+
+def get_image_dimensions(megapixels: float) -> Tuple[int, int]:
+    # 3:2, the aspect ratio of most camera sensors
+    width: int = round(math.sqrt(megapixels * 1000000 * 3 / 2))
+    return (width, round(width * 2 / 3))
+
+
+def create_image(megapixels: float) -> Image:
+    """
+    Creates a smooth random image, which compresses similarly to a photograph (unlike pure noise)
+    """
+    bands: List[Image.Image] = [Image.effect_noise((48, 32), 96) for _ in range(3)]
+    return Image.merge("RGB", bands).resize(get_image_dimensions(megapixels), Image.BICUBIC)
+
+
+def get_image_filename(megapixels: float, image_format: str) -> str:
+    extension: str = ".jpg" if image_format == "JPEG" else "." + image_format.lower()
+    return f"synthetic_{megapixels:g}mp{extension}"
+
+
+def generate_image_set(data_dir: str, megapixels: Iterable[float], image_formats: Iterable[str]) -> str:
+    """
+    Creates the synthetic images missing in the data directory
+    """
+    directory: str = os.path.join(data_dir, "images")
+    os.makedirs(directory, exist_ok=True)
+    for size in megapixels:
+        image: Optional[Image.Image] = None
+        for image_format in image_formats:
+            path: str = os.path.join(directory, get_image_filename(size, image_format))
+            if os.path.exists(path):
+                continue
+            if image is None:
+                image = create_image(size)
+            # Fast PNG compression keeps generating the biggest images bearable, decoding isn't much affected
+            image.save(path, image_format, quality=90, compress_level=1)
+    return directory
+
+
+def generate_file_set(data_dir: str, file_count: int) -> str:
+    """
+    Creates a directory of empty image files, numbered so that natural sorting matters
+    """
+    directory: str = os.path.join(data_dir, f"files_{file_count}")
+    if os.path.isdir(directory) and len(os.listdir(directory)) == file_count:
+        return directory
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for number in range(file_count):
+        with open(os.path.join(directory, f"IMG_{number}.jpg"), "wb"):
+            pass
+    return directory
+
+
+def generate_crop_set(data_dir: str, file_count: int) -> str:
+    """
+    Creates a directory of empty crops of a single image, numbered consecutively
+    """
+    directory: str = os.path.join(data_dir, f"crops_{file_count}")
+    if os.path.isdir(directory) and len(os.listdir(directory)) == file_count:
+        return directory
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for number in range(file_count):
+        with open(os.path.join(directory, f"IMG_crop{number + 1}.jpg"), "wb"):
+            pass
+    return directory
+
+
+def measure(function: Callable[[], Any],
+            repeat: int,
+            setup: Optional[Callable[[], Any]] = None) -> List[float]:
+    times: List[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start: float = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def create_result(stage: str, params: Dict[str, Any], times: List[float]) -> Dict[str, Any]:
+    return {
+        "stage": stage,
+        "params": params,
+        "times": times,
+        "median": statistics.median(times),
+        "min": min(times),
+    }
+
+
+def benchmark_image_pipeline(image_dir: str,
+                             output_dir: str,
+                             megapixels: Iterable[float],
+                             image_formats: Iterable[str],
+                             repeat: int) -> List[Dict[str, Any]]:
+    """
+    Times loading, rescaling and saving of every synthetic image through the controller
+    """
+    results: List[Dict[str, Any]] = []
+    controller: Controller = create_controller(image_dir, output_dir, DEFAULT_CANVAS_SIZE)
+    canvas: StubCanvas = controller.view.image_canvas
+    try:
+        for size, image_format in itertools.product(megapixels, image_formats):
+            image_name: str = get_image_filename(size, image_format)
+            params: Dict[str, Any] = {"megapixels": size, "format": image_format}
+            controller.model.images = [image_name]
+            controller.model.current_file = 0
+
+            def load_cold():
+                canvas.size = DEFAULT_CANVAS_SIZE
+                controller.prefetcher.invalidate()
+
+            results.append(create_result(
+                "load_image", params,
+                measure(lambda: controller.load_image(image_name), repeat, load_cold)))
+            results.append(create_result(
+                "load_image_cached", params,
+                measure(lambda: controller.load_image(image_name), repeat)))
+
+            def resize_canvas():
+                canvas.size = RESIZED_CANVAS_SIZE if canvas.size == DEFAULT_CANVAS_SIZE else DEFAULT_CANVAS_SIZE
+
+            results.append(create_result(
+                "display_image_on_canvas", params,
+                measure(lambda: controller.display_image_on_canvas(controller.model.current_image),
+                        repeat, resize_canvas)))
+
+            def save():
+                controller.save()
+                controller.save_queue.flush()
+
+            results.append(create_result("save", params, measure(save, repeat)))
+    finally:
+        controller.save_queue.shutdown()
+        controller.prefetcher.shutdown()
+    return results
+
+
+def get_crop_box(image_size: Tuple[int, int], resize: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Returns a centered box with the aspect ratio of the resize, covering 90% of the image height
+    """
+    height: int = int(image_size[1] * 0.9)
+    width: int = min(height * resize[0] // resize[1], image_size[0])
+    left: int = (image_size[0] - width) // 2
+    top: int = (image_size[1] - height) // 2
+    return (left, top, left + width, top + height)
+
+
+def run_crop_pipeline(pipeline: str,
+                      path: str,
+                      resize: Tuple[int, int],
+                      image: Optional[Image.Image] = None) -> Image:
+    if pipeline == "copy_crop_resize":
+        # The save path before resizing read the crop straight from the image
+        return image.copy().crop(get_crop_box(image.size, resize)).resize(resize, Image.LANCZOS)
+    if pipeline == "reduce_resample":
+        return cropping.crop_image(image, get_crop_box(image.size, resize), resize)
+    with Image.open(path) as source_image:
+        box: Tuple[float, ...] = get_crop_box(source_image.size, resize)
+        original_size: Tuple[int, int] = source_image.size
+        if pipeline == "draft_reduce_resample" and cropping.draft_for_resize(source_image, box, resize):
+            box = cropping.scale_box(box, original_size, source_image.size)
+        return cropping.crop_image(source_image, box, resize)
+
+
+def reset_peak_memory() -> bool:
+    """
+    Resets the peak resident memory of the process to the current one (Linux only)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_memory_kb() -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak_memory: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return peak_memory // 1024 if sys.platform == "darwin" else peak_memory
+
+
+def measure_crop_pipeline_memory(pipeline: str, path: str, resize: Tuple[int, int]) -> Optional[int]:
+    """
+    Runs in a fresh process, returns how much the pipeline raised the peak memory of the process. Where the peak
+    can't be reset, a pipeline using less memory than decoding the image is reported as 0
+    """
+    image: Optional[Image.Image] = None
+    if pipeline in IN_MEMORY_CROP_PIPELINES:
+        image = Image.open(path)
+        image.load()
+    reset_peak_memory()
+    peak_memory_before: Optional[int] = get_peak_memory_kb()
+    if peak_memory_before is None:
+        return None
+    run_crop_pipeline(pipeline, path, resize, image)
+    return get_peak_memory_kb() - peak_memory_before
+
+
+def benchmark_crop_pipelines(image_dir: str,
+                             megapixels: Iterable[float],
+                             image_formats: Iterable[str],
+                             repeat: int) -> List[Dict[str, Any]]:
+    """
+    Times cropping and resizing with the different pipelines and measures their peak memory use
+    """
+    results: List[Dict[str, Any]] = []
+    spawn_context = multiprocessing.get_context("spawn")
+    for size, image_format in itertools.product(megapixels, image_formats):
+        path: str = os.path.join(image_dir, get_image_filename(size, image_format))
+        with Image.open(path) as image:
+            image.load()
+            for resize, pipeline in itertools.product(CROP_RESIZES, IN_MEMORY_CROP_PIPELINES + FILE_CROP_PIPELINES):
+                result: Dict[str, Any] = create_result(
+                    "crop_resize",
+                    {"megapixels": size, "format": image_format, "resize": list(resize), "pipeline": pipeline},
+                    measure(lambda: run_crop_pipeline(pipeline, path, resize, image), repeat))
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+                    result["peak_memory_kb"] = executor.submit(
+                        measure_crop_pipeline_memory, pipeline, path, resize).result()
+                results.append(result)
+    return results
+
+
+def benchmark_filesystem(data_dir: str, file_counts: Iterable[int], repeat: int) -> List[Dict[str, Any]]:
+    """
+    Times listing the images of a directory and naming crops in directories of growing size
+    """
+    results: List[Dict[str, Any]] = []
+    index_dir: str = os.path.join(data_dir, "index")
+    for file_count in file_counts:
+        params: Dict[str, Any] = {"files": file_count}
+        files_dir: str = generate_file_set(data_dir, file_count)
+        crops_dir: str = generate_crop_set(data_dir, file_count)
+
+        results.append(create_result(
+            "load_image_list", params,
+            measure(lambda: Controller.load_image_list(files_dir), repeat)))
+        image_index.list_images(files_dir, index_dir)
+        results.append(create_result(
+            "load_image_list_indexed", params,
+            measure(lambda: image_index.list_images(files_dir, index_dir), repeat)))
+        results.append(create_result(
+            "output_index_allocate", params,
+            measure(lambda: OutputIndex(crops_dir).allocate("IMG.jpg"), repeat)))
+        results.append(create_result(
+            "collect_cropped_files", params,
+            measure(lambda: rename_planner.collect_cropped_files(crops_dir), repeat)))
+    return results
+
+
+def get_result_key(result: Dict[str, Any]) -> str:
+    return result["stage"] + json.dumps(result["params"], sort_keys=True)
+
+
+def calculate_scaling(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Groups the results of every stage into curves over their size parameter (megapixels or files). The exponent
+    is the slope of the least squares fit in log-log space: 1 means linear scaling, 2 quadratic
+    """
+    curves: Dict[str, Dict[str, Any]] = {}
+    for result in results:
+        size_param: str = "megapixels" if "megapixels" in result["params"] else "files"
+        fixed_params: Dict[str, Any] = {key: value for key, value in result["params"].items() if key != size_param}
+        key: str = result["stage"] + json.dumps(fixed_params, sort_keys=True)
+        curve: Dict[str, Any] = curves.setdefault(key, {
+            "stage": result["stage"],
+            "params": fixed_params,
+            "x": size_param,
+            "points": [],
+        })
+        curve["points"].append([result["params"][size_param], result["median"]])
+
+    for curve in curves.values():
+        curve["points"].sort()
+        points: List[Tuple[float, float]] = [(math.log(x), math.log(y)) for x, y in curve["points"] if x > 0 and y > 0]
+        curve["exponent"] = None
+        if len(points) > 1:
+            mean_x: float = statistics.fmean(x for x, _ in points)
+            mean_y: float = statistics.fmean(y for _, y in points)
+            variance: float = sum((x - mean_x) ** 2 for x, _ in points)
+            if variance > 0:
+                curve["exponent"] = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    return list(curves.values())
+
+
+def compare_results(results: List[Dict[str, Any]],
+                    baseline: List[Dict[str, Any]],
+                    threshold: float,
+                    min_seconds: float = DEFAULT_MIN_SECONDS) -> List[Dict[str, Any]]:
+    """
+    Returns the measurements whose median got slower than the baseline by more than the threshold ratio
+    """
+    baseline_medians: Dict[str, float] = {get_result_key(result): result["median"] for result in baseline}
+    regressions: List[Dict[str, Any]] = []
+    for result in results:
+        baseline_median: Optional[float] = baseline_medians.get(get_result_key(result))
+        if baseline_median is None or max(baseline_median, result["median"]) < min_seconds:
+            continue
+        ratio: float = result["median"] / max(baseline_median, min_seconds)
+        if ratio > threshold:
+            regressions.append({
+                "stage": result["stage"],
+                "params": result["params"],
+                "baseline": baseline_median,
+                "median": result["median"],
+                "ratio": ratio,
+            })
+    return regressions
+
+
+def parse_benchmark_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="inbac benchmarks - times the imaging pipeline and file system operations on synthetic data")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file the JSON results are written to (default is standard output)",
+        default=None)
+    parser.add_argument(
+        "-d",
+        "--data_dir",
+        help="directory the synthetic data is generated into and reused from (default is a temporary directory)",
+        default=None)
+    parser.add_argument(
+        "-m",
+        "--megapixels",
+        type=float,
+        nargs="+",
+        help="sizes of the synthetic images in megapixels (default is 2 8 24 50 100)",
+        default=None)
+    parser.add_argument(
+        "-f",
+        "--formats",
+        nargs="+",
+        help="formats of the synthetic images",
+        default=DEFAULT_FORMATS)
+    parser.add_argument(
+        "-n",
+        "--file_counts",
+        type=int,
+        nargs="+",
+        help="numbers of files in the synthetic directories (default is 1000 10000 100000)",
+        default=None)
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        help="number of measurements of every stage (default is 5)",
+        default=None)
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="only small images and directories and fewer measurements, for a fast check")
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        help="results of a previous run, slower stages are reported as regressions",
+        default=None)
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        help=f"ratio to the baseline median above which a stage is a regression (default is {DEFAULT_THRESHOLD})",
+        default=DEFAULT_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    # Explicitly passed values take precedence over the presets
+    if args.megapixels is None:
+        args.megapixels = [2.0, 8.0] if args.quick else DEFAULT_MEGAPIXELS
+    if args.file_counts is None:
+        args.file_counts = [1000, 10000] if args.quick else DEFAULT_FILE_COUNTS
+    if args.repeat is None:
+        args.repeat = 3 if args.quick else 5
+    return args
+
+
+def run(args) -> Dict[str, Any]:
+    data_dir: str = args.data_dir or tempfile.mkdtemp(prefix="inbac-benchmark-")
+    output_dir: str = tempfile.mkdtemp(prefix="inbac-benchmark-crops-")
+    try:
+        image_dir: str = generate_image_set(data_dir, args.megapixels, args.formats)
+        with mock.patch("inbac.controller.ImageTk.PhotoImage", StubPhotoImage):
+            results: List[Dict[str, Any]] = benchmark_image_pipeline(
+                image_dir, output_dir, args.megapixels, args.formats, args.repeat)
+        results += benchmark_crop_pipelines(image_dir, args.megapixels, args.formats, args.repeat)
+        results += benchmark_filesystem(data_dir, args.file_counts, args.repeat)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report: Dict[str, Any] = {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+        "scaling": calculate_scaling(results),
+    }
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            baseline: Dict[str, Any] = json.load(baseline_file)
+        report["threshold"] = args.threshold
+        report["regressions"] = compare_results(results, baseline["results"], args.threshold)
+    return report
+
+
+def main():
+    args = parse_benchmark_arguments()
+    report: Dict[str, Any] = run(args)
+    output: str = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+
+    for regression in report.get("regressions", []):
+        print(f"Regression: {regression['stage']} {json.dumps(regression['params'])} "
+              f"{regression['baseline']:.4f}s -> {regression['median']:.4f}s ({regression['ratio']:.2f}x)",
+              file=sys.stderr)
+    sys.exit(1 if report.get("regressions") else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from PIL import Image
+
+import inbac.parse_arguments as parse_args
+from inbac import cropping
+from inbac.output_index import OutputIndex
+
+# Number of crops submitted to the pool per worker process, bounds the memory used for huge manifests
+IN_FLIGHT_PER_WORKER: int = 4
+# How often (in processed records) the progress is reported
+REPORT_INTERVAL: int = 1000
+
+
+class CropRecord():
+    def __init__(self,
+                 line: int,
+                 source: str,
+                 box: Tuple[int, int, int, int],
+                 rotation: int = 0,
+                 resize: Optional[Tuple[int, int]] = None,
+                 image_format: Optional[str] = None,
+                 image_quality: Optional[int] = None):
+        self.line: int = line
+        self.source: str = source
+        self.box: Tuple[int, int, int, int] = box
+        self.rotation: int = rotation
+        self.resize: Optional[Tuple[int, int]] = resize
+        self.image_format: Optional[str] = image_format
+        self.image_quality: Optional[int] = image_quality
+        self.attempts: int = 0
+
+
+def read_manifest(path: str, on_invalid_row: Callable[[int, Exception], None]) -> Iterator[CropRecord]:
+    """
+    Lazily reads the crop records of the manifest, so huge manifests never have to be held in memory.
+    Malformed rows are reported and skipped
+    """
+    with open(path, newline="", encoding="utf-8") as manifest:
+        if path.lower().endswith(".jsonl"):
+            rows: Iterator[Tuple[int, Any]] = enumerate(manifest, start=1)
+            parse_record: Callable[[int, Any], CropRecord] = lambda line, row: parse_json_record(line, json.loads(row))
+        else:
+            # Line 1 is the header
+            rows = enumerate(csv.DictReader(manifest), start=2)
+            parse_record = parse_csv_record
+        for line, row in rows:
+            if isinstance(row, str) and not row.strip():
+                continue
+            try:
+                yield parse_record(line, row)
+            except (ValueError, KeyError, TypeError) as error:
+                on_invalid_row(line, error)
+
+
+def parse_json_record(line: int, row: Dict) -> CropRecord:
+    return CropRecord(
+        line,
+        row["source"],
+        tuple(int(value) for value in row["box"]),
+        int(row.get("rotation") or 0),
+        tuple(int(value) for value in row["resize"]) if row.get("resize") else None,
+        row.get("format") or None,
+        int(row["quality"]) if row.get("quality") else None)
+
+
+def parse_csv_record(line: int, row: Dict[str, str]) -> CropRecord:
+    resize: Optional[Tuple[int, int]] = None
+    if row.get("resize_width") and row.get("resize_height"):
+        resize = (int(row["resize_width"]), int(row["resize_height"]))
+    return CropRecord(
+        line,
+        row["source"],
+        (int(row["left"]), int(row["top"]), int(row["right"]), int(row["bottom"])),
+        int(row.get("rotation") or 0),
+        resize,
+        row.get("format") or None,
+        int(row["quality"]) if row.get("quality") else None)
+
+
+def process_record(source_path: str,
+                   box: Tuple[int, int, int, int],
+                   rotation: int,
+                   output_path: str,
+                   resize: Optional[Tuple[int, int]],
+                   image_format: Optional[str],
+                   image_quality: int,
+                   resample: int = Image.LANCZOS,
+                   reducing_gap: Optional[float] = cropping.DEFAULT_REDUCING_GAP):
+    """
+    Runs in the worker processes
+    """
+    with Image.open(source_path) as image:
+        # The box is given in the coordinates of the image in its EXIF orientation, rotated like in the application.
+        # Only the cropped region is transformed, so the box is mapped back onto the image as stored
+        orientation: cropping.Orientation = cropping.rotate_orientation(cropping.get_exif_orientation(image), rotation)
+        original_size: Tuple[int, int] = image.size
+        box = cropping.unorient_box(box, orientation, original_size)
+        source_resize: Optional[Tuple[int, int]] = cropping.get_oriented_size(resize, orientation) if resize else None
+        if cropping.draft_for_resize(image, box, source_resize, reducing_gap):
+            box = cropping.scale_box(box, original_size, image.size)
+        cropping.save_cropped_image(
+            image, box, output_path, resize, image_format, image_quality, resample, reducing_gap, orientation)
+
+
+class BatchCropper():
+    def __init__(self, args):
+        self.args = args
+        self.processed: int = 0
+        self.failed: int = 0
+        self.retried: int = 0
+        self.start_time: float = time.monotonic()
+        self.output_index: Optional[OutputIndex] = None
+        self.in_flight: Dict[Future, Tuple[CropRecord, str]] = {}
+
+    def run(self) -> int:
+        os.makedirs(self.args.output_dir, exist_ok=True)
+        self.output_index = OutputIndex(self.args.output_dir)
+        workers: int = self.args.jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for record in read_manifest(self.args.manifest, self.skip_invalid_row):
+                if len(self.in_flight) >= workers * IN_FLIGHT_PER_WORKER:
+                    self.collect(executor, FIRST_COMPLETED)
+                self.submit(executor, record)
+            while self.in_flight:
+                self.collect(executor, FIRST_COMPLETED)
+        self.report(final=True)
+        return 1 if self.failed else 0
+
+    def skip_invalid_row(self, line: int, error: Exception):
+        self.failed += 1
+        print(f"Skipping invalid manifest line {line}: {error!r}", file=sys.stderr)
+
+    def submit(self, executor: ProcessPoolExecutor, record: CropRecord, output_path: Optional[str] = None):
+        image_format: Optional[str] = record.image_format or self.args.image_format
+        if output_path is None:
+            # Names are allocated here, in the single parent process, so workers never race for the same name
+            output_filename: str = self.output_index.allocate(os.path.basename(record.source), image_format)
+            output_path = os.path.join(self.args.output_dir, output_filename)
+        record.attempts += 1
+        future: Future = executor.submit(
+            process_record,
+            os.path.join(self.args.input_dir, record.source),
+            record.box,
+            record.rotation,
+            output_path,
+            record.resize or self.args.resize,
+            image_format,
+            record.image_quality if record.image_quality is not None else self.args.image_quality,
+            cropping.RESAMPLE_FILTERS[self.args.resample],
+            self.args.reducing_gap)
+        self.in_flight[future] = (record, output_path)
+
+    def collect(self, executor: ProcessPoolExecutor, return_when: str):
+        done, _ = wait(self.in_flight, return_when=return_when)
+        for future in done:
+            record, output_path = self.in_flight.pop(future)
+            error: Optional[BaseException] = future.exception()
+            if isinstance(error, OSError) and record.attempts <= self.args.retries:
+                self.retried += 1
+                self.submit(executor, record, output_path)
+                continue
+            self.processed += 1
+            if error is not None:
+                self.failed += 1
+                print(f"Skipping {record.source} (manifest line {record.line}): {error}", file=sys.stderr)
+            if self.processed % REPORT_INTERVAL == 0:
+                self.report()
+
+    def report(self, final: bool = False):
+        elapsed: float = max(time.monotonic() - self.start_time, 1e-9)
+        prefix: str = "Done" if final else "Progress"
+        print(f"{prefix}: {self.processed} records ({self.failed} failed, {self.retried} retries) "
+              f"in {elapsed:.1f} s - {self.processed / elapsed:.1f} records/s", file=sys.stderr)
+
+
+def main():
+    sys.exit(BatchCropper(parse_args.parse_batch_arguments()).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,90 @@
 from fractions import Fraction
-import itertools
-import mimetypes
 import os
-from natsort import os_sorted
+import tarfile
+import threading
+import zipfile
 
-import re
-from typing import Optional, List, Tuple
+from concurrent.futures import CancelledError, Future
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, Optional, List, Sequence, Set, Tuple, Union
 
 from PIL import Image, ImageTk
 
+from inbac import cropping, duplicates, image_index, image_source, profiler, rename_planner, saliency
+from inbac.cropping import IMAGE_FILE_EXTENSIONS
+from inbac.directory_watcher import DirectoryWatcher
+from inbac.image_archive import ImageArchive, is_archive
+from inbac.image_cache import CachedImage, ImageCache, ImagePyramid, Prefetcher
+from inbac.image_index import NameList
+from inbac.image_source import LazyNameList
+from inbac.journal import CropJournal
+from inbac.large_image import LargeImage, MemoryBudget, get_decoded_size, get_resident_memory
 from inbac.model import Model
+from inbac.output_index import OutputIndex
+from inbac.output_sink import OutputSink, create_output_sink
+from inbac.processed_images import ProcessedImages
+from inbac.rename_planner import DEFAULT_GAP_SIZE
+from inbac.render_scheduler import RenderScheduler
+from inbac.save_queue import RenditionOutput, SaveQueue
+from inbac.thumbnail_cache import ThumbnailCache, ThumbnailLoader, get_default_thumbnail_dir
 from inbac.view import View
 
-DEFAULT_GAP_SIZE: int = 100
-IMAGE_FILE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
-# Regular expression to match the filename structure of cropped images
-CROPPED_IMAGE_PATTERN = re.compile(r"(.*_crop)(\d+)(.*)(.jpg|.jpeg|.png)", re.IGNORECASE)
-# Prefix used to temporarily assign a file a unique name, before renaming to real file name in case of collisions wile removing gaps in the filename (cropXX) sequence numbers
-TMP_FILENAME_PREFIX="tmp_"
+# Directories with more images show the first one before the complete listing is sorted
+STREAMING_SORT_THRESHOLD: int = 10000
+# Delay after the last window resize event, after which the image is rescaled in full quality
+RESIZE_SETTLE_DELAY_MS: int = 200
+# With a memory limit, images decoding to more than this fraction of it are handled as large images
+LARGE_IMAGE_FRACTION: int = 8
+# Large images are displayed from a preview at least this many times bigger than the canvas, so it can grow
+LARGE_IMAGE_PREVIEW_SCALE: int = 2
+# Boxes placed on the image are drawn dashed, to tell them apart from the selection
+PLACED_BOX_DASH: Tuple[int, ...] = (6, 4)
+# Images looked up in the output indexes before the processed images found among them are stored
+PROCESSED_SCAN_CHUNK_SIZE: int = 4096
+# Journal entries looked at to find where to resume, more than the crops which can be saved concurrently: saves which
+# finished out of order must not move the resume position back
+RESUME_JOURNAL_ENTRIES: int = 256
 
 class Controller():
     def __init__(self, model: Model):
         self.model: Model = model
         self.view = None
+        cache_size: int = self.model.args.cache_size * 1024 * 1024
+        # Half of the memory limit is left for decoding and saving, which is bounded by the memory budget
+        self.memory_budget: Optional[MemoryBudget] = None
+        if self.model.args.memory_limit:
+            memory_limit: int = self.model.args.memory_limit * 1024 * 1024
+            cache_size = min(cache_size, memory_limit // 2)
+            self.memory_budget = MemoryBudget(memory_limit // 2)
+        self.prefetcher: Prefetcher = Prefetcher(
+            ImageCache(cache_size),
+            self.prepare_image,
+            self.model.args.prefetch)
+        self.save_queue: SaveQueue = SaveQueue(
+            self.model.args.save_queue_size,
+            self.model.args.save_workers,
+            lambda: self.view.run_on_ui_thread(self.update_title))
+        self.journal: Optional[CropJournal] = None
+        self.directory_watcher: Optional[DirectoryWatcher] = None
+        self.image_source: Optional[LazyNameList] = None
+        # Set when the input is a zip or tar archive, the images are read from it instead of the input directory
+        self.image_archive: Optional[ImageArchive] = None
+        self.output_sink: Optional[OutputSink] = None
+        # Indexes of the output directory and the subdirectories mirroring the input tree, by their path
+        self.output_indexes: Dict[str, OutputIndex] = {}
+        # Indexes are also looked up by the thread finding the processed images
+        self.output_index_lock: threading.Lock = threading.Lock()
+        self.thumbnail_loader: Optional[ThumbnailLoader] = ThumbnailLoader() if self.model.args.filmstrip else None
+        self.thumbnail_cache: ThumbnailCache = ThumbnailCache(
+            None if self.model.args.no_index_cache else get_default_thumbnail_dir())
+        # Original of the draft shown by the progressive display and the future of its full decode
+        self.draft: Optional[Tuple[Image.Image, Future]] = None
+        # Image list the filmstrip shows, it's reset when the list is replaced
+        self.filmstrip_images: Optional[Sequence[str]] = None
+        self.render_scheduler: RenderScheduler = RenderScheduler(
+            lambda delay_ms, callback: self.view.schedule(delay_ms, callback),
+            self.render_selection)
+        if self.model.args.profile:
+            profiler.enable()
 
     def run(self):
         self.select_images_folder()
@@ -44,21 +106,260 @@ class Controller():
                 "Output directory cannot be created, please select output directory location")
             self.model.args.output_dir = self.view.ask_directory()
 
+    @profiler.profiled("load_image")
     def load_image(self, image_name: str):
-        if self.model.current_image is not None:
-            self.model.current_image.close()
-            self.model.current_image = None
-        image = Image.open(os.path.join(self.model.args.input_dir, image_name))
-        image_dimensions: Tuple[int, int] = self.display_image_on_canvas(image)
+        # Images are not closed when switching, they may still be referenced by the image cache
+        self.model.current_image = None
+        self.draft = None
+        self.model.rotation = self.model.rotations.get(image_name, 0)
+        self.model.placed_boxes = []
+        # The box of a progressively displayed image is placed in the corner, its draft isn't scored
+        self.model.image_scores = None
+        canvas_size: Tuple[int, int] = self.get_canvas_size()
+        image_dimensions: Optional[Tuple[int, int]] = None
+        if self.model.args.progressive and not self.prefetcher.is_ready(image_name):
+            image_dimensions = self.display_draft_image(image_name, canvas_size)
+        if image_dimensions is None:
+            cached_image: CachedImage = self.prefetcher.get(image_name, canvas_size)
+            self.model.exif_orientation = cached_image.orientation
+            self.model.image_scores = cached_image.scores
+            self.model.image_pyramid = cached_image.pyramid
+            display_image: Optional[Image.Image] = None
+            # Rotating by another 90 degrees changes the size the image is fitted to the canvas with
+            if cached_image.canvas_size == canvas_size and self.model.rotation % 180 == 0:
+                display_image = cached_image.display_image
+            image_dimensions = self.display_image_on_canvas(cached_image.image, display_image)
+        self.update_image_title(image_name, image_dimensions)
+
+        # Decode the neighbouring images in the background, while the user looks at this one
+        self.prefetcher.prefetch(self.model.images, self.model.current_file, canvas_size)
+
+    def update_image_title(self, image_name: str, image_dimensions: Tuple[int, int]):
         image_width: int = image_dimensions[0]
         image_height: int = image_dimensions[1]
 
         # TODO: Add mapping from float to aspect ratio with tolerances -> introduce tolerant function for proper mapping!
         aspect_ratio: Fraction = Fraction(round(image_width / image_height, 3)).limit_denominator()
         aspect_ratio_string: str = str(aspect_ratio).replace('/', ':')
-        image_name_with_counter = f'({self.model.current_file + 1}/{len(self.model.images)}): {image_name}'
-        full_image_title = f'{image_name_with_counter} - Dimensions: {image_width}x{image_height} - Aspect Ratio: {aspect_ratio_string}'
-        self.view.set_title(full_image_title)
+        image_count: str = f'{len(self.model.images)}+' if self.model.images_listing else str(len(self.model.images))
+        image_name_with_counter = f'({self.model.current_file + 1}/{image_count}): {image_name}'
+        cache_stats = f'Cache hits/misses: {self.prefetcher.hits}/{self.prefetcher.misses}'
+        self.model.image_title = f'{image_name_with_counter} - Dimensions: {image_width}x{image_height} - Aspect Ratio: {aspect_ratio_string} - {cache_stats}'
+        if image_name in self.model.duplicate_of:
+            self.model.image_title += f' - Duplicate of {self.model.duplicate_of[image_name]}'
+        self.model.image_title += f' - Processed: {self.model.processed_images.count}'
+        self.update_title()
+        self.update_filmstrip()
+
+    def update_title(self):
+        """
+        Shows the current image information together with the state of the background saves in the window title
+        """
+        title: str = self.model.image_title
+        pending, failures = self.save_queue.status()
+        if pending:
+            title += f' - Saving: {pending}'
+        if failures:
+            failed_path, error = failures[-1]
+            title += f' - Failed saves: {len(failures)} (last: {os.path.basename(failed_path)}: {error})'
+        self.view.set_title(title)
+
+    def update_filmstrip(self):
+        if self.thumbnail_loader is None:
+            return
+        reset: bool = self.model.images is not self.filmstrip_images
+        self.filmstrip_images = self.model.images
+        self.view.update_filmstrip(len(self.model.images), self.model.current_file, reset)
+
+    def request_thumbnails(self, positions: range):
+        """
+        Loads the thumbnails of the cells the filmstrip shows, the thumbnails of cells shown before are dropped
+        """
+        images: Sequence[str] = self.model.images
+        names: Dict[str, int] = {images[position]: position for position in positions if position < len(images)}
+        self.thumbnail_loader.request(
+            list(names),
+            self.load_thumbnail,
+            lambda name, thumbnail: self.view.run_on_ui_thread(
+                lambda: self.on_thumbnail_loaded(images, names[name], thumbnail)))
+
+    def load_thumbnail(self, image_name: str) -> Image.Image:
+        return self.thumbnail_cache.get(
+            os.path.join(self.model.args.input_dir, image_name),
+            self.get_image_stat(image_name),
+            lambda: self.get_image_file(image_name))
+
+    def on_thumbnail_loaded(self, images: Sequence[str], position: int, thumbnail: Optional[Image.Image]):
+        # The images at the positions changed in the meantime
+        if images is not self.model.images or thumbnail is None:
+            return
+        self.view.show_thumbnail(position, thumbnail)
+
+    def go_to_image(self, position: int):
+        self.model.current_file = position
+        try:
+            self.load_image(self.model.images[self.model.current_file])
+        except IOError:
+            self.next_image()
+
+    def prepare_image(self, image_name: str, canvas_size: Tuple[int, int]) -> CachedImage:
+        """
+        Decodes the image and scales it down to fit the canvas. Runs on the prefetching worker threads,
+        so it must not touch the view
+        """
+        image: Image = Image.open(self.get_image_file(image_name))
+        orientation: cropping.Orientation = cropping.get_exif_orientation(image)
+        if self.is_large_image(image):
+            image.close()
+            return self.prepare_large_image(
+                os.path.join(self.model.args.input_dir, image_name), canvas_size, orientation)
+        with profiler.span("decode"):
+            image.load()
+        pyramid: ImagePyramid = ImagePyramid(image)
+        with profiler.span("scale"):
+            display_image: Image = pyramid.scale(self.fit_to_canvas(image.size, canvas_size, orientation))
+        return CachedImage(image, display_image, canvas_size, pyramid, orientation, self.score_image(display_image))
+
+    def prepare_large_image(self,
+                            path: str,
+                            canvas_size: Tuple[int, int],
+                            orientation: cropping.Orientation) -> CachedImage:
+        """
+        Prepares an image which doesn't fit into the memory limit: only a reduced preview is decoded
+        """
+        # Square, so the preview stays big enough however the image is rotated
+        preview_side: int = max(canvas_size) * LARGE_IMAGE_PREVIEW_SCALE
+        with profiler.span("decode_preview"):
+            image: LargeImage = LargeImage.open(path, (preview_side, preview_side), self.memory_budget)
+        pyramid: ImagePyramid = ImagePyramid.for_image(image)
+        with profiler.span("scale"):
+            display_image: Image = pyramid.scale(self.fit_to_canvas(image.size, canvas_size, orientation))
+        return CachedImage(image, display_image, canvas_size, pyramid, orientation, self.score_image(display_image))
+
+    def score_image(self, display_image: Image.Image) -> Optional[Any]:
+        """
+        Scores the content of the display image for placing the initial selection box. Done while the image is
+        prepared, so for the upcoming images it's done by the prefetching workers
+        """
+        if self.model.args.initial_box == "corner" or not saliency.is_available():
+            return None
+        with profiler.span("score"):
+            return saliency.score_image(display_image, self.model.args.initial_box)
+
+    def get_image_file(self, image_name: str) -> Union[str, BinaryIO]:
+        """
+        Returns the path of the image, or the image read from the archive the images are listed from
+        """
+        if self.image_archive is not None:
+            with profiler.span("read_archive"):
+                return self.image_archive.open_member(image_name)
+        return os.path.join(self.model.args.input_dir, image_name)
+
+    def get_orientation(self) -> cropping.Orientation:
+        return cropping.rotate_orientation(self.model.exif_orientation, self.model.rotation)
+
+    def fit_to_canvas(self,
+                      image_size: Tuple[int, int],
+                      canvas_size: Tuple[int, int],
+                      orientation: cropping.Orientation) -> Tuple[int, int]:
+        """
+        Returns the size the image is scaled to, before it's transformed into the orientation it's displayed in
+        """
+        oriented_size: Tuple[int, int] = cropping.get_oriented_size(image_size, orientation)
+        canvas_image_dimensions: Tuple[int, int] = self.calculate_canvas_image_dimensions(
+            oriented_size[0], oriented_size[1], canvas_size[0], canvas_size[1])
+        return cropping.get_oriented_size(canvas_image_dimensions, orientation)
+
+    def is_large_image(self, image: Image) -> bool:
+        """
+        Checks whether decoding the opened image would exceed the memory limit, if there is one
+        """
+        # Images of archives are read into memory anyway and the regions of large images are decoded from their path
+        if self.memory_budget is None or self.image_archive is not None:
+            return False
+        memory_limit: int = self.model.args.memory_limit * 1024 * 1024
+        decoded_size: int = get_decoded_size(image.size, image.mode)
+        if decoded_size > memory_limit // LARGE_IMAGE_FRACTION:
+            return True
+        resident_memory: Optional[int] = get_resident_memory()
+        return resident_memory is not None and resident_memory + decoded_size > memory_limit
+
+    @profiler.profiled("display_draft")
+    def display_draft_image(self, image_name: str, canvas_size: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+        """
+        First phase of the progressive display: shows a quick reduced-scale decode of the image and schedules the full
+        quality version, which replaces it once ready. Returns None if the image format has no reduced-scale decoding
+        """
+        # Only the header is read here, the original keeps its full size so crop coordinates map onto it
+        image: Image = Image.open(self.get_image_file(image_name))
+        if self.is_large_image(image):
+            # Its preview is decoded at reduced scale anyway, without ever decoding the original on this thread
+            image.close()
+            return None
+        self.model.exif_orientation = cropping.get_exif_orientation(image)
+        draft_image: Optional[Image.Image] = self.prepare_draft_image(
+            self.get_image_file(image_name), self.fit_to_canvas(image.size, canvas_size, self.get_orientation()))
+        if draft_image is None:
+            image.close()
+            return None
+
+        image_dimensions: Tuple[int, int] = self.display_image_on_canvas(image, draft_image)
+        future: Future = self.prefetcher.request(image_name, canvas_size)
+        self.draft = (image, future)
+        future.add_done_callback(
+            lambda finished: self.view.run_on_ui_thread(lambda: self.refine_displayed_image(image, finished)))
+        return image_dimensions
+
+    @profiler.profiled("refine_display")
+    def refine_displayed_image(self, draft_original: Image, future: Future):
+        """
+        Second phase of the progressive display: replaces the draft with the full quality image, keeping the selection
+        """
+        # The user already moved on to another image
+        if self.model.current_image is not draft_original or future.cancelled():
+            return
+        try:
+            cached_image: CachedImage = future.result()
+        except Exception:
+            # Keep the draft, the error will surface once the original is needed
+            return
+
+        self.model.current_image = cached_image.image
+        self.draft = None
+        self.model.image_pyramid = cached_image.pyramid
+        draft_original.close()
+        display_image: Image = cached_image.display_image
+        # The image may have been rotated while the draft was shown
+        orientation: cropping.Orientation = self.get_orientation()
+        if cached_image.canvas_size != self.get_canvas_size() or self.model.rotation % 180 != 0:
+            with profiler.span("scale"):
+                display_image = self.model.image_pyramid.scale(
+                    cropping.get_oriented_size(self.model.canvas_image_dimensions, orientation))
+        with profiler.span("transpose"):
+            display_image = cropping.orient_image(display_image, orientation)
+        with profiler.span("photoimage"):
+            self.model.displayed_image = ImageTk.PhotoImage(display_image)
+        with profiler.span("draw"):
+            self.view.update_canvas_object(self.model.canvas_image, image=self.model.displayed_image)
+
+    @staticmethod
+    def prepare_draft_image(path: Union[str, BinaryIO], canvas_image_dimensions: Tuple[int, int]) -> Optional[Image.Image]:
+        """
+        Decodes the image at reduced scale (JPEG DCT scaling) and fits it to the canvas with a fast filter.
+        Returns None for formats not supporting reduced-scale decoding
+        """
+        with profiler.span("draft_decode"):
+            draft_image: Image = Image.open(path)
+            if draft_image.draft("RGB", canvas_image_dimensions) is None:
+                draft_image.close()
+                return None
+            draft_image.load()
+        with profiler.span("thumbnail"):
+            draft_image.thumbnail(canvas_image_dimensions, Image.BILINEAR)
+        return draft_image
+
+    def get_canvas_size(self) -> Tuple[int, int]:
+        return (self.view.image_canvas.winfo_width(), self.view.image_canvas.winfo_height())
 
     # TODO: Add option to control it via args from CLI + checkbox on UI
     def draw_initial_selection_box(self):
@@ -80,49 +381,528 @@ class Controller():
 
         # Get current coordinates of the selection box
         left_x, top_y, right_x, bottom_y = self.view.get_canvas_object_coords(self.model.selection_box)
+        if self.model.image_scores is not None and self.model.selection_box is not None:
+            # Content-aware: the box of the same size is moved to where the content of the image scores highest
+            offset_x, offset_y = saliency.suggest_position(
+                self.model.image_scores,
+                image_dimensions,
+                (round(right_x - left_x), round(bottom_y - top_y)),
+                self.get_orientation())
+            self.view.move_canvas_object_by_offset(self.model.selection_box, offset_x, offset_y)
+            left_x, top_y, right_x, bottom_y = left_x + offset_x, top_y + offset_y, right_x + offset_x, bottom_y + offset_y
         self.update_overlays(left_x, top_y, right_x, bottom_y)
         self.update_golden_ratio_lines(left_x, top_y, right_x, bottom_y)
         self.view.tag_raise(self.model.selection_box)
 
     def load_images(self):
+        self.prefetcher.invalidate()
+        self.model.images_generation += 1
+        self.model.rotations = {}
+        self.model.images_sorting = False
+        self.model.pending_directory_changes = []
+        self.model.duplicate_of = {}
+        self.model.resume_pending = False
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.clear()
+        self.stop_watching()
+        self.stop_image_source()
+        self.close_image_archive()
         if self.model.args.input_dir:
             try:
-                self.model.images = self.load_image_list(
-                    self.model.args.input_dir)
-            except OSError:
+                if is_archive(self.model.args.input_dir):
+                    self.model.images = self.open_image_archive(self.model.args.input_dir)
+                elif self.uses_image_source():
+                    self.model.images = self.open_image_source(self.model.args.input_dir)
+                else:
+                    # Started before listing the directory, so no file added in the meantime is missed
+                    if self.model.args.watch:
+                        self.watch_directory(self.model.args.input_dir)
+                    self.model.images = self.index_images(
+                        self.model.args.input_dir)
+            except (OSError, tarfile.TarError, zipfile.BadZipFile):
                 self.view.show_error(
                     "Error", "Input directory cannot be opened")
+        self.start_processed_scan()
 
         if self.model.images:
+            # Big directories are scanned once their complete listing is sorted
+            if not self.model.images_sorting:
+                self.start_duplicate_scan()
             try:
-                self.model.current_file = 0
+                self.model.current_file = self.find_resume_position()
+                # The image saved last may not be listed yet, resuming is tried again once the listing is complete
+                self.model.resume_pending = self.model.images_listing and self.model.current_file == 0
                 self.load_image(self.model.images[self.model.current_file])
             except IOError:
                 self.next_image()
 
-    def display_image_on_canvas(self, image: Image) -> Tuple[int, int]:
+    def uses_image_source(self) -> bool:
+        args = self.model.args
+        return bool(getattr(args, "recursive", False) or getattr(args, "file_list", None) or
+                    getattr(args, "include", None) or getattr(args, "exclude", None))
+
+    def open_image_source(self, directory: str) -> LazyNameList:
+        """
+        Lists the images of the directory tree or the file list lazily: the first image is displayed as soon as it's
+        found, the rest is listed in the background while cropping
+        """
+        args = self.model.args
+        output_dir: Optional[str] = getattr(args, "output_dir", None)
+        # Crops are saved inside of the input tree by default, they must not be listed again
+        skipped_directories: Set[str] = {os.path.abspath(output_dir)} if output_dir else set()
+        names = image_source.create_image_source(
+            directory,
+            getattr(args, "recursive", False),
+            getattr(args, "file_list", None),
+            getattr(args, "include", None) or [],
+            getattr(args, "exclude", None) or [],
+            skipped_directories)
+        generation: int = self.model.images_generation
+        self.model.images_listing = True
+        self.image_source = LazyNameList(
+            names,
+            lambda: self.view.run_on_ui_thread(lambda: self.on_images_listed(generation)))
+        self.image_source.wait_for(1)
+        return self.image_source
+
+    def open_image_archive(self, path: str) -> Sequence[str]:
+        """
+        Indexes the images of the archive, they are named by their path inside of it like the images of a recursively
+        listed directory
+        """
+        self.image_archive = ImageArchive.open(path)
+        include: List[str] = getattr(self.model.args, "include", None) or []
+        exclude: List[str] = getattr(self.model.args, "exclude", None) or []
+        if not include and not exclude:
+            return self.image_archive.names
+        return NameList([name for name in self.image_archive.names if image_source.is_included(name, include, exclude)])
+
+    def close_image_archive(self):
+        if self.image_archive is not None:
+            self.image_archive.close()
+            self.image_archive = None
+
+    def on_images_listed(self, generation: int):
+        # Another directory was opened in the meantime
+        if generation != self.model.images_generation:
+            return
+        self.model.images_listing = False
+        if self.model.resume_pending:
+            self.model.resume_pending = False
+            resume_position: int = self.find_resume_position()
+            # Unless another image was opened in the meantime
+            if resume_position > 0 and self.model.current_file == 0:
+                self.model.current_file = resume_position
+                try:
+                    self.load_image(self.model.images[self.model.current_file])
+                except IOError:
+                    self.next_image()
+                return
+        if self.model.current_image is not None:
+            self.update_image_title(self.model.images[self.model.current_file], self.model.canvas_image_dimensions)
+
+    def stop_image_source(self):
+        if self.image_source is not None:
+            self.image_source.stop()
+            self.image_source = None
+        self.model.images_listing = False
+
+    def wait_for_images(self, count: int) -> bool:
+        """
+        Returns whether there are at least count images, waiting for them while they are still being listed
+        """
+        if self.model.images_listing and self.image_source is not None:
+            return self.image_source.wait_for(count)
+        return len(self.model.images) >= count
+
+    def index_images(self, directory: str) -> Sequence[str]:
+        """
+        Lists the images of the directory, from the persistent index if the directory didn't change. Big directories
+        are sorted in the background: only the first image is listed at first, so it can be displayed right away
+        """
+        cache_dir: Optional[str] = None if self.model.args.no_index_cache else image_index.get_default_cache_dir()
+        if cache_dir is not None:
+            cached_images: Optional[NameList] = image_index.load_index(cache_dir, directory)
+            if cached_images is not None:
+                return cached_images
+
+        mtime_ns: int = os.stat(directory).st_mtime_ns
+        names: List[str] = image_index.scan_image_names(directory)
+        if len(names) < STREAMING_SORT_THRESHOLD:
+            images: NameList = image_index.sort_names(names)
+            if cache_dir is not None:
+                image_index.save_index(cache_dir, directory, images, mtime_ns)
+            return images
+
+        generation: int = self.model.images_generation
+        self.model.images_sorting = True
+        threading.Thread(
+            target=self.sort_images_in_background,
+            args=(directory, names, mtime_ns, cache_dir, generation),
+            name="inbac-index",
+            daemon=True).start()
+        return NameList([image_index.first_name(names)])
+
+    def sort_images_in_background(self,
+                                  directory: str,
+                                  names: List[str],
+                                  mtime_ns: int,
+                                  cache_dir: Optional[str],
+                                  generation: int):
+        images: NameList = image_index.sort_names(names)
+        if cache_dir is not None:
+            image_index.save_index(cache_dir, directory, images, mtime_ns)
+        self.view.run_on_ui_thread(lambda: self.replace_sorted_images(images, generation))
+
+    def replace_sorted_images(self, images: NameList, generation: int):
+        """
+        Called once the complete listing of a big directory is sorted, keeps the displayed image
+        """
+        # Another directory was opened in the meantime
+        if generation != self.model.images_generation:
+            return
+        displayed_image: Optional[str] = self.model.images[self.model.current_file] if self.model.images else None
+        self.model.images_sorting = False
+        for added, removed in self.model.pending_directory_changes:
+            images = self.merge_directory_changes(images, added, removed)
+        self.model.pending_directory_changes = []
+        self.model.images = images
+        self.start_duplicate_scan()
+        self.start_processed_scan()
+        resume_position: int = self.find_resume_position()
+        if resume_position > 0:
+            self.model.current_file = resume_position
+            try:
+                self.load_image(self.model.images[self.model.current_file])
+            except IOError:
+                self.next_image()
+            return
+        self.model.current_file = images.index(displayed_image) if displayed_image in images else 0
+        if self.model.current_image is not None:
+            self.update_image_title(displayed_image, self.model.canvas_image_dimensions)
+            self.prefetcher.prefetch(self.model.images, self.model.current_file, self.get_canvas_size())
+
+    def start_duplicate_scan(self):
+        """
+        Hashes the images in the background and groups near-duplicates, if finding duplicates is enabled
+        """
+        if self.model.args.duplicates == "off":
+            return
+        generation: int = self.model.images_generation
+        images: Sequence[str] = self.model.images
+        cache_dir: Optional[str] = None if self.model.args.no_index_cache else image_index.get_default_cache_dir()
+        threading.Thread(
+            target=duplicates.scan_duplicates,
+            args=(images.follow() if isinstance(images, LazyNameList) else images,
+                  self.get_image_stat,
+                  self.get_image_file,
+                  duplicates.HashCache(cache_dir, self.model.args.input_dir),
+                  self.model.args.duplicate_distance,
+                  lambda found: self.view.run_on_ui_thread(lambda: self.apply_duplicates(found, generation)),
+                  lambda: generation != self.model.images_generation),
+            name="inbac-duplicates",
+            daemon=True).start()
+
+    def get_image_stat(self, image_name: str) -> duplicates.ImageStat:
+        # Images of an archive change together with the archive
+        path: str = self.model.args.input_dir if self.image_archive is not None else os.path.join(
+            self.model.args.input_dir, image_name)
+        stat: os.stat_result = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def apply_duplicates(self, found: Dict[str, str], generation: int):
+        # Another directory was opened in the meantime
+        if generation != self.model.images_generation:
+            return
+        self.model.duplicate_of.update(found)
+        if self.model.current_image is not None and self.model.images[self.model.current_file] in found:
+            self.update_image_title(self.model.images[self.model.current_file], self.model.canvas_image_dimensions)
+
+    def skip_duplicates(self, position: int, step: int) -> int:
+        """
+        Returns the first position from position on in the direction of step which isn't a duplicate of an earlier image
+        """
+        while 0 <= position < len(self.model.images) and self.model.images[position] in self.model.duplicate_of:
+            position += step
+        return position
+
+    def skip_duplicate_group(self):
+        """
+        Goes to the first image after the current one which doesn't belong to its group of duplicates
+        """
+        if not self.model.images:
+            return
+        current_image: str = self.model.images[self.model.current_file]
+        representative: str = self.model.duplicate_of.get(current_image, current_image)
+        position: int = self.model.current_file + 1
+        while self.wait_for_images(position + 1) and representative in (
+                self.model.images[position], self.model.duplicate_of.get(self.model.images[position])):
+            position += 1
+        if self.model.args.duplicates == "collapse":
+            position = self.skip_duplicates(position, 1)
+        if not self.wait_for_images(position + 1):
+            return
+        self.model.current_file = position
+        try:
+            self.load_image(self.model.images[self.model.current_file])
+        except IOError:
+            self.next_image()
+
+    def start_processed_scan(self):
+        """
+        Finds the images which already have crops in the background, from the indexes of the output directory
+        """
+        self.model.processed_images.stop()
+        processed: ProcessedImages = ProcessedImages()
+        self.model.processed_images = processed
+        # Big directories are scanned once their complete listing is sorted
+        if self.model.images_sorting or not getattr(self.model.args, "output_dir", None) or not self.model.images:
+            return
+        images: Sequence[str] = self.model.images
+        threading.Thread(
+            target=self.scan_processed_images,
+            args=(processed, images.follow() if isinstance(images, LazyNameList) else images, self.get_output_sink()),
+            name="inbac-processed",
+            daemon=True).start()
+
+    def scan_processed_images(self, processed: ProcessedImages, images: Iterable[str], sink: OutputSink):
+        iterator: Iterator[str] = iter(images)
+        while not processed.stopped:
+            chunk: List[str] = [name for _, name in zip(range(PROCESSED_SCAN_CHUNK_SIZE), iterator)]
+            if not chunk:
+                break
+            processed.add_built([self.has_crops(sink, name) for name in chunk])
+        self.view.run_on_ui_thread(lambda: self.on_processed_changed(processed))
+
+    def on_processed_changed(self, processed: ProcessedImages):
+        if processed is self.model.processed_images and self.model.current_image is not None:
+            self.update_image_title(self.model.images[self.model.current_file], self.model.canvas_image_dimensions)
+
+    def has_crops(self, sink: OutputSink, image_name: str) -> bool:
+        source_name: str = os.path.basename(image_name)
+        subdirectory: str = sink.get_crop_directory(image_source.get_output_subdirectory(image_name), source_name)
+        return self.find_output_index(sink, subdirectory).highest_crop_number(source_name) > 0
+
+    def next_unprocessed_image(self):
+        """
+        Goes to the first image after the current one which has no crops yet
+        """
+        processed: ProcessedImages = self.model.processed_images
+        position: int = self.model.current_file + 1
+        while self.wait_for_images(position + 1):
+            position = processed.find_unprocessed(position)
+            if not self.wait_for_images(position + 1):
+                return
+            # Positions the background scan didn't reach yet are looked up right away
+            if position < processed.built or not self.has_crops(self.get_output_sink(), self.model.images[position]):
+                self.model.current_file = position
+                try:
+                    self.load_image(self.model.images[self.model.current_file])
+                except IOError:
+                    self.next_image()
+                return
+            position += 1
+
+    def watch_directory(self, directory: str):
+        generation: int = self.model.images_generation
+        self.directory_watcher = DirectoryWatcher(
+            directory,
+            lambda added, removed: self.view.run_on_ui_thread(
+                lambda: self.apply_directory_changes(added, removed, generation)))
+
+    def stop_watching(self):
+        if self.directory_watcher is not None:
+            self.directory_watcher.stop()
+            self.directory_watcher = None
+
+    def apply_directory_changes(self,
+                                added: Optional[Set[str]],
+                                removed: Optional[Set[str]],
+                                generation: int):
+        """
+        Merges the images added to and removed from the watched directory into the list, keeping the position in it
+        """
+        # Another directory was opened in the meantime
+        if generation != self.model.images_generation:
+            return
+        if self.model.images_sorting:
+            self.model.pending_directory_changes.append((added, removed))
+            return
+        displayed_image: Optional[str] = (
+            self.model.images[self.model.current_file]
+            if self.model.images and self.model.current_image is not None else None)
+        self.model.images = self.merge_directory_changes(self.model.images, added, removed)
+        # Positions of the images changed
+        self.start_processed_scan()
+        if not self.model.images:
+            self.model.current_file = 0
+            self.model.current_image = None
+            self.clear_canvas()
+            return
+        if displayed_image in self.model.images:
+            self.model.current_file = self.model.images.index(displayed_image)
+            self.update_image_title(displayed_image, self.model.canvas_image_dimensions)
+            self.prefetcher.prefetch(self.model.images, self.model.current_file, self.get_canvas_size())
+            return
+        # The displayed image was removed (or there was none), the one which took its place is shown
+        position: int = 0 if displayed_image is None else image_index.find_sorted_position(
+            self.model.images, displayed_image)
+        self.model.current_file = min(position, len(self.model.images) - 1)
+        try:
+            self.load_image(self.model.images[self.model.current_file])
+        except IOError:
+            self.next_image()
+
+    def merge_directory_changes(self,
+                                images: Sequence[str],
+                                added: Optional[Set[str]],
+                                removed: Optional[Set[str]]) -> NameList:
+        if added is None:
+            # The watcher lost track of the changes, they are found by scanning the directory again
+            added = set(image_index.scan_image_names(self.model.args.input_dir))
+            removed = set(images) - added
+        return image_index.merge_names(images, added, removed)
+
+    def find_resume_position(self) -> int:
+        """
+        Returns the index of the first image after the furthest one saved in a previous session, according to the
+        journal. Crops are saved in the background, so the entries written last aren't necessarily of the furthest image
+        """
+        output_dir: Optional[str] = getattr(self.model.args, "output_dir", None)
+        if not output_dir:
+            return 0
+        sources: Set[str] = {
+            entry["source"] for entry in CropJournal.read_last_entries(output_dir, RESUME_JOURNAL_ENTRIES)}
+        last_saved: int = -1
+        if isinstance(self.model.images, LazyNameList):
+            # Looking up every name would walk the list each time
+            for position, name in enumerate(self.model.images):
+                if name in sources:
+                    last_saved = position
+        else:
+            for source in sources:
+                try:
+                    last_saved = max(last_saved, self.model.images.index(source))
+                except ValueError:
+                    pass
+        if last_saved < 0:
+            return 0
+        return min(last_saved + 1, len(self.model.images) - 1)
+
+    def get_journal(self) -> CropJournal:
+        output_dir: str = self.model.args.output_dir
+        if self.journal is None or self.journal.output_dir != output_dir:
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = CropJournal(output_dir)
+        return self.journal
+
+    def get_output_sink(self) -> OutputSink:
+        output_dir: str = self.model.args.output_dir
+        if self.output_sink is None or self.output_sink.directory != output_dir:
+            if self.output_sink is not None:
+                # Crops still being saved into the previous output directory are written there
+                self.save_queue.flush()
+                self.output_sink.close()
+            self.output_sink = create_output_sink(
+                output_dir, self.model.args.output_layout, self.model.args.shard_size * 1024 * 1024)
+            self.output_indexes = {}
+        return self.output_sink
+
+    def get_output_index(self, subdirectory: str = "") -> OutputIndex:
+        return self.find_output_index(self.get_output_sink(), subdirectory)
+
+    def find_output_index(self, sink: OutputSink, subdirectory: str) -> OutputIndex:
+        output_dir: str = os.path.normpath(os.path.join(sink.directory, subdirectory))
+        with self.output_index_lock:
+            if output_dir not in self.output_indexes:
+                self.output_indexes[output_dir] = sink.create_output_index(subdirectory)
+            return self.output_indexes[output_dir]
+
+    def supports_filename_gaps(self) -> bool:
+        """
+        Filename gaps are only managed for crops saved as files directly in the output directory
+        """
+        return self.model.args.output_layout == "directory"
+
+    def invalidate_output_index(self):
+        """
+        Has to be called before files in the output directory are renamed, the index is rebuilt on the next save
+        """
+        self.save_queue.flush()
+        self.output_indexes = {}
+
+    @profiler.profiled("display")
+    def display_image_on_canvas(self,
+                                image: Image,
+                                displayed_image: Optional[Image.Image] = None,
+                                resample: int = Image.LANCZOS) -> Tuple[int, int]:
         """
         Called when the main window is resized, a new image is being loaded or the image is rotated.
-        Displays the requested image on the canvas
+        Displays the requested image on the canvas in the current orientation. An already downscaled version of the
+        image, not transformed into the orientation yet, can be passed (e.g. from the image cache) to skip scaling
         """
         self.clear_canvas()
         self.model.current_image = image
+        canvas_width, canvas_height = self.get_canvas_size()
+        self.model.displayed_canvas_size = (canvas_width, canvas_height)
+        self.model.displayed_resample = resample
+        orientation: cropping.Orientation = self.get_orientation()
+        oriented_size: Tuple[int, int] = cropping.get_oriented_size(image.size, orientation)
         self.model.canvas_image_dimensions = self.calculate_canvas_image_dimensions(
-            self.model.current_image.size[0],
-            self.model.current_image.size[1],
-            self.view.image_canvas.winfo_width(),
-            self.view.image_canvas.winfo_height())
-        displayed_image: Image = self.model.current_image.copy()
-        displayed_image.thumbnail(
-            self.model.canvas_image_dimensions, Image.LANCZOS)
-        self.model.displayed_image = ImageTk.PhotoImage(displayed_image)
-        self.model.canvas_image = self.view.display_image(
-            self.model.displayed_image)
-
-        self.draw_initial_selection_box()
+            oriented_size[0],
+            oriented_size[1],
+            canvas_width,
+            canvas_height)
+        if displayed_image is None:
+            if self.model.image_pyramid is None or self.model.image_pyramid.source is not image:
+                self.model.image_pyramid = ImagePyramid.for_image(image)
+            with profiler.span("scale"):
+                displayed_image = self.model.image_pyramid.scale(
+                    cropping.get_oriented_size(self.model.canvas_image_dimensions, orientation), resample)
+        # Only the downscaled image is transformed, the original keeps the orientation it was decoded in
+        with profiler.span("transpose"):
+            displayed_image = cropping.orient_image(displayed_image, orientation)
+        with profiler.span("photoimage"):
+            self.model.displayed_image = ImageTk.PhotoImage(displayed_image)
+        with profiler.span("draw"):
+            self.model.canvas_image = self.view.display_image(
+                self.model.displayed_image)
+
+            self.draw_initial_selection_box()
+            self.draw_placed_boxes()
 
         return self.model.canvas_image_dimensions
 
+    def on_canvas_resize(self):
+        """
+        Coalesces the configure events of an interactive window resize: the image is rescaled at most once per idle
+        period with a fast filter, and once more in full quality after the resizing settled
+        """
+        if self.model.current_image is None:
+            return
+        if not self.model.resize_redraw_scheduled:
+            self.model.resize_redraw_scheduled = True
+            self.view.schedule_idle(self.redraw_resized_image)
+        if self.model.resize_settle_job is not None:
+            self.view.cancel_scheduled(self.model.resize_settle_job)
+        self.model.resize_settle_job = self.view.schedule(RESIZE_SETTLE_DELAY_MS, self.redraw_settled_image)
+
+    def redraw_resized_image(self):
+        self.model.resize_redraw_scheduled = False
+        if self.model.current_image is None or self.get_canvas_size() == self.model.displayed_canvas_size:
+            return
+        self.display_image_on_canvas(self.model.current_image, resample=Image.BILINEAR)
+
+    def redraw_settled_image(self):
+        self.model.resize_settle_job = None
+        if self.model.current_image is None:
+            return
+        if (self.get_canvas_size() == self.model.displayed_canvas_size and
+                self.model.displayed_resample == Image.LANCZOS):
+            return
+        self.display_image_on_canvas(self.model.current_image)
+
     def clear_canvas(self):
         self.clear_selection_box()
         if self.model.canvas_image is not None:
@@ -130,6 +910,10 @@ class Controller():
             self.model.canvas_image = None
 
     def clear_selection_box(self):
+        # Mouse input not rendered yet belongs to the cleared box
+        self.model.pending_move_coord = None
+        self.model.pending_zoom_steps = 0
+
         if self.model.selection_box is not None:
             self.view.remove_from_canvas(self.model.selection_box)
             self.model.selection_box = None
@@ -173,12 +957,39 @@ class Controller():
             self.update_overlays(selected_box[0], selected_box[1], selected_box[2], selected_box[3])
             # Draw the golden ratio lines
             self.update_golden_ratio_lines(selected_box[0], selected_box[1], selected_box[2], selected_box[3])
-            self.view.tag_raise(self.model.selection_box)
 
     def stop_selection(self):
+        # Apply the last mouse position before the dragged box is released
+        self.render_scheduler.flush()
         self.model.box_selected = False
 
+    def request_move_selection(self, move_coord: Tuple[int, int]):
+        """
+        Called for mouse motion events, only the latest position is rendered in the next frame
+        """
+        self.model.pending_move_coord = move_coord
+        self.render_scheduler.request()
+
     def on_mouse_wheel_zoom(self, delta: int):
+        """
+        Called for mouse wheel events, the zoom steps are accumulated and rendered in the next frame
+        """
+        if not self.model.selection_box:
+            return
+        self.model.pending_zoom_steps += 1 if delta > 0 else -1
+        self.render_scheduler.request()
+
+    def render_selection(self):
+        if self.model.pending_move_coord is not None:
+            move_coord: Tuple[int, int] = self.model.pending_move_coord
+            self.model.pending_move_coord = None
+            self.move_selection(move_coord)
+        if self.model.pending_zoom_steps:
+            zoom_steps: int = self.model.pending_zoom_steps
+            self.model.pending_zoom_steps = 0
+            self.zoom_selection(zoom_steps)
+
+    def zoom_selection(self, steps: int):
         if not self.model.selection_box:
             return
 
@@ -190,8 +1001,7 @@ class Controller():
         height: int = bottom_y - top_y
 
         # Calculate the change in size
-        direction: int = 1 if delta > 0 else -1
-        delta: int = self.model.effective_scrolling_speed_in_px * direction
+        delta: int = self.model.effective_scrolling_speed_in_px * steps
 
         # Maintain user defined aspect ratio and if not present the current selection box'
         aspect_ratio: Tuple[int, int] = self.model.args.aspect_ratio if self.model.args.aspect_ratio is not None else (width, height)
@@ -223,9 +1033,9 @@ class Controller():
         self.update_overlays(left_x, top_y, left_x + new_width, top_y + new_height)
         # Draw the golden ratio lines
         self.update_golden_ratio_lines(left_x, top_y, left_x + new_width, top_y + new_height)
-        self.view.tag_raise(self.model.selection_box)
 
     def start_selection(self, press_coord: Tuple[int, int]):
+        self.render_scheduler.flush()
         self.model.press_coord = press_coord
         self.model.move_coord = press_coord
         if self.is_outside_image_dimensions(press_coord):
@@ -297,7 +1107,6 @@ class Controller():
                 self.update_overlays(new_x0, new_y0, new_x1, new_y1)
                 # Draw the golden ratio lines
                 self.update_golden_ratio_lines(new_x0, new_y0, new_x1, new_y1)
-                self.view.tag_raise(self.model.selection_box)
         else:
             self.update_selection_box()
 
@@ -307,18 +1116,25 @@ class Controller():
         return not self.coordinates_in_selection_box(move_coord, image_box)
 
     def next_image(self):
-        if self.model.current_file + 1 >= len(self.model.images):
+        position: int = self.model.current_file + 1
+        if self.model.args.duplicates == "collapse":
+            # Only the first image of every group of duplicates is shown
+            position = self.skip_duplicates(position, 1)
+        if not self.wait_for_images(position + 1):
             return
-        self.model.current_file += 1
+        self.model.current_file = position
         try:
             self.load_image(self.model.images[self.model.current_file])
         except IOError:
             self.next_image()
 
     def previous_image(self):
-        if self.model.current_file - 1 < 0:
+        position: int = self.model.current_file - 1
+        if self.model.args.duplicates == "collapse":
+            position = self.skip_duplicates(position, -1)
+        if position < 0:
             return
-        self.model.current_file -= 1
+        self.model.current_file = position
         try:
             self.load_image(self.model.images[self.model.current_file])
         except IOError:
@@ -328,38 +1144,190 @@ class Controller():
         if self.save():
             self.next_image()
 
+    @profiler.profiled("save")
     def save(self) -> bool:
-        if self.model.selection_box is None:
+        """
+        Saves the placed boxes and the selection of the current image in one pass: the image is decoded once, the
+        names are allocated in one step and the crops are encoded in parallel by the save queue
+        """
+        source_boxes: List[Tuple[int, int, int, int]] = list(self.model.placed_boxes)
+        if self.model.selection_box is not None:
+            source_boxes.append(self.get_source_box(self.view.get_canvas_object_coords(self.model.selection_box)))
+        if not source_boxes:
             return False
-        selected_box: Tuple[int, int, int, int] = self.view.get_canvas_object_coords(
-            self.model.selection_box)
-        box: Tuple[int, int, int, int] = self.get_real_box(
-            selected_box, self.model.current_image.size, self.model.canvas_image_dimensions)
-        new_filename: str = self.find_available_name(
-            self.model.args.output_dir, self.model.images[self.model.current_file])
-        saved_image: Image = self.model.current_image.copy().crop(box)
-        if self.model.args.resize:
-            saved_image = saved_image.resize(
-                (self.model.args.resize[0], self.model.args.resize[1]), Image.LANCZOS)
-        if self.model.args.image_format:
-            new_filename, _ = os.path.splitext(new_filename)
         if not os.path.exists(self.model.args.output_dir):
             self.create_output_directory()
-        saved_image.save(
-            os.path.join(
-                self.model.args.output_dir,
-                new_filename),
-            self.model.args.image_format,
-            quality=self.model.args.image_quality)
+        source: str = self.model.images[self.model.current_file]
+        # Crops of images in subdirectories of the input tree are saved into the same subdirectories of the output
+        subdirectory: str = self.get_output_sink().get_crop_directory(
+            image_source.get_output_subdirectory(source), os.path.basename(source))
+        self.create_output_subdirectories(subdirectory)
+        # Names are taken as soon as they are allocated, even though saves in flight didn't create the files yet
+        new_filenames: List[str] = [
+            os.path.join(subdirectory, new_filename)
+            for new_filename in self.get_output_index(subdirectory).allocate_many(
+                os.path.basename(source), len(source_boxes), self.model.args.image_format)]
+        journal: CropJournal = self.get_journal()
+        image: Union[Image.Image, Callable[[], Image.Image]] = self.get_image_to_crop(source)
+        for source_box, new_filename in zip(source_boxes, new_filenames):
+            self.submit_crop(journal, image, source, source_box, new_filename)
+        self.clear_placed_boxes()
+        self.update_title()
         return True
 
+    def get_image_to_crop(self, source: str) -> Union[Image.Image, Callable[[], Image.Image]]:
+        """
+        Returns the current image, or for a draft shown by the progressive display a function returning the decoded
+        original: the save workers wait for the decode by the prefetcher, so saving doesn't block the UI
+        """
+        if self.draft is None or self.draft[0] is not self.model.current_image:
+            return self.model.current_image
+        future: Future = self.draft[1]
+        canvas_size: Tuple[int, int] = self.get_canvas_size()
+
+        def get_decoded_image() -> Image.Image:
+            try:
+                return future.result().image
+            except CancelledError:
+                # The decode was dropped when moving on before it started
+                return self.prepare_image(source, canvas_size).image
+        return get_decoded_image
+
+    def submit_crop(self,
+                    journal: CropJournal,
+                    image: Union[Image.Image, Callable[[], Image.Image]],
+                    source: str,
+                    source_box: Tuple[int, int, int, int],
+                    new_filename: str):
+        orientation: cropping.Orientation = self.get_orientation()
+        # Journaled like it was selected, on the image in its orientation
+        box: Tuple[int, int, int, int] = cropping.orient_box(source_box, orientation, self.model.current_image.size)
+        rotation: int = self.model.rotation
+        # The positions may change while the crop is saved, it's marked in the state of the list it was saved from
+        processed: ProcessedImages = self.model.processed_images
+        position: int = self.model.current_file
+        rendition_outputs: List[RenditionOutput] = [
+            (rendition, os.path.join(self.model.args.output_dir, rendition.subfolder,
+                                     cropping.get_output_filename(new_filename, rendition.image_format)))
+            for rendition in self.model.args.renditions]
+        self.save_queue.submit(
+            image,
+            source_box,
+            os.path.join(self.model.args.output_dir, new_filename),
+            self.model.args.resize,
+            self.model.args.image_format,
+            self.model.args.image_quality,
+            cropping.RESAMPLE_FILTERS[self.model.args.resample],
+            self.model.args.reducing_gap,
+            orientation,
+            rendition_outputs,
+            lambda: self.on_crop_saved(journal, processed, position, source, box, rotation, new_filename),
+            self.get_output_sink())
+
+    def on_crop_saved(self,
+                      journal: CropJournal,
+                      processed: ProcessedImages,
+                      position: int,
+                      source: str,
+                      box: Tuple[int, int, int, int],
+                      rotation: int,
+                      new_filename: str):
+        """
+        Called on a save worker once the crop is written without errors
+        """
+        journal.append(
+            source,
+            box,
+            rotation,
+            self.model.args.resize,
+            self.model.args.image_format,
+            self.model.args.image_quality,
+            new_filename)
+        processed.mark(position)
+        self.view.run_on_ui_thread(lambda: self.on_processed_changed(processed))
+
+    def create_output_subdirectories(self, subdirectory: str):
+        directories: List[str] = [subdirectory] if subdirectory else []
+        directories.extend(os.path.join(rendition.subfolder, subdirectory) for rendition in self.model.args.renditions)
+        for directory in directories:
+            try:
+                self.get_output_sink().make_directories(directory)
+            except OSError:
+                # Saving the crops fails and is reported in the title
+                pass
+
+    def get_source_box(self, selected_box: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        """
+        Maps a box selected on the canvas onto the current image as it's decoded. The box is selected on the image
+        in its orientation, only the cropped region is transformed when it's saved
+        """
+        orientation: cropping.Orientation = self.get_orientation()
+        box: Tuple[int, int, int, int] = self.get_real_box(
+            selected_box,
+            cropping.get_oriented_size(self.model.current_image.size, orientation),
+            self.model.canvas_image_dimensions)
+        return cropping.unorient_box(box, orientation, self.model.current_image.size)
+
+    def place_selection_box(self):
+        """
+        Keeps the selection as another box of the current image and clears it, so the next box can be selected
+        """
+        if self.model.selection_box is None:
+            return
+        # Apply mouse input which isn't rendered yet
+        self.render_scheduler.flush()
+        self.model.placed_boxes.append(
+            self.get_source_box(self.view.get_canvas_object_coords(self.model.selection_box)))
+        self.clear_selection_box()
+        self.draw_placed_boxes()
+
+    def draw_placed_boxes(self):
+        for placed_box_object in self.model.placed_box_objects:
+            self.view.remove_from_canvas(placed_box_object)
+        self.model.placed_box_objects.clear()
+        orientation: cropping.Orientation = self.get_orientation()
+        oriented_size: Tuple[int, int] = cropping.get_oriented_size(self.model.current_image.size, orientation)
+        for source_box in self.model.placed_boxes:
+            # Mapping from the image onto the canvas is the same as the other way round with the sizes swapped
+            canvas_box: Tuple[int, int, int, int] = self.get_real_box(
+                cropping.orient_box(source_box, orientation, self.model.current_image.size),
+                self.model.canvas_image_dimensions,
+                oriented_size)
+            self.model.placed_box_objects.append(self.view.create_rectangle(
+                canvas_box, self.model.args.selection_box_color, dash=PLACED_BOX_DASH))
+
+    def clear_placed_boxes(self):
+        self.model.placed_boxes = []
+        for placed_box_object in self.model.placed_box_objects:
+            self.view.remove_from_canvas(placed_box_object)
+        self.model.placed_box_objects.clear()
+
+    @profiler.profiled("rotate")
     def rotate_image(self):
         if self.model.current_image is not None:
-            rotated_image = self.model.current_image.transpose(Image.ROTATE_90)
-            self.model.current_image.close()
-            self.model.current_image = None
-            self.display_image_on_canvas(rotated_image)
+            # Only the display image is rescaled from the pyramid and rotated, the original is left as it is
+            self.model.rotation = (self.model.rotation + 90) % 360
+            self.model.rotations[self.model.images[self.model.current_file]] = self.model.rotation
+            self.display_image_on_canvas(self.model.current_image)
     
+    def exit(self):
+        # Don't lose crops which are still being saved in the background
+        self.stop_watching()
+        self.model.processed_images.stop()
+        self.stop_image_source()
+        self.save_queue.shutdown()
+        if self.output_sink is not None:
+            self.output_sink.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.prefetcher.shutdown()
+        if self.thumbnail_loader is not None:
+            self.thumbnail_loader.shutdown()
+        self.close_image_archive()
+        if profiler.active_profiler is not None:
+            profiler.active_profiler.write(self.model.args.profile)
+        self.view.master.quit()
+
     def rotate_aspect_ratio(self):
         if self.model.args.aspect_ratio is not None:
             self.model.args.aspect_ratio = (
@@ -383,6 +1351,9 @@ class Controller():
         self.model.overlay_bottom = self.view.create_overlay((0, image_dimensions[1], image_dimensions[0], image_dimensions[1]), stipple=stipple)
         self.model.overlay_left = self.view.create_overlay((0, 0, 0, image_dimensions[1]), stipple=stipple)
         self.model.overlay_right = self.view.create_overlay((image_dimensions[0], 0, image_dimensions[0], image_dimensions[1]), stipple=stipple)
+        self.model.applied_overlay_stipple = stipple
+        # Overlays are created after the selection box, keep the box visible on top of them
+        self.view.tag_raise(self.model.selection_box)
 
     def update_overlays(self, left_x, top_y, right_x, bottom_y):
         image_dimensions = self.model.canvas_image_dimensions
@@ -396,18 +1367,18 @@ class Controller():
 
     def update_overlay_style(self):
         stipple = self.model.overlay_stipple
+        # Restyling the overlays is only needed after the style was toggled
+        if self.model.overlay_top is None or stipple == self.model.applied_overlay_stipple:
+            return
 
         self.view.update_canvas_object(self.model.overlay_top, stipple=stipple)
         self.view.update_canvas_object(self.model.overlay_bottom, stipple=stipple)
         self.view.update_canvas_object(self.model.overlay_left, stipple=stipple)
         self.view.update_canvas_object(self.model.overlay_right, stipple=stipple)
+        self.model.applied_overlay_stipple = stipple
     
     # TODO: Add option to control display of golden ratio lines via args from CLI + checkbox on UI
     def update_golden_ratio_lines(self, left_x, top_y, right_x, bottom_y):
-        for line in self.model.golden_ratio_lines:
-            self.view.remove_from_canvas(line)
-        self.model.golden_ratio_lines.clear()
-
         width = right_x - left_x
         height = bottom_y - top_y
 
@@ -416,18 +1387,25 @@ class Controller():
         # Vertical lines
         vertical_line_1_x = left_x + width / phi
         vertical_line_2_x = right_x - width / phi
-        self.model.golden_ratio_lines.append(
-            self.view.create_line((vertical_line_1_x, top_y, vertical_line_1_x, bottom_y), fill=self.model.args.selection_box_color))
-        self.model.golden_ratio_lines.append(
-            self.view.create_line((vertical_line_2_x, top_y, vertical_line_2_x, bottom_y), fill=self.model.args.selection_box_color))
-
         # Horizontal lines
         horizontal_line_1_y = top_y + height / phi
         horizontal_line_2_y = bottom_y - height / phi
-        self.model.golden_ratio_lines.append(
-            self.view.create_line((left_x, horizontal_line_1_y, right_x, horizontal_line_1_y), fill=self.model.args.selection_box_color))
-        self.model.golden_ratio_lines.append(
-            self.view.create_line((left_x, horizontal_line_2_y, right_x, horizontal_line_2_y), fill=self.model.args.selection_box_color))
+        line_coords = [
+            (vertical_line_1_x, top_y, vertical_line_1_x, bottom_y),
+            (vertical_line_2_x, top_y, vertical_line_2_x, bottom_y),
+            (left_x, horizontal_line_1_y, right_x, horizontal_line_1_y),
+            (left_x, horizontal_line_2_y, right_x, horizontal_line_2_y)]
+
+        # The lines live as long as the selection box, afterwards they are only moved
+        if self.model.golden_ratio_lines:
+            for line, coords in zip(self.model.golden_ratio_lines, line_coords):
+                self.view.change_canvas_overlay_coords(line, coords)
+            return
+
+        for coords in line_coords:
+            self.model.golden_ratio_lines.append(
+                self.view.create_line(coords, fill=self.model.args.selection_box_color))
+        self.view.tag_raise(self.model.selection_box)
 
 
     @staticmethod
@@ -445,16 +1423,8 @@ class Controller():
         return (image_width, image_height)
 
     @staticmethod
-    def load_image_list(directory: str) -> List[str]:
-        images: List[str] = []
-
-        for filename in os_sorted(os.listdir(directory)):
-            filetype, _ = mimetypes.guess_type(filename)
-            if filetype is None or filetype.split("/")[0] != "image":
-                continue
-            images.append(filename)
-
-        return images
+    def load_image_list(directory: str) -> Sequence[str]:
+        return image_index.list_images(directory)
 
     @staticmethod
     def coordinates_in_selection_box(
@@ -462,19 +1432,12 @@ class Controller():
         return (coordinates[0] >= selection_box[0] and coordinates[0] <= selection_box[2]
                 and coordinates[1] >= selection_box[1] and coordinates[1] <= selection_box[3])
 
-    @staticmethod
-    def find_available_name(directory: str, filename: str) -> str:
-        crop_suffix: str = '_crop'
-        name, extension = os.path.splitext(filename)
-        for num in itertools.count(1):
-            if not os.path.isfile(
-                os.path.join(
-                    directory,
-                    name +
-                    crop_suffix +
-                    str(num) +
-                    extension)):
-                return name + crop_suffix + str(num) + extension
+    def find_available_name(self, directory: str, filename: str) -> str:
+        """
+        Allocates the name from the index of the directory kept by the controller, which is only scanned once
+        """
+        sink: OutputSink = self.get_output_sink()
+        return self.find_output_index(sink, os.path.relpath(directory, sink.directory)).allocate(filename)
 
     @staticmethod
     def get_selected_box(image_dimensions: Tuple[int, int],
@@ -575,40 +1538,17 @@ class Controller():
                                                                                                               displayed_image_size[1]))
 
     @staticmethod
+    @profiler.profiled("remove_gaps")
     def remove_filename_gaps(directory, process_all=True):
         """
         Removes the sequence number gaps in filenames of image files containing the "_crop" identifier. Can be performed for all files
         of the current directory or only the newest one
         """
-
-        files_dict = Controller.collect_cropped_files(directory, process_all=process_all)
-
-        # Process each group of files
-        failed_renamings = {}
-        for base_name, files in files_dict.items():
-
-            # Rename files forward to remove gaps (forward direction to avoid possible conflicts!)
-            for new_index, (_, suffix, extension, old_filename) in enumerate(files, start=1):
-                try:
-                    Controller.rename_file(directory, old_filename, base_name, new_index, extension)
-                except FileExistsError:
-                    # File exists -> collision:
-                    #  => Collect planned renaming and perform later, once blocking file is renamed as well
-                    new_base_name = f"{TMP_FILENAME_PREFIX}{base_name}"
-                    new_filename = Controller.rename_file(directory, old_filename, new_base_name, new_index, extension)
-                    failed_renamings[new_filename] = new_filename.replace(TMP_FILENAME_PREFIX, '')
-
-
-        # Finally rename files to real filename which failed earlier due to temporary filename collisions
-        #  -> now all files should be renamed so that collisions won't occur anymore!
-        for tmp_filename, real_filename in failed_renamings.items():
-            old_filepath = os.path.join(directory, tmp_filename)
-            new_filepath = os.path.join(directory, real_filename)
-            if old_filename != new_filename:
-                os.rename(old_filepath, new_filepath)
+        rename_planner.plan_remove_filename_gaps(directory, process_all=process_all).execute()
 
 
     @staticmethod
+    @profiler.profiled("insert_gaps")
     def insert_filename_gaps(directory, gap_after, gap_size=DEFAULT_GAP_SIZE):
         """
         Introduces gaps of the specified gap_size (default=100) to the filenames after the specified index. Can only be performed for latest file
@@ -621,72 +1561,9 @@ class Controller():
         if gap_size is None or gap_size < 1:
             gap_size = DEFAULT_GAP_SIZE
 
-
-        # Start processing
-        files_dict = Controller.collect_cropped_files(directory, process_all=False)
-
-        if len(files_dict) > 1:
-            raise Exception("Invalid amount of files -> Only in latest file gaps can be introduced!")
-
-        # Process each group of files
-        for base_name, files in files_dict.items():
-
-            # Rename files to close the gaps or introduce the new gaps (backward to avoid conflicts)
-            for i in range(len(files)-1, -1, -1):
-                crop_number, suffix, extension, old_filename = files[i]
-                if gap_after is not None and crop_number > gap_after:
-                    new_crop_number = crop_number + gap_size
-                else:
-                    # Exit -> Since file list is sorted won't find a higher crop number to raise & rename
-                    break
-                Controller.rename_file(directory, old_filename, base_name, new_crop_number, extension)
-
-
-    @staticmethod
-    def collect_cropped_files(directory:str, process_all: bool=True, extensions: list[str]=IMAGE_FILE_EXTENSIONS) -> dict[str, list[(int, str, str, str)]]:
-        
-        # Dictionary to hold filenames by their base name
-        files_dict = {}
-        
-        # List all image files in the directory *as per operating system order* => very important for keeping correct order of files and not mixing!!
-        files = [
-            filename
-            for filename in os_sorted(os.listdir(directory))    # sorting according to the operating system!
-            if filename.lower().endswith(extensions) and CROPPED_IMAGE_PATTERN.match(filename)
-        ]
-        
-        # If not processing all, select only the last file based on modification time
-        latest_file_base_name=None
-        if not process_all and files:
-            newest_file = files[-1]
-            match = CROPPED_IMAGE_PATTERN.match(newest_file)
-            if match:
-                latest_file_base_name = match.group(1)
-        
-        # Extract and categorize files based on the regular expression (-> create files_dict)
-        for filename in files:
-            match = CROPPED_IMAGE_PATTERN.match(filename)
-            if match:
-                base_name = match.group(1)
-                crop_number = int(match.group(2))
-                suffix = match.group(3)
-                extension = match.group(4)
-                # Only continue processing/ collecting files, when they match the latest file's base name (in case process_all=False provided)
-                if latest_file_base_name is None or base_name == latest_file_base_name:
-                    if base_name not in files_dict:
-                        # Only add key once to dict
-                        files_dict[base_name] = []
-                    files_dict[base_name].append((crop_number, suffix, extension, filename))
-        
-        return files_dict
+        rename_planner.plan_insert_filename_gaps(directory, gap_after, gap_size, process_all=False).execute()
 
 
     @staticmethod
-    def rename_file(directory: str, old_filename: str, base_name: str, new_index: int, extension: str) -> str:
-        new_filename = f"{base_name}{new_index}{extension}"
-        old_filepath = os.path.join(directory, old_filename)
-        new_filepath = os.path.join(directory, new_filename)
-        if old_filename != new_filename:
-            os.rename(old_filepath, new_filepath)
-            return new_filename
-        return None
+    def collect_cropped_files(directory:str, process_all: bool=True, extensions: Tuple[str, ...]=IMAGE_FILE_EXTENSIONS) -> Dict[str, List[rename_planner.CroppedFile]]:
+        return rename_planner.collect_cropped_files(directory, process_all, extensions)
@@ -0,0 +1,303 @@
+import io
+import math
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from inbac import profiler
+
+CROP_SUFFIX: str = '_crop'
+IMAGE_FILE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Extensions of all formats crops can be saved in (-f)
+OUTPUT_FILE_EXTENSIONS: Tuple[str, ...] = tuple(sorted(
+    extension for extension, image_format in Image.registered_extensions().items() if image_format in Image.SAVE))
+# Regular expression to match the filename structure of cropped images
+CROPPED_IMAGE_PATTERN = re.compile(
+    r"(.*_crop)(\d+)(.*)(" + "|".join(re.escape(extension) for extension in OUTPUT_FILE_EXTENSIONS) + ")$",
+    re.IGNORECASE)
+# Extensions used for explicitly requested image formats, where Pillow registers more than one
+PREFERRED_FORMAT_EXTENSIONS: Dict[str, str] = {"JPEG": ".jpg", "TIFF": ".tif", "PNG": ".png"}
+# Filters crops can be resized with, by their command line names
+RESAMPLE_FILTERS: Dict[str, int] = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+# (mirrored, counter clockwise rotation in degrees) of an image, it's mirrored left to right before the rotation
+Orientation = Tuple[bool, int]
+NO_ORIENTATION: Orientation = (False, 0)
+EXIF_ORIENTATION_TAG: int = 0x0112
+# Orientations the EXIF orientation values describe
+EXIF_ORIENTATIONS: Dict[int, Orientation] = {
+    1: (False, 0),
+    2: (True, 0),
+    3: (False, 180),
+    4: (True, 180),
+    5: (True, 90),
+    6: (False, 270),
+    7: (True, 270),
+    8: (False, 90),
+}
+# Every orientation is a single transposition
+ORIENTATION_METHODS: Dict[Orientation, int] = {
+    (False, 90): Image.ROTATE_90,
+    (False, 180): Image.ROTATE_180,
+    (False, 270): Image.ROTATE_270,
+    (True, 0): Image.FLIP_LEFT_RIGHT,
+    (True, 90): Image.TRANSPOSE,
+    (True, 180): Image.FLIP_TOP_BOTTOM,
+    (True, 270): Image.TRANSVERSE,
+}
+# Downscaling by an integer factor first is in most cases indistinguishable from resampling the whole way with
+# the filter, as long as the reduced image stays this many times bigger than the target
+DEFAULT_REDUCING_GAP: float = 3.0
+
+
+def get_format_extension(image_format: str) -> str:
+    image_format = image_format.upper()
+    if image_format in PREFERRED_FORMAT_EXTENSIONS:
+        return PREFERRED_FORMAT_EXTENSIONS[image_format]
+    for extension, registered_format in Image.registered_extensions().items():
+        if registered_format == image_format:
+            return extension
+    return ""
+
+
+def get_format_from_path(path: str) -> Optional[str]:
+    # Like Image.save, which infers the format from the extension when none is given
+    return Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+
+
+def get_output_filename(crop_name: str, image_format: Optional[str]) -> str:
+    # When an explicit image format is requested the extension of the source image is replaced by its extension
+    if image_format:
+        crop_name, _ = os.path.splitext(crop_name)
+        crop_name += get_format_extension(image_format)
+    return crop_name
+
+
+def get_exif_orientation(image: Image.Image) -> Orientation:
+    """
+    Returns the orientation from the EXIF data of the opened image, without decoding it. The PNG plugin would
+    decode the whole image looking for EXIF data after the pixels, only EXIF data in the header is used instead
+    """
+    return EXIF_ORIENTATIONS.get(Image.Image.getexif(image).get(EXIF_ORIENTATION_TAG), NO_ORIENTATION)
+
+
+def rotate_orientation(orientation: Orientation, rotation: int) -> Orientation:
+    """
+    Returns the orientation further rotated counter clockwise by rotation degrees
+    """
+    return (orientation[0], (orientation[1] + rotation) % 360)
+
+
+def get_oriented_size(size: Tuple[int, int], orientation: Orientation) -> Tuple[int, int]:
+    # Also maps an oriented size back, as rotations only swap the sides
+    if orientation[1] % 180 == 0:
+        return size
+    return (size[1], size[0])
+
+
+def orient_image(image: Image.Image, orientation: Orientation) -> Image.Image:
+    """
+    Transposes the image into the orientation, returns the image itself if it doesn't have to change
+    """
+    method: Optional[int] = ORIENTATION_METHODS.get((orientation[0], orientation[1] % 360))
+    if method is None:
+        return image
+    return image.transpose(method)
+
+
+def unrotate_box(box: Tuple[int, int, int, int],
+                 rotation: int,
+                 source_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Maps a box in the coordinates of the image rotated counter clockwise by rotation degrees back onto the
+    image of source_size before the rotation
+    """
+    for step in reversed(range((rotation // 90) % 4)):
+        # Width of the image before this rotation step
+        width: int = source_size[0] if step % 2 == 0 else source_size[1]
+        box = (width - box[3], box[0], width - box[1], box[2])
+    return box
+
+
+def orient_box(box: Tuple[int, int, int, int],
+                orientation: Orientation,
+                source_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Maps a box on the image of source_size onto the image transformed into the orientation, the inverse of unorient_box
+    """
+    if orientation[0]:
+        box = (source_size[0] - box[2], box[1], source_size[0] - box[0], box[3])
+    for step in range((orientation[1] // 90) % 4):
+        # Width of the image before this rotation step
+        width: int = source_size[0] if step % 2 == 0 else source_size[1]
+        box = (box[1], width - box[2], box[3], width - box[0])
+    return box
+
+
+def unorient_box(box: Tuple[int, int, int, int],
+                 orientation: Orientation,
+                 source_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    Maps a box in the coordinates of the image in the orientation back onto the image of source_size
+    """
+    box = unrotate_box(box, orientation[1], source_size)
+    if orientation[0]:
+        box = (source_size[0] - box[2], box[1], source_size[0] - box[0], box[3])
+    return box
+
+
+def crop_image(image: Image.Image,
+               box: Tuple[int, int, int, int],
+               resize: Optional[Tuple[int, int]],
+               resample: int = Image.LANCZOS,
+               reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP) -> Image.Image:
+    """
+    Cuts the box (in original image coordinates) out of the image and optionally resizes it. The image itself
+    isn't copied, a resized crop is even read straight from it. Big downscales are first reduced by an integer
+    factor until they are reducing_gap times the requested size, and only then resampled with the filter
+    """
+    if not resize:
+        with profiler.span("crop"):
+            return image.crop(box)
+    if not is_box_inside_image(box, image.size):
+        # Resizing can't read outside of the image, cropping pads the box with black instead
+        with profiler.span("crop"):
+            image = image.crop(box)
+        box = (0, 0, image.width, image.height)
+    with profiler.span("resize"):
+        return image.resize((resize[0], resize[1]), resample, box=box, reducing_gap=reducing_gap)
+
+
+def is_box_inside_image(box: Tuple[float, float, float, float], image_size: Tuple[int, int]) -> bool:
+    return box[0] >= 0 and box[1] >= 0 and box[2] <= image_size[0] and box[3] <= image_size[1]
+
+
+def draft_for_resize(image: Image.Image,
+                     box: Tuple[int, int, int, int],
+                     resize: Optional[Tuple[int, int]],
+                     reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP) -> bool:
+    """
+    Configures a not yet loaded JPEG image to be decoded at 1/2, 1/4 or 1/8 scale (DCT scaling), as long as the box
+    stays at least reducing_gap times bigger than the size it's resized to. Returns False if the image is decoded
+    at full scale
+    """
+    if not resize or not reducing_gap:
+        return False
+    scale: float = min((box[2] - box[0]) / resize[0], (box[3] - box[1]) / resize[1]) / reducing_gap
+    if scale < 2:
+        return False
+    original_width: int = image.width
+    requested_size: Tuple[int, int] = (math.ceil(image.width / scale), math.ceil(image.height / scale))
+    return image.draft(None, requested_size) is not None and image.width < original_width
+
+
+def scale_box(box: Tuple[float, float, float, float],
+              original_size: Tuple[int, int],
+              scaled_size: Tuple[int, int]) -> Tuple[float, float, float, float]:
+    """
+    Maps the box from the original image onto the image decoded at reduced scale
+    """
+    scale_x: float = scaled_size[0] / original_size[0]
+    scale_y: float = scaled_size[1] / original_size[1]
+    return (box[0] * scale_x, box[1] * scale_y, box[2] * scale_x, box[3] * scale_y)
+
+
+class Rendition():
+    """
+    Additional output of every crop: resized to size (or kept at the size of the crop), encoded in image_format with
+    image_quality (or like the crop itself) and saved with the name of the crop into subfolder of the output directory
+    """
+
+    def __init__(self,
+                 size: Optional[Tuple[int, int]],
+                 image_format: Optional[str] = None,
+                 image_quality: Optional[int] = None,
+                 subfolder: str = ""):
+        self.size: Optional[Tuple[int, int]] = size
+        self.image_format: Optional[str] = image_format
+        self.image_quality: Optional[int] = image_quality
+        self.subfolder: str = subfolder
+
+
+def render_crop(image: Image.Image,
+                box: Tuple[int, int, int, int],
+                resize: Optional[Tuple[int, int]],
+                resample: int = Image.LANCZOS,
+                reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP,
+                orientation: Orientation = NO_ORIENTATION) -> Image.Image:
+    """
+    Crops the box (in coordinates of the image before it's oriented) out of the image and resizes it. Only the cropped
+    region is transformed into the orientation, after it was resized
+    """
+    if resize:
+        resize = get_oriented_size(resize, orientation)
+    cropped_image: Image = crop_image(image, box, resize, resample, reducing_gap)
+    with profiler.span("transpose"):
+        return orient_image(cropped_image, orientation)
+
+
+def render_renditions(image: Image.Image,
+                      box: Tuple[int, int, int, int],
+                      cropped_image: Image.Image,
+                      sizes: Sequence[Optional[Tuple[int, int]]],
+                      resample: int = Image.LANCZOS,
+                      reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP,
+                      orientation: Orientation = NO_ORIENTATION) -> List[Image.Image]:
+    """
+    Resizes the rendered crop to every size, as a cascade from the biggest to the smallest size: each rendition is
+    resized from the smallest image rendered so far which is still at least as big. Only sizes bigger than the crop
+    are rendered from the image again
+    """
+    renditions: Dict[int, Image.Image] = {}
+    sources: List[Image.Image] = [cropped_image]
+    by_area: List[int] = sorted(
+        range(len(sizes)), key=lambda index: sizes[index][0] * sizes[index][1] if sizes[index] else 0, reverse=True)
+    for index in by_area:
+        size: Optional[Tuple[int, int]] = sizes[index]
+        if not size:
+            renditions[index] = cropped_image
+            continue
+        source: Optional[Image.Image] = next(
+            (source for source in reversed(sources) if source.width >= size[0] and source.height >= size[1]), None)
+        if source is None:
+            renditions[index] = render_crop(image, box, size, resample, reducing_gap, orientation)
+        else:
+            with profiler.span("resize"):
+                renditions[index] = source.resize(size, resample, reducing_gap=reducing_gap)
+            sources.append(renditions[index])
+    return [renditions[index] for index in range(len(sizes))]
+
+
+def encode_image(image: Image.Image, output_path: str, image_format: Optional[str], image_quality: int):
+    if profiler.active_profiler is None:
+        image.save(output_path, image_format, quality=image_quality)
+        return
+    # Encoding into memory first is only worth it for telling encoding and writing apart
+    encoded_image: io.BytesIO = io.BytesIO()
+    with profiler.span("encode"):
+        image.save(encoded_image, image_format or get_format_from_path(output_path), quality=image_quality)
+    with profiler.span("write"):
+        with open(output_path, "wb") as output_file:
+            output_file.write(encoded_image.getbuffer())
+
+
+@profiler.profiled("save_crop")
+def save_cropped_image(image: Image.Image,
+                       box: Tuple[int, int, int, int],
+                       output_path: str,
+                       resize: Optional[Tuple[int, int]],
+                       image_format: Optional[str],
+                       image_quality: int,
+                       resample: int = Image.LANCZOS,
+                       reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP,
+                       orientation: Orientation = NO_ORIENTATION):
+    encode_image(render_crop(image, box, resize, resample, reducing_gap, orientation),
+                 output_path, image_format, image_quality)
@@ -0,0 +1,151 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from typing import Callable, Dict, Optional, Set
+
+from inbac.image_index import is_image_filename, scan_image_names
+
+# How often the directory is scanned for changes where inotify isn't available, in seconds
+POLL_INTERVAL: float = 1.0
+# Events arriving within this time after the first one are reported together, in seconds
+COALESCE_DELAY: float = 0.1
+# How often the inotify thread checks whether it was stopped, in seconds
+STOP_CHECK_INTERVAL: float = 0.5
+
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_DELETE: int = 0x00000200
+IN_DELETE_SELF: int = 0x00000400
+IN_MOVE_SELF: int = 0x00000800
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ISDIR: int = 0x40000000
+# Files are only reported once they are completely written (or moved into the directory)
+WATCH_MASK: int = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# struct inotify_event, followed by the name padded with null bytes
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Called with the added and the removed image names, or with None when the changes were lost and the directory
+# has to be scanned again
+ChangesCallback = Callable[[Optional[Set[str]], Optional[Set[str]]], None]
+
+
+def load_inotify():
+    """
+    Returns the C library if it provides inotify (Linux), None otherwise
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    library: Optional[str] = ctypes.util.find_library("c")
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        # Looking the functions up raises AttributeError where they don't exist
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher():
+    """
+    Reports image files added to and removed from a directory on a background thread, renames are reported as the
+    old name being removed and the new one added. Uses inotify where available and polls the directory otherwise
+    """
+
+    def __init__(self, directory: str, on_changes: ChangesCallback, use_inotify: bool = True):
+        self.directory: str = directory
+        self.on_changes: ChangesCallback = on_changes
+        self.stopped: threading.Event = threading.Event()
+        self.inotify_fd: Optional[int] = None
+        libc = load_inotify() if use_inotify else None
+        if libc is not None:
+            self.inotify_fd = self.add_inotify_watch(libc)
+        target = self.watch_inotify if self.inotify_fd is not None else self.poll
+        self.thread: threading.Thread = threading.Thread(target=target, name="inbac-watch", daemon=True)
+        # Names known to the polling fallback, scanned before the thread starts so no change is missed
+        self.names: Set[str] = set(scan_image_names(directory)) if self.inotify_fd is None else set()
+        self.thread.start()
+
+    def add_inotify_watch(self, libc) -> Optional[int]:
+        fd: int = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def stop(self):
+        self.stopped.set()
+
+    def watch_inotify(self):
+        try:
+            while not self.stopped.is_set():
+                readable, _, _ = select.select([self.inotify_fd], [], [], STOP_CHECK_INTERVAL)
+                if not readable:
+                    continue
+                # Wait for the events belonging together, e.g. both halves of a rename
+                self.stopped.wait(COALESCE_DELAY)
+                changes: Dict[str, bool] = {}
+                overflowed: bool = False
+                directory_gone: bool = False
+                while True:
+                    try:
+                        data: bytes = os.read(self.inotify_fd, 64 * 1024)
+                    except BlockingIOError:
+                        break
+                    for mask, name in self.parse_events(data):
+                        if mask & IN_Q_OVERFLOW:
+                            overflowed = True
+                        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                            directory_gone = True
+                        elif name and not mask & IN_ISDIR and is_image_filename(name):
+                            # The last event of a name decides whether it exists
+                            changes[name] = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+                if self.stopped.is_set():
+                    break
+                if overflowed:
+                    self.on_changes(None, None)
+                elif changes:
+                    self.on_changes({name for name, exists in changes.items() if exists},
+                                    {name for name, exists in changes.items() if not exists})
+                if directory_gone:
+                    break
+        finally:
+            os.close(self.inotify_fd)
+
+    @staticmethod
+    def parse_events(data: bytes):
+        offset: int = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name: str = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            yield mask, name
+
+    def poll(self):
+        mtime_ns: Optional[int] = None
+        while not self.stopped.wait(POLL_INTERVAL):
+            try:
+                # Adding, removing or renaming a file changes the modification time of the directory
+                current_mtime_ns: int = os.stat(self.directory).st_mtime_ns
+                if current_mtime_ns == mtime_ns:
+                    continue
+                names: Set[str] = set(scan_image_names(self.directory))
+            except OSError:
+                continue
+            mtime_ns = current_mtime_ns
+            added: Set[str] = names - self.names
+            removed: Set[str] = self.names - names
+            self.names = names
+            if added or removed:
+                self.on_changes(added, removed)
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from inbac.image_index import NAME_SEPARATOR
+
+# Side of the tiny downscale the difference hash is computed from, giving HASH_SIZE * HASH_SIZE bits
+HASH_SIZE: int = 8
+HASH_BITS: int = HASH_SIZE * HASH_SIZE
+HASH_CACHE_FORMAT_VERSION: int = 1
+# Images hashed before the duplicates found among them are reported
+SCAN_CHUNK_SIZE: int = 256
+
+# Size and modification time of an image file, the cached hash is valid as long as they don't change
+ImageStat = Tuple[int, int]
+
+
+def compute_hash(image_file: Union[str, BinaryIO]) -> int:
+    """
+    Difference hash (dHash) of the image: one bit per pair of horizontally neighbouring pixels of a tiny grayscale
+    downscale, set where the brightness increases. Similar images differ in few bits
+    """
+    with Image.open(image_file) as image:
+        # JPEG is decoded at up to 1/8 scale right away
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        pixels: bytes = image.convert("L").resize(
+            (HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, reducing_gap=2.0).tobytes()
+    image_hash: int = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset: int = row * (HASH_SIZE + 1) + column
+            image_hash = (image_hash << 1) | (pixels[offset] < pixels[offset + 1])
+    return image_hash
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
+
+
+class MultiIndexHash():
+    """
+    Finds the hashes within a Hamming distance of a hash without comparing it to all of them (multi-index hashing):
+    the hashes are split into max_distance + 1 blocks, hashes within max_distance of each other have at least one
+    of the blocks in common, so only the hashes sharing a block are compared
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance: int = max_distance
+        blocks: int = min(max_distance + 1, HASH_BITS)
+        # Bit offset and mask of every block
+        self.blocks: List[Tuple[int, int]] = []
+        for block in range(blocks):
+            start: int = block * HASH_BITS // blocks
+            end: int = (block + 1) * HASH_BITS // blocks
+            self.blocks.append((start, (1 << (end - start)) - 1))
+        self.tables: List[Dict[int, List[int]]] = [{} for _ in self.blocks]
+        self.keys: List[str] = []
+        self.hashes: List[int] = []
+
+    def add(self, key: str, image_hash: int):
+        position: int = len(self.keys)
+        self.keys.append(key)
+        self.hashes.append(image_hash)
+        for table, (start, mask) in zip(self.tables, self.blocks):
+            table.setdefault((image_hash >> start) & mask, []).append(position)
+
+    def find(self, image_hash: int) -> List[Tuple[int, str]]:
+        """
+        Returns the distances and keys of the hashes within max_distance, in the order they were added
+        """
+        candidates = set()
+        for table, (start, mask) in zip(self.tables, self.blocks):
+            candidates.update(table.get((image_hash >> start) & mask, ()))
+        matches: List[Tuple[int, str]] = []
+        for position in sorted(candidates):
+            distance: int = hamming_distance(image_hash, self.hashes[position])
+            if distance <= self.max_distance:
+                matches.append((distance, self.keys[position]))
+        return matches
+
+
+class DuplicateGroups():
+    """
+    Groups near-duplicate images, added in the order of the image list: an image within the distance of an image
+    added before joins the group of the closest one. Every group is represented by its first image
+    """
+
+    def __init__(self, max_distance: int):
+        self.index: MultiIndexHash = MultiIndexHash(max_distance)
+        # First image of the group of every image which isn't the first of its group itself
+        self.representatives: Dict[str, str] = {}
+
+    def add(self, name: str, image_hash: int) -> Optional[str]:
+        """
+        Returns the first image of the group the image joins, None if it doesn't duplicate an image added before
+        """
+        matches: List[Tuple[int, str]] = self.index.find(image_hash)
+        self.index.add(name, image_hash)
+        if not matches:
+            return None
+        _, closest = min(matches, key=lambda match: match[0])
+        representative: str = self.representatives.get(closest, closest)
+        self.representatives[name] = representative
+        return representative
+
+
+class HashCache():
+    """
+    Hashes of the images of a directory stored in the cache directory, keyed by the image path relative to the
+    directory together with its size and modification time
+    """
+
+    def __init__(self, cache_dir: Optional[str], directory: str):
+        self.path: Optional[str] = None
+        if cache_dir is not None:
+            key: str = hashlib.sha1(os.path.abspath(directory).encode("utf-8", "surrogateescape")).hexdigest()
+            self.path = os.path.join(cache_dir, key + ".dhash")
+        self.directory: str = os.path.abspath(directory)
+        self.entries: Dict[str, Tuple[int, int, int]] = {}
+        self.modified: bool = False
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8", errors="surrogateescape") as cache_file:
+                header = json.loads(cache_file.readline())
+                if header.get("version") != HASH_CACHE_FORMAT_VERSION or header.get("directory") != self.directory:
+                    return
+                records: str = cache_file.read()
+        except (OSError, ValueError):
+            return
+        for record in records.split(NAME_SEPARATOR) if records else []:
+            image_hash, size, mtime_ns, name = record.split(" ", 3)
+            self.entries[name] = (int(size), int(mtime_ns), int(image_hash, 16))
+
+    def get(self, name: str, stat: ImageStat) -> Optional[int]:
+        entry: Optional[Tuple[int, int, int]] = self.entries.get(name)
+        if entry is None or entry[:2] != stat:
+            return None
+        return entry[2]
+
+    def put(self, name: str, stat: ImageStat, image_hash: int):
+        self.entries[name] = stat + (image_hash,)
+        self.modified = True
+
+    def save(self):
+        if self.path is None or not self.modified:
+            return
+        header = {"version": HASH_CACHE_FORMAT_VERSION, "directory": self.directory}
+        tmp_path: str = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape") as cache_file:
+                cache_file.write(json.dumps(header) + "\n")
+                cache_file.write(NAME_SEPARATOR.join(
+                    f"{image_hash:016x} {size} {mtime_ns} {name}"
+                    for name, (size, mtime_ns, image_hash) in self.entries.items()))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # The cache is only an optimization
+            pass
+
+
+def scan_duplicates(names: Iterable[str],
+                    stat_image: Callable[[str], ImageStat],
+                    open_image: Callable[[str], Union[str, BinaryIO]],
+                    cache: HashCache,
+                    max_distance: int,
+                    on_duplicates: Callable[[Dict[str, str]], None],
+                    should_stop: Callable[[], bool],
+                    workers: Optional[int] = None):
+    """
+    Hashes the images (using the cache where possible) on a pool of threads and groups the near-duplicates, in the
+    order of the names. Every chunk of images, the duplicates found among them are reported as a mapping from the
+    duplicate to the first image of its group. Unreadable images are skipped
+    """
+    groups: DuplicateGroups = DuplicateGroups(max_distance)
+    cache.load()
+
+    def hash_image(name: str) -> Tuple[str, Optional[ImageStat], Optional[int], bool]:
+        try:
+            stat: ImageStat = stat_image(name)
+            cached_hash: Optional[int] = cache.get(name, stat)
+            if cached_hash is not None:
+                return name, stat, cached_hash, False
+            return name, stat, compute_hash(open_image(name)), True
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return name, None, None, False
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inbac-hash") as executor:
+        iterator = iter(names)
+        while not should_stop():
+            chunk = [name for _, name in zip(range(SCAN_CHUNK_SIZE), iterator)]
+            if not chunk:
+                break
+            duplicates: Dict[str, str] = {}
+            for name, stat, image_hash, computed in executor.map(hash_image, chunk):
+                if image_hash is None:
+                    continue
+                if computed:
+                    cache.put(name, stat, image_hash)
+                representative: Optional[str] = groups.add(name, image_hash)
+                if representative is not None:
+                    duplicates[name] = representative
+            if duplicates:
+                on_duplicates(duplicates)
+    cache.save()
@@ -0,0 +1,127 @@
+import tkinter as tk
+from tkinter import Canvas, Event
+from typing import Any, Callable, Dict, Tuple
+
+from PIL import Image
+from PIL.ImageTk import PhotoImage
+
+from inbac.thumbnail_cache import THUMBNAIL_SIZE
+
+CELL_PADDING: int = 4
+CELL_SIZE: int = THUMBNAIL_SIZE + 2 * CELL_PADDING
+
+
+def get_visible_range(offset: int, width: int, count: int, cell_size: int = CELL_SIZE) -> range:
+    """
+    Returns the positions of the cells which are at least partly visible when the strip is scrolled by offset pixels
+    """
+    first: int = max(offset // cell_size, 0)
+    last: int = min((offset + width + cell_size - 1) // cell_size, count)
+    return range(first, max(first, last))
+
+
+def clamp_offset(offset: int, width: int, count: int, cell_size: int = CELL_SIZE) -> int:
+    return max(0, min(offset, count * cell_size - width))
+
+
+class Filmstrip():
+    """
+    Horizontally scrolling strip with a thumbnail of every image. Only the cells which are visible exist on the canvas
+    and hold a thumbnail, so scrolling through any number of images creates a handful of canvas items at a time and
+    memory use doesn't grow with the number of images
+    """
+
+    def __init__(self,
+                 master: Any,
+                 on_select: Callable[[int], None],
+                 on_visible: Callable[[range], None],
+                 current_color: str = "gold"):
+        self.on_select: Callable[[int], None] = on_select
+        self.on_visible: Callable[[range], None] = on_visible
+        self.current_color: str = current_color
+        self.frame: tk.Frame = tk.Frame(master)
+        self.canvas: Canvas = Canvas(self.frame, height=CELL_SIZE, highlightthickness=0, background="gray20")
+        self.scrollbar: tk.Scrollbar = tk.Scrollbar(self.frame, orient=tk.HORIZONTAL, command=self.on_scrollbar)
+        self.canvas.pack(fill=tk.X)
+        self.scrollbar.pack(fill=tk.X)
+        self.count: int = 0
+        self.current: int = 0
+        # Scrolled distance from the first cell, in pixels
+        self.offset: int = 0
+        self.visible: range = range(0)
+        # Rectangle and image item of every visible cell
+        self.cells: Dict[int, Tuple[Any, Any]] = {}
+        # PhotoImages have to be referenced as long as they are displayed
+        self.thumbnails: Dict[int, PhotoImage] = {}
+        self.canvas.bind('<Configure>', lambda event: self.refresh())
+        self.canvas.bind('<ButtonPress-1>', self.on_click)
+        self.canvas.bind('<MouseWheel>', lambda event: self.scroll_by(-CELL_SIZE if event.delta > 0 else CELL_SIZE))
+        self.canvas.bind('<Button-4>', lambda event: self.scroll_by(-CELL_SIZE))
+        self.canvas.bind('<Button-5>', lambda event: self.scroll_by(CELL_SIZE))
+
+    def pack(self):
+        self.frame.pack(side=tk.BOTTOM, fill=tk.X)
+
+    def set_images(self, count: int, current: int, reset: bool):
+        """
+        Updates the number of images and the current one, which is scrolled into view. Reset drops the thumbnails,
+        when the images at the positions changed
+        """
+        if reset:
+            self.canvas.delete("cell")
+            self.cells = {}
+            self.thumbnails = {}
+            self.visible = range(0)
+        self.count = count
+        self.current = current
+        width: int = self.canvas.winfo_width()
+        if current not in get_visible_range(self.offset, width, count) or (current + 1) * CELL_SIZE > self.offset + width:
+            self.offset = current * CELL_SIZE - (width - CELL_SIZE) // 2
+        self.refresh()
+
+    def refresh(self):
+        width: int = self.canvas.winfo_width()
+        self.offset = clamp_offset(self.offset, width, self.count)
+        visible: range = get_visible_range(self.offset, width, self.count)
+        for position in [position for position in self.cells if position not in visible]:
+            self.canvas.delete(*self.cells.pop(position))
+            self.thumbnails.pop(position, None)
+        for position in visible:
+            left: int = position * CELL_SIZE - self.offset
+            if position not in self.cells:
+                self.cells[position] = (
+                    self.canvas.create_rectangle(0, 0, 0, 0, width=2, tags="cell"),
+                    self.canvas.create_image(0, 0, anchor=tk.CENTER, tags="cell"))
+            rectangle, image = self.cells[position]
+            self.canvas.coords(rectangle, left + 1, 1, left + CELL_SIZE - 1, CELL_SIZE - 1)
+            self.canvas.coords(image, left + CELL_SIZE // 2, CELL_SIZE // 2)
+            self.canvas.itemconfig(rectangle, outline=self.current_color if position == self.current else "")
+        total: int = max(self.count * CELL_SIZE, 1)
+        self.scrollbar.set(self.offset / total, min((self.offset + width) / total, 1.0))
+        if visible != self.visible:
+            self.visible = visible
+            self.on_visible(visible)
+
+    def show_thumbnail(self, position: int, thumbnail: Image.Image):
+        if position not in self.cells:
+            return
+        self.thumbnails[position] = PhotoImage(thumbnail)
+        self.canvas.itemconfig(self.cells[position][1], image=self.thumbnails[position])
+
+    def scroll_by(self, distance: int):
+        self.offset += distance
+        self.refresh()
+
+    def on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * self.count * CELL_SIZE)
+        elif args[2] == "pages":
+            self.offset += int(args[1]) * self.canvas.winfo_width()
+        else:
+            self.offset += int(args[1]) * CELL_SIZE
+        self.refresh()
+
+    def on_click(self, event: Event):
+        position: int = (self.offset + event.x) // CELL_SIZE
+        if position < self.count:
+            self.on_select(position)
@@ -0,0 +1,67 @@
+import os
+import sys
+from typing import Iterator, Optional
+
+import inbac.parse_arguments as parse_args
+from inbac import rename_planner
+from inbac.rename_planner import InterruptedRenameError, RenameConflictError, RenamePlan
+
+
+def walk_directories(directory: str, recursive: bool) -> Iterator[str]:
+    if not recursive:
+        yield directory
+        return
+    for path, _, _ in os.walk(directory):
+        yield path
+
+
+def process_directory(directory: str, args) -> bool:
+    """
+    Plans and executes the renames of one directory, returns False if they failed
+    """
+    try:
+        if args.resume or args.rollback:
+            plan: Optional[RenamePlan] = RenamePlan.load_interrupted(directory)
+            if plan is None:
+                return True
+            if args.rollback:
+                print(f"{directory}: rolling back {plan.completed} of {len(plan.steps)} renames")
+                if not args.dry_run:
+                    plan.rollback()
+            else:
+                print(f"{directory}: resuming after {plan.completed} of {len(plan.steps)} renames")
+                if not args.dry_run:
+                    plan.execute()
+            return True
+
+        if args.insert_after is not None:
+            plan = rename_planner.plan_insert_filename_gaps(
+                directory, args.insert_after, args.gap_size, process_all=not args.latest_only)
+        else:
+            plan = rename_planner.plan_remove_filename_gaps(directory, process_all=not args.latest_only)
+
+        if args.dry_run:
+            for old, new in plan.steps:
+                print(f"{os.path.join(directory, old)} -> {new}")
+        else:
+            plan.execute()
+    except (RenameConflictError, InterruptedRenameError, OSError, ValueError) as error:
+        print(f"{directory}: {error}", file=sys.stderr)
+        return False
+    if plan.steps:
+        print(f"{directory}: {len(plan.steps)} renames{' planned' if args.dry_run else ''}")
+    return True
+
+
+def main():
+    args = parse_args.parse_gaps_arguments()
+    failed: bool = False
+    for root in args.directories:
+        for directory in walk_directories(root, args.recursive):
+            if not process_directory(directory, args):
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from inbac.image_index import NameList, is_image_filename, sort_names
+
+# Number of images following the requested one which are read together with it
+READ_AHEAD_MEMBERS: int = 2
+# Bytes of images read ahead which are kept until they are requested, the oldest ones are dropped first
+READ_AHEAD_BYTES: int = 64 * 1024 * 1024
+# Reading at an offset without moving a shared file position isn't available on Windows
+HAS_PREAD: bool = hasattr(os, "pread")
+
+
+def is_archive(path: str) -> bool:
+    """
+    Checks whether the path is a zip or tar archive (tar archives may be compressed)
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+    except OSError:
+        return False
+
+
+class ImageArchive(ABC):
+    """
+    Images read directly from an archive without extracting it. The members are indexed once when the archive is
+    opened, images are then read by their name in any order. The images following the requested one in the list
+    are read along with it and buffered, so going through the images one by one reads the archive sequentially
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        # Image members sorted like the images of a directory, member names are relative paths inside of the archive
+        self.names: NameList = NameList([])
+        self.positions: Dict[str, int] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.buffer: "OrderedDict[str, bytes]" = OrderedDict()
+        self.buffered_bytes: int = 0
+
+    @staticmethod
+    def open(path: str) -> "ImageArchive":
+        archive: ImageArchive = ZipImageArchive(path) if zipfile.is_zipfile(path) else TarImageArchive(path)
+        archive.index_names(archive.list_members())
+        return archive
+
+    def index_names(self, member_names: List[str]):
+        self.names = sort_names(member_names)
+        self.positions = {name: position for position, name in enumerate(self.names)}
+
+    @abstractmethod
+    def list_members(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def read_members(self, names: List[str]) -> List[bytes]:
+        pass
+
+    def close(self):
+        with self.lock:
+            self.buffer.clear()
+            self.buffered_bytes = 0
+
+    def read(self, name: str) -> bytes:
+        with self.lock:
+            data = self.buffer.pop(name, None)
+            if data is not None:
+                self.buffered_bytes -= len(data)
+                return data
+            position: int = self.positions[name]
+            # Images already buffered are not read again
+            read_ahead: List[str] = [
+                following for following in self.names[position + 1:position + 1 + READ_AHEAD_MEMBERS]
+                if following not in self.buffer]
+        members: List[bytes] = self.read_members([name] + read_ahead)
+        with self.lock:
+            for following, following_data in zip(read_ahead, members[1:]):
+                if following in self.buffer:
+                    continue
+                self.buffer[following] = following_data
+                self.buffered_bytes += len(following_data)
+            while self.buffered_bytes > READ_AHEAD_BYTES:
+                _, dropped_data = self.buffer.popitem(last=False)
+                self.buffered_bytes -= len(dropped_data)
+        return members[0]
+
+    def open_member(self, name: str) -> io.BytesIO:
+        """
+        Returns the image as a file object, which can be opened by Image.open
+        """
+        return io.BytesIO(self.read(name))
+
+
+class ZipImageArchive(ImageArchive):
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # Reading from several threads is safe, the shared file position is guarded by the zip file itself
+        self.zip_file: zipfile.ZipFile = zipfile.ZipFile(path)
+
+    def list_members(self) -> List[str]:
+        # A name stored several times refers to its last member, like when the archive is extracted
+        return list(dict.fromkeys(info.filename for info in self.zip_file.infolist()
+                                  if not info.is_dir() and is_image_filename(info.filename)))
+
+    def read_members(self, names: List[str]) -> List[bytes]:
+        return [self.zip_file.read(name) for name in names]
+
+    def close(self):
+        super().close()
+        self.zip_file.close()
+
+
+class TarImageArchive(ImageArchive):
+    """
+    Members of uncompressed tar archives are read at their offsets, several at once where they are stored one after
+    another. Compressed tar archives can't be read at random positions, their members are extracted one at a time
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.tar_file: tarfile.TarFile = tarfile.open(path, "r:*")
+        self.compressed: bool = not isinstance(self.tar_file.fileobj, io.BufferedReader)
+        self.fd: int = os.open(path, os.O_RDONLY) if HAS_PREAD and not self.compressed else -1
+        # Offset and size of the data of every image member
+        self.extents: Dict[str, Tuple[int, int]] = {}
+        self.members: Dict[str, tarfile.TarInfo] = {}
+        self.extract_lock: threading.Lock = threading.Lock()
+
+    def list_members(self) -> List[str]:
+        for member in self.tar_file:
+            if member.isfile() and is_image_filename(member.name):
+                self.extents[member.name] = (member.offset_data, member.size)
+                self.members[member.name] = member
+        if not self.compressed:
+            # Only the offsets are needed, the headers aren't kept for the lifetime of the archive
+            self.members = {}
+        return list(self.extents)
+
+    def read_members(self, names: List[str]) -> List[bytes]:
+        if self.compressed:
+            with self.extract_lock:
+                return [self.tar_file.extractfile(self.members[name]).read() for name in names]
+        extents: List[Tuple[int, int]] = [self.extents[name] for name in names]
+        start: int = extents[0][0]
+        end: int = max(offset + size for offset, size in extents)
+        contiguous: bool = all(previous[0] < following[0] for previous, following in zip(extents, extents[1:]))
+        if not contiguous or end - start > READ_AHEAD_BYTES:
+            return [self.read_at(offset, size) for offset, size in extents]
+        # Members stored one after another are read with a single call
+        data: bytes = self.read_at(start, end - start)
+        return [data[offset - start:offset - start + size] for offset, size in extents]
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        if self.fd >= 0:
+            return os.pread(self.fd, size, offset)
+        # Without pread the position of the tar file is shared, so seeking and reading have to happen together
+        with self.extract_lock:
+            self.tar_file.fileobj.seek(offset)
+            return self.tar_file.fileobj.read(size)
+
+    def close(self):
+        super().close()
+        self.tar_file.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,275 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from inbac.cropping import NO_ORIENTATION, Orientation
+from inbac.large_image import LargeImage
+
+
+def image_size_in_bytes(image: Image) -> int:
+    """
+    Approximates the memory used by the pixel data of a decoded image
+    """
+    if isinstance(image, LargeImage):
+        # Only holds its preview, which is accounted as the base of the pyramid
+        return 0
+    return image.width * image.height * len(image.getbands())
+
+
+class ImagePyramid():
+    """
+    Successively halved versions of an image, created on demand. Rescaling starts from the smallest level
+    which is still at least as big as the requested size, instead of from the full-resolution original
+    """
+
+    def __init__(self, image: Image, source=None):
+        self.image: Image = image
+        # Image the levels represent, differs from the first level for large images which are never fully decoded
+        self.source = source if source is not None else image
+        self.levels: List[Image] = [image]
+
+    @staticmethod
+    def for_image(image) -> "ImagePyramid":
+        if isinstance(image, LargeImage):
+            return ImagePyramid(image.preview, image)
+        return ImagePyramid(image)
+
+    def nearest_level(self, size: Tuple[int, int]) -> Image:
+        # Add levels while the smallest one is still at least twice as big as requested
+        while self.levels[-1].width >= size[0] * 2 and self.levels[-1].height >= size[1] * 2:
+            try:
+                self.levels.append(self.levels[-1].reduce(2))
+            except ValueError:
+                # Some modes (e.g. palette images) can't be reduced, they are scaled from the original
+                break
+        for level in reversed(self.levels):
+            if level.width >= size[0] and level.height >= size[1]:
+                return level
+        return self.image
+
+    def scale(self, size: Tuple[int, int], resample: int = Image.LANCZOS) -> Image:
+        level: Image = self.nearest_level(size)
+        if level.size == size:
+            return level.copy()
+        return level.resize(size, resample)
+
+    @property
+    def size_in_bytes(self) -> int:
+        # The original is accounted by the cache entry holding it
+        return sum(image_size_in_bytes(level) for level in self.levels if level is not self.source)
+
+
+class CachedImage():
+    def __init__(self,
+                 image: Image,
+                 display_image: Image,
+                 canvas_size: Tuple[int, int],
+                 pyramid: Optional[ImagePyramid] = None,
+                 orientation: Orientation = NO_ORIENTATION,
+                 scores: Optional[Any] = None):
+        # Fully decoded original image (used for saving crops)
+        self.image: Image = image
+        # Downscaled version of the original, fitted to the canvas it was prepared for in the EXIF orientation.
+        # It isn't transformed into the orientation yet, like the original
+        self.display_image: Image = display_image
+        self.canvas_size: Tuple[int, int] = canvas_size
+        # Orientation from the EXIF data of the image
+        self.orientation: Orientation = orientation
+        # Lower resolution levels of the original, used when the image has to be rescaled for another canvas size
+        self.pyramid: ImagePyramid = pyramid if pyramid is not None else ImagePyramid.for_image(image)
+        # Content scores of the display image the initial selection box is placed with, if it's content-aware
+        self.scores: Optional[Any] = scores
+
+    @property
+    def size_in_bytes(self) -> int:
+        return (image_size_in_bytes(self.image) + image_size_in_bytes(self.display_image) +
+                self.pyramid.size_in_bytes + (self.scores.nbytes if self.scores is not None else 0))
+
+
+class ImageCache():
+    """
+    Least recently used cache of decoded images, bounded by the memory used by their pixel data.
+    Can be safely accessed from the UI thread and the prefetching worker threads.
+    Entries are accounted with their size at insertion, pyramid levels added later aren't counted
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.used_bytes: int = 0
+        self.entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self.entry_sizes: Dict[str, int] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key: str) -> Optional[CachedImage]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CachedImage):
+        entry_size: int = entry.size_in_bytes
+        with self.lock:
+            self._remove(key)
+            # Entries which don't fit into the whole budget are never cached
+            if entry_size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.entry_sizes[key] = entry_size
+            self.used_bytes += entry_size
+            while self.used_bytes > self.max_bytes:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+
+    def discard(self, key: str):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.entry_sizes.clear()
+            self.used_bytes = 0
+
+    def _remove(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.used_bytes -= self.entry_sizes.pop(key)
+
+
+class Prefetcher():
+    """
+    Decodes the images surrounding the currently displayed one on worker threads and keeps them in the image cache,
+    so that switching to the next or previous image doesn't have to wait for decoding and scaling
+    """
+
+    def __init__(self,
+                 cache: ImageCache,
+                 loader: Callable[[str, Tuple[int, int]], CachedImage],
+                 distance: int,
+                 workers: int = 2):
+        self.cache: ImageCache = cache
+        self.loader: Callable[[str, Tuple[int, int]], CachedImage] = loader
+        self.distance: int = distance
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inbac-prefetch")
+        # Futures of scheduled and finished decodes of the images around the current one, only accessed from the UI thread
+        self.pending: Dict[str, Future] = {}
+        # Images served from the cache or a running prefetch vs. images decoded on demand
+        self.hits: int = 0
+        self.misses: int = 0
+        # Bumped on invalidation, so decodes finishing afterwards don't populate the cache with stale images
+        self.generation: int = 0
+
+    def get(self, name: str, canvas_size: Tuple[int, int]) -> CachedImage:
+        """
+        Returns the decoded image. Served from the cache or an already running prefetch if possible,
+        otherwise the image is decoded on the calling thread
+        """
+        entry: Optional[CachedImage] = self.cache.get(name)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        # The future is kept while the image is wanted, images too big for the cache aren't decoded again
+        future: Optional[Future] = self.pending.get(name)
+        if future is not None and not future.cancelled():
+            try:
+                entry = future.result()
+            except Exception:
+                # Decoding is retried below so that the error is raised for the caller
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        entry = self.loader(name, canvas_size)
+        self.cache.put(name, entry)
+        if name not in self.cache:
+            # Too big for the cache, kept like a finished prefetch so it isn't decoded again while it's wanted
+            future = Future()
+            future.set_result(entry)
+            self.pending[name] = future
+        return entry
+
+    def is_ready(self, name: str) -> bool:
+        """
+        Checks whether the image can be returned by get without waiting for decoding
+        """
+        if name in self.cache:
+            return True
+        future: Optional[Future] = self.pending.get(name)
+        return future is not None and future.done() and not future.cancelled() and future.exception() is None
+
+    def request(self, name: str, canvas_size: Tuple[int, int]) -> Future:
+        """
+        Returns a future of the decoded image, decoding it on a worker thread unless it's already cached or scheduled
+        """
+        entry: Optional[CachedImage] = self.cache.get(name)
+        if entry is not None:
+            self.hits += 1
+            future: Future = Future()
+            future.set_result(entry)
+            return future
+
+        future = self.pending.get(name)
+        if future is not None and not future.cancelled():
+            self.hits += 1
+            return future
+
+        self.misses += 1
+        future = self.executor.submit(self._load, name, canvas_size, self.generation)
+        self.pending[name] = future
+        return future
+
+    def prefetch(self, images: Sequence[str], current_index: int, canvas_size: Tuple[int, int]):
+        """
+        Schedules decoding of the images within prefetching distance of the current one, nearest first
+        """
+        # The current image is kept, it may still be decoded for progressive display
+        wanted: Dict[str, None] = {}
+        if 0 <= current_index < len(images):
+            wanted[images[current_index]] = None
+        for offset in range(1, self.distance + 1):
+            for index in (current_index + offset, current_index - offset):
+                if 0 <= index < len(images):
+                    wanted[images[index]] = None
+
+        # Images the user moved away from are no longer worth decoding. Finished decodes of images still wanted are
+        # kept, images the cache refused (bigger than its budget) are served from them instead of being decoded again
+        for name, future in list(self.pending.items()):
+            if name not in wanted or future.cancelled():
+                future.cancel()
+                del self.pending[name]
+
+        for name in wanted:
+            if name in self.pending or name in self.cache:
+                continue
+            self.pending[name] = self.executor.submit(self._load, name, canvas_size, self.generation)
+
+    def invalidate(self):
+        self.generation += 1
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.cache.clear()
+
+    def shutdown(self):
+        self.invalidate()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self, name: str, canvas_size: Tuple[int, int], generation: int) -> CachedImage:
+        entry: CachedImage = self.loader(name, canvas_size)
+        if generation == self.generation:
+            self.cache.put(name, entry)
+        return entry
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import mimetypes
+import os
+from array import array
+from bisect import bisect_right
+from typing import AbstractSet, Iterable, Iterator, List, Optional, Sequence, Union
+
+from natsort import os_sort_keygen, os_sorted
+
+mimetypes.init()
+# Extensions (lower case) of all file types which mimetypes considers images, looked up once instead of per file
+IMAGE_EXTENSIONS = frozenset(
+    extension for extension, filetype in {**mimetypes.types_map, **mimetypes.common_types}.items()
+    if filetype.split("/")[0] == "image")
+# Separates the names in the compact name store and in the index files, can't be part of a filename
+NAME_SEPARATOR: str = "\0"
+INDEX_FORMAT_VERSION: int = 1
+
+
+def is_image_filename(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+class NameList(Sequence[str]):
+    """
+    Immutable list of filenames stored in a single string with an array of offsets, which needs a fraction
+    of the memory of a list of separate strings for hundreds of thousands of names
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        names = list(names)
+        self.blob: str = NAME_SEPARATOR + NAME_SEPARATOR.join(names) + NAME_SEPARATOR if names else NAME_SEPARATOR
+        # Start of every name in the blob, followed by the position past the end of the last name
+        self.offsets: array = array("Q")
+        position: int = 1
+        for name in names:
+            self.offsets.append(position)
+            position += len(name) + 1
+        self.offsets.append(position)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("NameList index out of range")
+        return self.blob[self.offsets[index]:self.offsets[index + 1] - 1]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.blob[1:-1].split(NAME_SEPARATOR)) if len(self) else iter(())
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and (NAME_SEPARATOR + name + NAME_SEPARATOR) in self.blob
+
+    def index(self, name: str, start: int = 0, stop: Optional[int] = None) -> int:
+        position: int = self.blob.find(NAME_SEPARATOR + name + NAME_SEPARATOR)
+        if position < 0:
+            raise ValueError(f"{name!r} is not in list")
+        return bisect_right(self.offsets, position + 1) - 1
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, NameList):
+            return self.blob == other.blob
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"NameList({list(self)!r})"
+
+
+def scan_image_names(directory: str) -> List[str]:
+    """
+    Lists the image files of the directory (unsorted) with a single scandir pass
+    """
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if is_image_filename(entry.name) and entry.is_file()]
+
+
+def sort_names(names: Iterable[str]) -> NameList:
+    # Sorted like in the file manager of the operating system
+    return NameList(os_sorted(names))
+
+
+def first_name(names: Iterable[str]) -> str:
+    """
+    Returns the name which comes first in sorted order, in linear time
+    """
+    return min(names, key=os_sort_keygen())
+
+
+def merge_names(names: Sequence[str], added: Iterable[str], removed: AbstractSet[str]) -> NameList:
+    """
+    Returns the sorted names with the added names inserted at their sorted positions and the removed ones left out.
+    Only the sort keys needed by the binary searches are computed, the names aren't sorted again
+    """
+    sort_key = os_sort_keygen()
+    merged_names: List[str] = [name for name in names if name not in removed] if removed else list(names)
+    for name in added:
+        key = sort_key(name)
+        low: int = find_sorted_position(merged_names, name, sort_key)
+        # Names differing only in case may have the same key
+        position: int = low
+        while position < len(merged_names) and merged_names[position] != name and sort_key(merged_names[position]) == key:
+            position += 1
+        if position < len(merged_names) and merged_names[position] == name:
+            continue
+        merged_names.insert(low, name)
+    return NameList(merged_names)
+
+
+def find_sorted_position(names: Sequence[str], name: str, sort_key=None) -> int:
+    """
+    Returns the position of the first of the sorted names which doesn't come before name, with a binary search
+    """
+    if sort_key is None:
+        sort_key = os_sort_keygen()
+    key = sort_key(name)
+    low: int = 0
+    high: int = len(names)
+    while low < high:
+        middle: int = (low + high) // 2
+        if sort_key(names[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def get_default_cache_dir() -> str:
+    cache_home: str = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "inbac", "index")
+
+
+def get_index_path(cache_dir: str, directory: str) -> str:
+    key: str = hashlib.sha1(os.path.abspath(directory).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(cache_dir, key + ".idx")
+
+
+def load_index(cache_dir: str, directory: str) -> Optional[NameList]:
+    """
+    Returns the sorted image names stored for the directory, if the directory wasn't modified since
+    """
+    try:
+        mtime_ns: int = os.stat(directory).st_mtime_ns
+        with open(get_index_path(cache_dir, directory), "r", encoding="utf-8", errors="surrogateescape") as index_file:
+            header = json.loads(index_file.readline())
+            if (header.get("version") != INDEX_FORMAT_VERSION or header.get("mtime_ns") != mtime_ns or
+                    header.get("directory") != os.path.abspath(directory)):
+                return None
+            names: str = index_file.read()
+    except (OSError, ValueError):
+        return None
+    return NameList(names.split(NAME_SEPARATOR) if names else [])
+
+
+def save_index(cache_dir: str, directory: str, names: Iterable[str], mtime_ns: int):
+    """
+    Stores the sorted image names for the directory. The modification time must be taken before scanning the directory,
+    so changes made during the scan invalidate the index
+    """
+    header = {"version": INDEX_FORMAT_VERSION, "directory": os.path.abspath(directory), "mtime_ns": mtime_ns}
+    index_path: str = get_index_path(cache_dir, directory)
+    tmp_path: str = index_path + ".tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape") as index_file:
+            index_file.write(json.dumps(header) + "\n")
+            index_file.write(NAME_SEPARATOR.join(names))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # The index is only an optimization
+        pass
+
+
+def list_images(directory: str, cache_dir: Optional[str] = None) -> NameList:
+    """
+    Returns the sorted image names of the directory, from the persistent index if it's still valid
+    """
+    if cache_dir is not None:
+        cached_names: Optional[NameList] = load_index(cache_dir, directory)
+        if cached_names is not None:
+            return cached_names
+    mtime_ns: int = os.stat(directory).st_mtime_ns
+    names: NameList = sort_names(scan_image_names(directory))
+    if cache_dir is not None:
+        save_index(cache_dir, directory, names, mtime_ns)
+    return names
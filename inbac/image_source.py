@@ -0,0 +1,204 @@
+import fnmatch
+import os
+import sys
+import threading
+from typing import AbstractSet, Callable, Iterable, Iterator, List, Optional, Sequence, Union
+
+from natsort import os_sorted
+
+from inbac.image_index import NameList, is_image_filename
+
+# Number of names stored together in one NameList of a LazyNameList
+LAZY_CHUNK_SIZE: int = 4096
+# File list name standing for the standard input
+STDIN_FILE_LIST: str = "-"
+
+
+def matches_any(relative_path: str, patterns: Sequence[str]) -> bool:
+    """
+    Checks whether one of the glob patterns matches the path (relative to the input directory) or its last component
+    """
+    name: str = os.path.basename(relative_path)
+    return any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def is_included(relative_path: str, include: Sequence[str], exclude: Sequence[str]) -> bool:
+    return (not include or matches_any(relative_path, include)) and not matches_any(relative_path, exclude)
+
+
+def walk_image_tree(root: str,
+                    include: Sequence[str] = (),
+                    exclude: Sequence[str] = (),
+                    skipped_directories: AbstractSet[str] = frozenset()) -> Iterator[str]:
+    """
+    Yields the paths (relative to root) of the images in the directory tree, while walking it: the images of every
+    directory sorted like in the file manager, followed by its subdirectories in the same order. Only one directory
+    is scanned at a time. Excluded directories and the absolute paths in skipped_directories aren't entered
+    """
+    pending_directories: List[str] = [""]
+    while pending_directories:
+        relative_directory: str = pending_directories.pop()
+        try:
+            with os.scandir(os.path.join(root, relative_directory)) as entries:
+                files: List[str] = []
+                directories: List[str] = []
+                for entry in entries:
+                    relative_path: str = os.path.join(relative_directory, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if (not matches_any(relative_path, exclude) and
+                                os.path.abspath(entry.path) not in skipped_directories):
+                            directories.append(relative_path)
+                    elif is_image_filename(entry.name) and entry.is_file() and is_included(relative_path, include, exclude):
+                        files.append(relative_path)
+        except OSError:
+            # Unreadable directories are skipped like in a file manager
+            continue
+        yield from os_sorted(files)
+        pending_directories.extend(reversed(os_sorted(directories)))
+
+
+def read_file_list(file_list: str,
+                   root: str,
+                   include: Sequence[str] = (),
+                   exclude: Sequence[str] = ()) -> Iterator[str]:
+    """
+    Yields the images listed one per line in the file (or the standard input for "-"), in the listed order. Relative
+    paths are relative to root, absolute paths inside of root are made relative to it
+    """
+    absolute_root: str = os.path.abspath(root)
+    list_file = sys.stdin if file_list == STDIN_FILE_LIST else open(file_list, "r", encoding="utf-8")
+    try:
+        for line in list_file:
+            path: str = line.rstrip("\r\n")
+            if not path or not is_image_filename(path):
+                continue
+            if os.path.isabs(path):
+                absolute_path: str = os.path.abspath(path)
+                if os.path.commonpath([absolute_root, absolute_path]) == absolute_root:
+                    path = os.path.relpath(absolute_path, absolute_root)
+            if is_included(path, include, exclude):
+                yield path
+    finally:
+        if list_file is not sys.stdin:
+            list_file.close()
+
+
+def get_output_subdirectory(source: str) -> str:
+    """
+    Returns the subdirectory of the output directory the crops of the source image are saved into, mirroring the
+    input tree. Images listed from outside of the input directory are saved into the output directory itself
+    """
+    subdirectory: str = os.path.dirname(source)
+    if os.path.isabs(subdirectory) or subdirectory.split(os.sep)[0] == os.pardir:
+        return ""
+    return subdirectory
+
+
+class LazyNameList(Sequence[str]):
+    """
+    Names produced by a generator on a background thread, which can already be used while the rest is still produced.
+    Stored in chunks of NameList, so a tree of a million images needs little memory
+    """
+
+    def __init__(self, names: Iterable[str], on_complete: Optional[Callable[[], None]] = None):
+        self.chunks: List[NameList] = []
+        self.tail: List[str] = []
+        self.length: int = 0
+        self.complete: bool = False
+        self.stopped: bool = False
+        self.condition: threading.Condition = threading.Condition()
+        # Called on the producing thread, once all names are produced
+        self.on_complete: Optional[Callable[[], None]] = on_complete
+        self.thread: threading.Thread = threading.Thread(
+            target=self.produce, args=(iter(names),), name="inbac-source", daemon=True)
+        self.thread.start()
+
+    def produce(self, names: Iterator[str]):
+        try:
+            for name in names:
+                with self.condition:
+                    if self.stopped:
+                        return
+                    self.tail.append(name)
+                    if len(self.tail) == LAZY_CHUNK_SIZE:
+                        self.chunks.append(NameList(self.tail))
+                        self.tail = []
+                    self.length += 1
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.complete = True
+                self.condition.notify_all()
+            if self.on_complete is not None and not self.stopped:
+                self.on_complete()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+
+    def wait_for(self, count: int, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until at least count names are produced or there are no more names, returns whether there are enough
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.length >= count or self.complete, timeout)
+            return self.length >= count
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        with self.condition:
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(self.length))]
+            if index < 0:
+                index += self.length
+            if not 0 <= index < self.length:
+                raise IndexError("LazyNameList index out of range")
+            chunk: int = index // LAZY_CHUNK_SIZE
+            if chunk < len(self.chunks):
+                return self.chunks[chunk][index % LAZY_CHUNK_SIZE]
+            return self.tail[index % LAZY_CHUNK_SIZE]
+
+    def __iter__(self) -> Iterator[str]:
+        # Names produced while iterating are included
+        index: int = 0
+        while index < self.length:
+            yield self[index]
+            index += 1
+
+    def follow(self) -> Iterator[str]:
+        """
+        Iterates over all names, waiting for the names which aren't produced yet
+        """
+        index: int = 0
+        while self.wait_for(index + 1):
+            yield self[index]
+            index += 1
+
+    def __contains__(self, name: object) -> bool:
+        with self.condition:
+            return any(name in chunk for chunk in self.chunks) or name in self.tail
+
+    def index(self, name: str, start: int = 0, stop: Optional[int] = None) -> int:
+        with self.condition:
+            for chunk_index, chunk in enumerate(self.chunks):
+                if name in chunk:
+                    return chunk_index * LAZY_CHUNK_SIZE + chunk.index(name)
+            return len(self.chunks) * LAZY_CHUNK_SIZE + self.tail.index(name)
+
+
+def create_image_source(input_dir: str,
+                        recursive: bool,
+                        file_list: Optional[str],
+                        include: Sequence[str],
+                        exclude: Sequence[str],
+                        skipped_directories: AbstractSet[str] = frozenset()) -> Iterator[str]:
+    if file_list is not None:
+        return read_file_list(file_list, input_dir, include, exclude)
+    if recursive:
+        return walk_image_tree(input_dir, include, exclude, skipped_directories)
+    # A flat directory is scanned at once, only the filters are applied lazily
+    with os.scandir(input_dir) as entries:
+        names: List[str] = [entry.name for entry in entries if is_image_filename(entry.name) and entry.is_file()]
+    return (name for name in os_sorted(names) if is_included(name, include, exclude))
@@ -15,7 +15,7 @@ class Application():
         self.model: Model = Model(args)
 
         self.controller: Controller = Controller(self.model)
-        self.view: View = View(master, self.controller, args.window_size, args.no_fullscreen)
+        self.view: View = View(master, self.controller, args.window_size, args.no_fullscreen, args.filmstrip)
 
         self.controller.view = self.view
 
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from typing import Any, Dict, IO, List, Optional, Tuple
+
+# Stored in the output directory, every saved crop is appended as one JSON line
+JOURNAL_FILENAME: str = ".inbac_journal.jsonl"
+# Size of the blocks read backwards from the end of the journal while looking for the last entry
+TAIL_BLOCK_SIZE: int = 4096
+
+
+class CropJournal():
+    """
+    Append-only journal of the saved crops. Entries use the keys of the inbac-batch JSON lines manifest
+    (source, box, rotation, resize, format, quality) plus the output filename, so a journal can be replayed
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir: str = output_dir
+        self.path: str = os.path.join(output_dir, JOURNAL_FILENAME)
+        self.file: Optional[IO[str]] = None
+        self.lock: threading.Lock = threading.Lock()
+
+    def append(self,
+               source: str,
+               box: Tuple[int, int, int, int],
+               rotation: int,
+               resize: Optional[Tuple[int, int]],
+               image_format: Optional[str],
+               image_quality: int,
+               output: str):
+        entry: Dict[str, Any] = {
+            "source": source,
+            "box": list(box),
+            "rotation": rotation,
+            "resize": list(resize) if resize else None,
+            "format": image_format,
+            "quality": image_quality,
+            "output": output,
+        }
+        line: str = json.dumps(entry) + "\n"
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+                # Don't continue a line left incomplete by a crash
+                if self.file.tell() > 0 and not self.ends_with_newline():
+                    line = "\n" + line
+            self.file.write(line)
+            self.file.flush()
+
+    def ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as journal:
+            journal.seek(-1, os.SEEK_END)
+            return journal.read(1) == b"\n"
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @staticmethod
+    def read_last_entry(output_dir: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the most recent entry of the journal in the output directory. Only the end of the file is read,
+        so this is cheap regardless of the number of entries
+        """
+        entries: List[Dict[str, Any]] = CropJournal.read_last_entries(output_dir, 1)
+        return entries[0] if entries else None
+
+    @staticmethod
+    def read_last_entries(output_dir: str, count: int) -> List[Dict[str, Any]]:
+        """
+        Returns up to count of the most recent entries of the journal in the output directory, the most recent first
+        """
+        path: str = os.path.join(output_dir, JOURNAL_FILENAME)
+        entries: List[Dict[str, Any]] = []
+        try:
+            with open(path, "rb") as journal:
+                journal.seek(0, os.SEEK_END)
+                position: int = journal.tell()
+                tail: bytes = b""
+                while position > 0 and len(entries) < count:
+                    block_size: int = min(TAIL_BLOCK_SIZE, position)
+                    position -= block_size
+                    journal.seek(position)
+                    tail = journal.read(block_size) + tail
+                    lines = tail.splitlines()
+                    # The first line may be cut off, unless the beginning of the file was reached
+                    complete_lines = lines if position == 0 else lines[1:]
+                    # Lines parsed from earlier blocks are kept out of the next round
+                    tail = b"" if position == 0 else lines[0] if lines else b""
+                    for line in reversed(complete_lines):
+                        entry = CropJournal.parse_entry(line)
+                        if entry is not None:
+                            entries.append(entry)
+                            if len(entries) == count:
+                                break
+        except OSError:
+            pass
+        return entries
+
+    @staticmethod
+    def parse_entry(line: bytes) -> Optional[Dict[str, Any]]:
+        # A line may be incomplete if the application was killed while writing it
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(entry, dict) or "source" not in entry:
+            return None
+        return entry
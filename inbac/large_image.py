@@ -0,0 +1,237 @@
+import contextlib
+import math
+import mmap
+import os
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+from PIL import Image
+
+# Height of the bands large images are decoded in when their preview is created, in bytes of decoded pixels
+PREVIEW_BAND_BYTES: int = 64 * 1024 * 1024
+# Bytes per pixel of the raw modes uncompressed images are stored in, where the stride isn't given explicitly
+RAW_MODE_PIXEL_SIZES: Dict[str, int] = {
+    "L": 1, "P": 1, "RGB": 3, "BGR": 3, "RGBA": 4, "RGBX": 4, "BGRX": 4, "BGRA": 4, "CMYK": 4,
+    "I;16": 2, "I;16B": 2, "I;16L": 2,
+}
+
+
+class MemoryBudget():
+    """
+    Bounds the memory used at the same time by decodes which can't be avoided, like full decodes of compressed
+    images. Reservations wait until enough of the budget is free, one exceeding the whole budget only runs alone
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.used_bytes: int = 0
+        self.condition: threading.Condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, size: int) -> Iterator[None]:
+        with self.condition:
+            self.condition.wait_for(lambda: self.used_bytes == 0 or self.used_bytes + size <= self.max_bytes)
+            self.used_bytes += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used_bytes -= size
+                self.condition.notify_all()
+
+
+def get_resident_memory() -> Optional[int]:
+    """
+    Returns the resident memory of the process in bytes, if it can be determined (Linux only)
+    """
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_decoded_size(size: Tuple[int, int], mode: str) -> int:
+    return size[0] * size[1] * Image.getmodebands(mode)
+
+
+def get_raw_tile_layout(image: Image.Image, tile) -> Optional[Tuple[str, int, int]]:
+    """
+    Returns the raw mode, stride and orientation of an uncompressed tile (BMP, PPM, uncompressed TIFF), whose rows
+    can be read directly from the file. Returns None for compressed tiles
+    """
+    decoder_name, extents, _, args = tile
+    if isinstance(args, str):
+        args = (args, 0, 1)
+    if decoder_name != "raw" or len(args) < 3 or args[2] not in (1, -1):
+        return None
+    raw_mode, stride, orientation = args[:3]
+    if not stride:
+        if raw_mode not in RAW_MODE_PIXEL_SIZES:
+            return None
+        stride = (extents[2] - extents[0]) * RAW_MODE_PIXEL_SIZES[raw_mode]
+    return raw_mode, stride, orientation
+
+
+def is_raw_image(image: Image.Image) -> bool:
+    return all(get_raw_tile_layout(image, tile) is not None for tile in image.tile)
+
+
+def get_raw_row_tile(image: Image.Image, top: int, bottom: int):
+    """
+    Returns a tile covering only the rows from top to bottom of an uncompressed image stored as a single raw tile,
+    so only the bytes of these rows are read. Returns None for other images
+    """
+    if len(image.tile) != 1 or tuple(image.tile[0][1]) != (0, 0) + image.size:
+        return None
+    layout = get_raw_tile_layout(image, image.tile[0])
+    if layout is None:
+        return None
+    raw_mode, stride, orientation = layout
+    # Bottom-up images (most BMPs) store the last row first
+    first_row: int = top if orientation == 1 else image.height - bottom
+    return ("raw", (0, 0, image.width, bottom - top), image.tile[0][2] + first_row * stride, layout)
+
+
+def boxes_intersect(first: Tuple[int, int, int, int], second: Tuple[int, int, int, int]) -> bool:
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+
+def read_raw_tile(image: Image.Image, tile) -> Image.Image:
+    """
+    Reads an uncompressed tile (or rows of one) through a memory map of the file into an image of its own size,
+    only the bytes of the tile are read
+    """
+    _, extents, offset, _ = tile
+    raw_mode, stride, orientation = get_raw_tile_layout(image, tile)
+    size: Tuple[int, int] = (extents[2] - extents[0], extents[3] - extents[1])
+    length: int = stride * size[1]
+    with open(image.filename, "rb") as image_file:
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            data: bytes = mapped_file[offset:offset + length]
+    if len(data) < length:
+        raise OSError("image file is truncated")
+    return Image.frombuffer(image.mode, size, data, "raw", raw_mode, stride, orientation)
+
+
+def decode_region(path: str, box: Tuple[int, int, int, int], budget: MemoryBudget) -> Image.Image:
+    """
+    Decodes only the box of the image file, as far as the format allows: uncompressed formats only read the rows
+    or tiles intersecting the box. Other formats are decoded completely, within the memory budget
+    """
+    with Image.open(path) as image:
+        top: int = min(max(box[1], 0), image.height)
+        bottom: int = max(min(box[3], image.height), top)
+        row_tile = get_raw_row_tile(image, top, bottom)
+        if row_tile is not None:
+            if bottom == top:
+                return Image.new(image.mode, (box[2] - box[0], box[3] - box[1]))
+            with budget.reserve(get_decoded_size((image.width, bottom - top), image.mode)):
+                rows: Image.Image = read_raw_tile(image, row_tile)
+            return rows.crop((box[0], box[1] - top, box[2], box[3] - top))
+        if len(image.tile) == 1 or not is_raw_image(image):
+            with budget.reserve(get_decoded_size(image.size, image.mode)):
+                image.load()
+                return image.crop(box)
+        # Like Image.crop, the parts of the box outside of the image are black
+        region: Image.Image = Image.new(image.mode, (box[2] - box[0], box[3] - box[1]))
+        for tile in image.tile:
+            if not boxes_intersect(tile[1], box):
+                continue
+            tile_size: int = get_decoded_size((tile[1][2] - tile[1][0], tile[1][3] - tile[1][1]), image.mode)
+            with budget.reserve(tile_size):
+                region.paste(read_raw_tile(image, tile), (tile[1][0] - box[0], tile[1][1] - box[1]))
+        return region
+
+
+def create_preview(path: str, min_size: Tuple[int, int], budget: MemoryBudget) -> Image.Image:
+    """
+    Creates a version of the image reduced by an integer factor, which is still at least min_size (where the image
+    is big enough), without keeping the complete image decoded in memory where the format allows
+    """
+    with Image.open(path) as image:
+        factor: int = max(min(image.width // max(min_size[0], 1), image.height // max(min_size[1], 1)), 1)
+        original_width: int = image.width
+        # JPEG can be decoded at 1/2, 1/4 or 1/8 scale right away
+        if factor > 1 and image.draft(None, (math.ceil(image.width / factor), math.ceil(image.height / factor))):
+            factor = max(factor * image.width // original_width, 1)
+        if factor > 1 and is_raw_image(image):
+            return create_banded_preview(image, factor, budget)
+        with budget.reserve(get_decoded_size(image.size, image.mode)):
+            image.load()
+            return image.reduce(factor) if factor > 1 else image.copy()
+
+
+def create_banded_preview(image: Image.Image, factor: int, budget: MemoryBudget) -> Image.Image:
+    """
+    Creates the preview of an uncompressed image band by band, so only one band is read at a time
+    """
+    preview: Image.Image = Image.new(image.mode, (math.ceil(image.width / factor), math.ceil(image.height / factor)))
+    row_bytes: int = get_decoded_size((image.width, 1), image.mode)
+    # Bands are aligned to the reduction factor, so reducing them separately gives the same result
+    band_height: int = max(PREVIEW_BAND_BYTES // row_bytes // factor, 1) * factor
+    for top in range(0, image.height, band_height):
+        box: Tuple[int, int, int, int] = (0, top, image.width, min(top + band_height, image.height))
+        band: Image.Image = decode_region(image.filename, box, budget)
+        preview.paste(band.reduce(factor), (0, top // factor))
+    return preview
+
+
+class LargeImage():
+    """
+    Stands in for an image too big to be kept decoded in memory. Only a reduced preview is held, which the image is
+    displayed from, the pixels of a box are decoded from the file when it's cropped. Supports the part of the Image
+    interface the application uses for the current image
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: Tuple[int, int],
+                 mode: str,
+                 preview: Image.Image,
+                 budget: MemoryBudget):
+        self.path: str = path
+        self.size: Tuple[int, int] = size
+        self.mode: str = mode
+        self.preview: Image.Image = preview
+        self.budget: MemoryBudget = budget
+
+    @staticmethod
+    def open(path: str, min_preview_size: Tuple[int, int], budget: MemoryBudget) -> "LargeImage":
+        with Image.open(path) as image:
+            size: Tuple[int, int] = image.size
+            mode: str = image.mode
+        return LargeImage(path, size, mode, create_preview(path, min_preview_size, budget), budget)
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def load(self):
+        # Boxes are decoded when they are cropped
+        pass
+
+    def close(self):
+        pass
+
+    def crop(self, box: Tuple[int, int, int, int]) -> Image.Image:
+        return decode_region(self.path, box, self.budget)
+
+    def resize(self,
+               size: Tuple[int, int],
+               resample: int = Image.LANCZOS,
+               box: Optional[Tuple[float, float, float, float]] = None,
+               reducing_gap: Optional[float] = None) -> Image.Image:
+        if box is None:
+            box = (0, 0) + self.size
+        # The decoded box is rounded out to whole pixels, the exact box is resampled from it
+        rounded_box: Tuple[int, int, int, int] = (
+            math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+        region: Image.Image = self.crop(rounded_box)
+        region_box: Tuple[float, float, float, float] = (
+            box[0] - rounded_box[0], box[1] - rounded_box[1], box[2] - rounded_box[0], box[3] - rounded_box[1])
+        return region.resize(size, resample, box=region_box, reducing_gap=reducing_gap)
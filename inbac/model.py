@@ -1,14 +1,35 @@
-from typing import Optional, List, Tuple, Any
+from typing import Optional, Dict, List, Sequence, Set, Tuple, Any
 from argparse import Namespace
 from PIL import Image
 from PIL.ImageTk import PhotoImage
 
+from inbac.cropping import NO_ORIENTATION, Orientation
+from inbac.image_cache import ImagePyramid
+from inbac.processed_images import ProcessedImages
+
 
 class Model():
     def __init__(self, args):
         self.args: Namespace = args
-        self.images: List[str] = []
+        self.images: Sequence[str] = []
+        # Incremented whenever a directory is opened, to discard stale results of background listing
+        self.images_generation: int = 0
+        # Set while a big directory is sorted in the background, changes of the watched directory are merged afterwards
+        self.images_sorting: bool = False
+        self.pending_directory_changes: List[Tuple[Optional[Set[str]], Optional[Set[str]]]] = []
+        # First image of the group of near-duplicates of every image which isn't the first of its group itself
+        self.duplicate_of: Dict[str, str] = {}
+        # Images which already have crops in the output directory, by their position in the list
+        self.processed_images: ProcessedImages = ProcessedImages()
+        # Set while the images of a recursive walk or a file list are still being listed in the background
+        self.images_listing: bool = False
+        # Set while resuming after the image saved last waits for the listing, which may not have reached it yet
+        self.resume_pending: bool = False
         self.selection_box: Optional[Any] = None
+        # Boxes placed on the current image in addition to the selection, in coordinates of the image as it's decoded
+        # (so they stay valid when it's rotated or rescaled), and the rectangles they are drawn with
+        self.placed_boxes: List[Tuple[int, int, int, int]] = []
+        self.placed_box_objects: List[Any] = []
         self.golden_ratio_lines = []
         self.press_coord: Tuple[int, int] = (0, 0)
         self.move_coord: Tuple[int, int] = (0, 0)
@@ -16,14 +37,37 @@ class Model():
         self.canvas_image: Optional[Any] = None
         self.canvas_image_dimensions: Tuple[int, int] = (0, 0)
         self.current_image: Optional[Image] = None
+        # Counter clockwise rotation of the current image in degrees, on top of its EXIF orientation. The current image
+        # itself is never transformed, only its display image and the cropped regions when they are saved
+        self.rotation: int = 0
+        self.exif_orientation: Orientation = NO_ORIENTATION
+        # Rotations of the images of the current directory, kept when going back to an image
+        self.rotations: Dict[str, int] = {}
+        # Content scores of the current image the initial selection box is placed with, None places it in the corner
+        self.image_scores: Optional[Any] = None
+        # Multi-resolution levels of the current image, used for rescaling it to the canvas
+        self.image_pyramid: Optional[ImagePyramid] = None
+        # Canvas size and filter the displayed image was last scaled for
+        self.displayed_canvas_size: Tuple[int, int] = (0, 0)
+        self.displayed_resample: Optional[int] = None
+        # State of the coalesced handling of window resize events
+        self.resize_redraw_scheduled: bool = False
+        self.resize_settle_job: Optional[Any] = None
         self.overlay_top: Optional[Any] = None
         self.overlay_bottom: Optional[Any] = None
         self.overlay_left: Optional[Any] = None
         self.overlay_right: Optional[Any] = None
         self.overlay_stipple: str = "gray25"
+        # Stipple the overlays are currently drawn with, to skip restyling them when it didn't change
+        self.applied_overlay_stipple: Optional[str] = None
+        # Mouse input waiting to be rendered in the next frame
+        self.pending_move_coord: Optional[Tuple[int, int]] = None
+        self.pending_zoom_steps: int = 0
         self.enabled_selection_mode: bool = False
         self.default_scrolling_speed_in_px: int = 8
         self.smooth_scrolling_speed_in_px: int = 1
         self.effective_scrolling_speed_in_px: int = self.default_scrolling_speed_in_px
         self.box_selected: bool = False
         self.current_file: int = 0
+        # Information about the current image shown in the window title
+        self.image_title: str = ""
@@ -0,0 +1,73 @@
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+from inbac.cropping import CROP_SUFFIX, CROPPED_IMAGE_PATTERN, get_output_filename
+
+
+class OutputIndex():
+    """
+    In-memory index of the output directory, mapping the base name of every cropped image (<name>_crop, parsed with
+    CROPPED_IMAGE_PATTERN) to its highest crop number. Built with a single scan and updated on every allocation,
+    so a new crop name is found without probing the filesystem
+    """
+
+    def __init__(self, directory: str, names: Optional[Iterable[str]] = None):
+        self.directory: str = directory
+        self.lock: threading.Lock = threading.Lock()
+        self.highest_crop_numbers: Dict[str, int] = {}
+        # All names in the directory, names not matching the pattern (e.g. other formats) may still collide
+        self.names: Set[str] = set()
+        # The names may be given by an output sink not storing the crops as files
+        if names is None:
+            self.scan()
+        else:
+            for name in names:
+                self.add(name)
+
+    def scan(self):
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    self.add(entry.name)
+        except FileNotFoundError:
+            # The output directory is created on the first save
+            pass
+
+    def add(self, filename: str):
+        self.names.add(filename)
+        match = CROPPED_IMAGE_PATTERN.match(filename)
+        if match:
+            base_name: str = match.group(1)
+            crop_number: int = int(match.group(2))
+            if crop_number > self.highest_crop_numbers.get(base_name, 0):
+                self.highest_crop_numbers[base_name] = crop_number
+
+    def highest_crop_number(self, filename: str) -> int:
+        name, _ = os.path.splitext(filename)
+        with self.lock:
+            return self.highest_crop_numbers.get(name + CROP_SUFFIX, 0)
+
+    def allocate(self, filename: str, image_format: Optional[str] = None) -> str:
+        """
+        Returns the name for the next crop of the source image and marks it as taken, safe to use from several threads
+        """
+        return self.allocate_many(filename, 1, image_format)[0]
+
+    def allocate_many(self, filename: str, count: int, image_format: Optional[str] = None) -> List[str]:
+        """
+        Returns the names for the next count crops of the source image, allocated in one step
+        """
+        name, extension = os.path.splitext(filename)
+        base_name: str = name + CROP_SUFFIX
+        output_filenames: List[str] = []
+        with self.lock:
+            crop_number: int = self.highest_crop_numbers.get(base_name, 0)
+            while len(output_filenames) < count:
+                crop_number += 1
+                output_filename: str = get_output_filename(base_name + str(crop_number) + extension, image_format)
+                if output_filename not in self.names:
+                    self.add(output_filename)
+                    output_filenames.append(output_filename)
+            self.highest_crop_numbers[base_name] = max(crop_number, self.highest_crop_numbers.get(base_name, 0))
+        return output_filenames
@@ -0,0 +1,286 @@
+import hashlib
+import io
+import os
+import re
+import tarfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from inbac import profiler
+from inbac.cropping import encode_image, get_format_from_path
+from inbac.output_index import OutputIndex
+
+# Crops waiting to be written to a shard are written together once they reach this size, in bytes
+SHARD_BATCH_BYTES: int = 8 * 1024 * 1024
+# or once this many crops are waiting
+SHARD_BATCH_MEMBERS: int = 64
+# Shards are named <prefix><number>.<format> in the output directory
+SHARD_PREFIX: str = "crops-"
+SHARD_PATTERN = re.compile(re.escape(SHARD_PREFIX) + r"(\d+)\.(zip|tar)$")
+# Number of hexadecimal digits of the hash naming the subdirectories of the hashed layout (256 subdirectories)
+HASH_DIGITS: int = 2
+OUTPUT_LAYOUTS: Tuple[str, ...] = ("directory", "hashed", "zip", "tar")
+
+# Called once the encoded crop is written (or failed to be written) to its final location
+WrittenCallback = Callable[[Optional[Exception]], None]
+
+
+class OutputSink():
+    """
+    Writes the encoded crops into the output directory, every crop into its own file
+    """
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+
+    def get_crop_directory(self, subdirectory: str, source_name: str) -> str:
+        """
+        Returns the directory (relative to the output directory) the crops of the source image are saved into
+        """
+        return subdirectory
+
+    def make_directories(self, relative_directory: str):
+        os.makedirs(os.path.join(self.directory, relative_directory), exist_ok=True)
+
+    def create_output_index(self, relative_directory: str) -> OutputIndex:
+        return OutputIndex(os.path.join(self.directory, relative_directory))
+
+    def save(self,
+             image: Image.Image,
+             output_path: str,
+             image_format: Optional[str],
+             image_quality: int,
+             on_written: WrittenCallback):
+        encode_image(image, output_path, image_format, image_quality)
+        on_written(None)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class HashedDirectorySink(OutputSink):
+    """
+    Spreads the crops over subdirectories named by a hash of the source image name, so no directory grows too big.
+    All crops of an image end up in the same subdirectory, where their names are allocated like in a flat directory
+    """
+
+    def get_crop_directory(self, subdirectory: str, source_name: str) -> str:
+        name, _ = os.path.splitext(source_name)
+        return os.path.join(subdirectory, hashlib.md5(name.encode("utf-8")).hexdigest()[:HASH_DIGITS])
+
+
+class ShardSink(OutputSink, ABC):
+    """
+    Appends the crops as members to archive shards in the output directory instead of creating a file per crop. A new
+    shard is started once the current one exceeds the shard size. Crops are collected and written in batches, a batch
+    is written once it's big enough, once it fills the current shard or when the sink is flushed. Members are named by their path relative
+    to the output directory, their names are indexed from the existing shards so they stay unique
+    """
+
+    extension: str = ""
+
+    def __init__(self, directory: str, shard_size: int):
+        super().__init__(directory)
+        self.shard_size: int = shard_size
+        self.lock: threading.Lock = threading.Lock()
+        # Only one batch is written at a time, in the order the batches were collected
+        self.write_lock: threading.Lock = threading.Lock()
+        self.batch: List[Tuple[str, bytes, WrittenCallback]] = []
+        self.batch_bytes: int = 0
+        # Shard every member is stored in
+        self.member_shards: Dict[str, str] = {}
+        self.shard_number: int = 0
+        self.shard_bytes: int = 0
+        self.scan_shards()
+
+    def scan_shards(self):
+        try:
+            filenames: List[str] = os.listdir(self.directory)
+        except FileNotFoundError:
+            # The output directory is created on the first save
+            return
+        for filename in filenames:
+            match = SHARD_PATTERN.match(filename)
+            if not match or "." + match.group(2) != self.extension:
+                continue
+            shard_path: str = os.path.join(self.directory, filename)
+            for member_name in self.list_members(shard_path):
+                self.member_shards[member_name] = shard_path
+            if int(match.group(1)) > self.shard_number:
+                self.shard_number = int(match.group(1))
+                self.shard_bytes = os.path.getsize(shard_path)
+
+    def get_shard_path(self) -> str:
+        return os.path.join(self.directory, f"{SHARD_PREFIX}{self.shard_number:05d}{self.extension}")
+
+    def get_member_name(self, output_path: str) -> str:
+        return os.path.relpath(output_path, self.directory).replace(os.sep, "/")
+
+    def make_directories(self, relative_directory: str):
+        # Members are stored with their directories in the shards
+        pass
+
+    def create_output_index(self, relative_directory: str) -> OutputIndex:
+        prefix: str = relative_directory.replace(os.sep, "/").strip("/")
+        with self.lock:
+            names: List[str] = [
+                member_name.rpartition("/")[2] for member_name in self.member_shards
+                if member_name.rpartition("/")[0] == prefix]
+        return OutputIndex(os.path.join(self.directory, relative_directory), names)
+
+    def save(self,
+             image: Image.Image,
+             output_path: str,
+             image_format: Optional[str],
+             image_quality: int,
+             on_written: WrittenCallback):
+        encoded_image: io.BytesIO = io.BytesIO()
+        with profiler.span("encode"):
+            image.save(encoded_image, image_format or get_format_from_path(output_path), quality=image_quality)
+        member_name: str = self.get_member_name(output_path)
+        with self.lock:
+            self.batch.append((member_name, encoded_image.getvalue(), on_written))
+            self.batch_bytes += encoded_image.getbuffer().nbytes
+            # Not written yet, but taken
+            self.member_shards[member_name] = ""
+            full: bool = (self.batch_bytes >= SHARD_BATCH_BYTES or len(self.batch) >= SHARD_BATCH_MEMBERS or
+                          self.shard_bytes + self.batch_bytes >= self.shard_size)
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                batch: List[Tuple[str, bytes, WrittenCallback]] = self.batch
+                self.batch = []
+                self.batch_bytes = 0
+            if not batch:
+                return
+            error: Optional[Exception] = None
+            written: List[Tuple[str, str]] = []
+            try:
+                with profiler.span("write"):
+                    written = self.write_batch([(member_name, data) for member_name, data, _ in batch])
+            except Exception as write_error:
+                error = write_error
+            # Names of crops which failed to be written stay taken, the failures are reported by the save queue
+            with self.lock:
+                for member_name, shard_path in written:
+                    self.member_shards[member_name] = shard_path
+        for _, _, on_written in batch:
+            on_written(error)
+
+    def write_batch(self, members: List[Tuple[str, bytes]]) -> List[Tuple[str, str]]:
+        """
+        Appends the members to the shards, starting new shards where the current one is full. Returns the shard
+        every member was written to
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        written: List[Tuple[str, str]] = []
+        start: int = 0
+        while start < len(members):
+            if self.shard_number == 0 or self.shard_bytes >= self.shard_size:
+                self.start_shard()
+            end: int = start
+            batch_bytes: int = 0
+            # At least one member is written to every shard, even a member bigger than the shard size
+            while end < len(members) and (end == start or self.shard_bytes + batch_bytes < self.shard_size):
+                batch_bytes += len(members[end][1])
+                end += 1
+            shard_path: str = self.get_shard_path()
+            self.append_members(shard_path, members[start:end])
+            self.shard_bytes = os.path.getsize(shard_path)
+            written.extend((member_name, shard_path) for member_name, _ in members[start:end])
+            start = end
+        return written
+
+    def start_shard(self):
+        self.close_shard()
+        self.shard_number += 1
+        self.shard_bytes = 0
+
+    @abstractmethod
+    def list_members(self, shard_path: str) -> List[str]:
+        pass
+
+    @abstractmethod
+    def append_members(self, shard_path: str, members: List[Tuple[str, bytes]]):
+        pass
+
+    def close_shard(self):
+        pass
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            self.close_shard()
+
+
+class ZipShardSink(ShardSink):
+    """
+    Zip shards are opened for every batch, so the central directory is written after every batch and the shard stays
+    readable if the application is terminated. Crops are stored without compressing them again
+    """
+
+    extension: str = ".zip"
+
+    def list_members(self, shard_path: str) -> List[str]:
+        with zipfile.ZipFile(shard_path) as shard:
+            return shard.namelist()
+
+    def append_members(self, shard_path: str, members: List[Tuple[str, bytes]]):
+        with zipfile.ZipFile(shard_path, "a", zipfile.ZIP_STORED) as shard:
+            date_time: Tuple[int, ...] = time.localtime()[:6]
+            for member_name, data in members:
+                shard.writestr(zipfile.ZipInfo(member_name, date_time), data)
+
+
+class TarShardSink(ShardSink):
+    """
+    Tar shards stay open until they are full, appending to a tar archive would read all of its headers first.
+    Members are complete on disk after every batch, the end of the archive is written when the shard is closed
+    """
+
+    extension: str = ".tar"
+
+    def __init__(self, directory: str, shard_size: int):
+        self.shard: Optional[tarfile.TarFile] = None
+        super().__init__(directory, shard_size)
+
+    def list_members(self, shard_path: str) -> List[str]:
+        with tarfile.open(shard_path) as shard:
+            return shard.getnames()
+
+    def append_members(self, shard_path: str, members: List[Tuple[str, bytes]]):
+        if self.shard is None:
+            self.shard = tarfile.open(shard_path, "a")
+        modification_time: float = time.time()
+        for member_name, data in members:
+            member: tarfile.TarInfo = tarfile.TarInfo(member_name)
+            member.size = len(data)
+            member.mtime = modification_time
+            self.shard.addfile(member, io.BytesIO(data))
+        self.shard.fileobj.flush()
+
+    def close_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+
+
+def create_output_sink(directory: str, layout: str = "directory", shard_size: int = 1024 * 1024 * 1024) -> OutputSink:
+    if layout == "hashed":
+        return HashedDirectorySink(directory)
+    if layout == "zip":
+        return ZipShardSink(directory, shard_size)
+    if layout == "tar":
+        return TarShardSink(directory, shard_size)
+    return OutputSink(directory)
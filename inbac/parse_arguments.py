@@ -1,7 +1,12 @@
 import argparse
+import re
 
+from inbac.cropping import Rendition
+from inbac.output_sink import OUTPUT_LAYOUTS
+from inbac.saliency import SCORING_METHODS, is_available as is_saliency_available
 
-def parse_arguments():
+
+def parse_arguments(argv=None):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="""inbac - interactive batch cropper\n
@@ -10,6 +15,9 @@ Z                                 - save selection and go to the next picture\n
 X                                 - save selection and stay on the same picture\n
 C                                 - rotate current image by 90 degrees\n
 R                                 - rotate aspect ratio if defined\n
+A                                 - keep selection as another box, all boxes are saved together\n
+D                                 - skip the rest of the group of near-duplicates (with --duplicates)\n
+N                                 - go to the next picture without crops in the output directory\n
 Hold Left Shift or Left Ctrl      - drag selection\n
 Right Arrow or Right Mouse Button - go to next picture\n
 Left Arrow or Middle Mouse Button - go to previous picture\n"""
@@ -17,7 +25,7 @@ Left Arrow or Middle Mouse Button - go to previous picture\n"""
     parser.add_argument(
         "input_dir",
         nargs="?",
-        help="input directory (defaults to current working directory)",
+        help="input directory or zip/tar archive (defaults to current working directory)",
         default=None)
     parser.add_argument(
         "output_dir",
@@ -62,12 +70,295 @@ Left Arrow or Middle Mouse Button - go to previous picture\n"""
                         help="define the croped image format")
     parser.add_argument("-q", "--image_quality", type=int,
                         help="define the croped image quality", default=100)
+    parser.add_argument(
+        "--resample",
+        choices=["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"],
+        help="filter cropped images are resized with (default is lanczos)",
+        default="lanczos")
+    parser.add_argument(
+        "--reducing_gap",
+        type=float,
+        help="big downscales are first reduced by an integer factor until the image is this many times bigger "
+             "than the requested size, which is faster and in most cases indistinguishable (default is 3, 0 disables it)",
+        default=3.0)
+    parser.add_argument(
+        "--rendition",
+        dest="renditions",
+        action="append",
+        type=parse_rendition,
+        metavar="WIDTHxHEIGHT[:FORMAT[:QUALITY[:SUBFOLDER]]]",
+        help="additional output of every crop, saved with the name of the crop into SUBFOLDER of the output directory "
+             "(default is the size). Can be given several times, smaller renditions are resized from bigger ones "
+             "(e.g. --rendition 540x960:JPEG:85:previews --rendition 135x240::70:thumbnails)",
+        default=[])
+    parser.add_argument(
+        "--output_layout",
+        choices=OUTPUT_LAYOUTS,
+        help="how crops are stored in the output directory: a file per crop (directory), a file per crop in 256 "
+             "subdirectories named by a hash of the source image name (hashed), or appended to zip or tar shards "
+             "written in batches (zip, tar) (default is directory)",
+        default="directory")
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        help="size in megabytes at which a new zip or tar shard is started (default is 1024)",
+        default=1024)
+    parser.add_argument(
+        "--initial_box",
+        choices=["corner"] + list(SCORING_METHODS),
+        help="where the initial selection box is placed: in the top left corner, or where the image content scores "
+             "highest by edge energy, local entropy or spectral residual saliency. Images are scored in the "
+             "background while they are prefetched, requires numpy (default is corner)",
+        default="corner")
     parser.add_argument(
         '-nfs',
         '--no-fullscreen',
         action='store_true',
          help="suppress starting the application in full screen mode")
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "-p",
+        "--prefetch",
+        type=parse_non_negative_int,
+        help="number of images before and after the current one decoded in the background (default is 2)",
+        default=2)
+    parser.add_argument(
+        "--cache_size",
+        type=parse_non_negative_int,
+        help="memory budget of the decoded image cache in megabytes (default is 1024)",
+        default=1024)
+    parser.add_argument(
+        "--memory_limit",
+        type=int,
+        help="approximate memory ceiling in megabytes: images which don't fit are never fully decoded, "
+             "they are displayed from a reduced decode and only the selected box is decoded when saving",
+        default=None)
+    parser.add_argument(
+        "-R",
+        "--recursive",
+        action="store_true",
+        help="crop the images of all subdirectories too, crops are saved into the same subdirectories of the "
+             "output directory. The tree is listed in the background while cropping")
+    parser.add_argument(
+        "--file_list",
+        metavar="FILE",
+        help="crop the images listed one per line in FILE (- reads the list from the standard input) instead of "
+             "the images of the input directory, relative paths are relative to the input directory",
+        default=None)
+    parser.add_argument(
+        "--include",
+        action="append",
+        metavar="GLOB",
+        help="only crop images whose path relative to the input directory or name matches GLOB, "
+             "can be given several times",
+        default=[])
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        metavar="GLOB",
+        help="skip images and subdirectories whose path relative to the input directory or name matches GLOB, "
+             "can be given several times",
+        default=[])
+    parser.add_argument(
+        "--duplicates",
+        choices=["off", "mark", "collapse"],
+        help="hash the images in the background and group near-duplicates (e.g. bursts): mark shows duplicates in "
+             "the title and D skips the rest of the group, collapse also only shows the first image of every group "
+             "when going to the next or previous image (default is off)",
+        default="off")
+    parser.add_argument(
+        "--duplicate_distance",
+        type=int,
+        help="number of differing bits of the 64 bit perceptual hashes up to which images are near-duplicates "
+             "(default is 4)",
+        default=4)
+    parser.add_argument(
+        "--filmstrip",
+        action="store_true",
+        help="show a scrollable strip of thumbnails below the image, clicking a thumbnail opens the image")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="merge images added to, removed from or renamed in the input directory into the list while cropping "
+             "(uses inotify on Linux and polls the directory otherwise)")
+    parser.add_argument(
+        "--progressive",
+        action="store_true",
+        help="show a quick reduced quality preview of images not decoded yet, replaced once the full quality is ready")
+    parser.add_argument(
+        "--save_queue_size",
+        type=parse_positive_int,
+        help="number of crops which can be waiting to be saved in the background before saving blocks (default is 16)",
+        default=16)
+    parser.add_argument(
+        "--save_workers",
+        type=parse_positive_int,
+        help="number of background threads saving crops (default is 2)",
+        default=2)
+    parser.add_argument(
+        "--no_index_cache",
+        action="store_true",
+        help="don't store the sorted listing, the perceptual hashes and the thumbnails of image directories in the user "
+             "cache directory")
+    parser.add_argument(
+        "--profile",
+        metavar="TRACE_FILE",
+        help="write timing spans of the processing stages to TRACE_FILE (Chrome trace JSON, viewable in Perfetto) "
+             "and their percentiles per stage to a CSV file next to it on exit",
+        default=None)
+
+    args = parser.parse_args(argv)
+    validate_reducing_gap(parser, args)
+    if args.initial_box != "corner" and not is_saliency_available():
+        parser.error(f"--initial_box {args.initial_box} requires numpy")
 
     return args
+
+
+def parse_batch_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""inbac-batch - crop images without the GUI\n
+Crops listed in the manifest are saved like in inbac. The manifest is either a CSV file with the columns\n
+source, left, top, right, bottom and optionally rotation, resize_width, resize_height, format, quality\n
+or a JSON lines file (.jsonl) with the keys source, box and optionally rotation, resize, format, quality.\n
+Boxes are given in pixels of the original image after applying its EXIF orientation and the rotation (counter clockwise, in degrees)."""
+    )
+    parser.add_argument(
+        "manifest",
+        help="crop manifest (CSV or JSON lines)")
+    parser.add_argument(
+        "input_dir",
+        help="directory the source images in the manifest are relative to")
+    parser.add_argument(
+        "output_dir",
+        help="output directory")
+    parser.add_argument(
+        "-r",
+        "--resize",
+        type=int,
+        nargs=2,
+        help="default size the cropped images will be resized to",
+        default=None)
+    parser.add_argument("-f", "--image_format",
+                        help="default cropped image format")
+    parser.add_argument("-q", "--image_quality", type=int,
+                        help="default cropped image quality", default=100)
+    parser.add_argument(
+        "--resample",
+        choices=["nearest", "box", "bilinear", "hamming", "bicubic", "lanczos"],
+        help="filter cropped images are resized with (default is lanczos)",
+        default="lanczos")
+    parser.add_argument(
+        "--reducing_gap",
+        type=float,
+        help="big downscales are first reduced by an integer factor until the image is this many times bigger "
+             "than the requested size, which is faster and in most cases indistinguishable (default is 3, 0 disables it)",
+        default=3.0)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of worker processes (defaults to the number of CPUs)",
+        default=None)
+    parser.add_argument(
+        "--retries",
+        type=int,
+        help="how often cropping an unreadable image is retried before it's skipped (default is 1)",
+        default=1)
+
+    args = parser.parse_args(argv)
+    validate_reducing_gap(parser, args)
+
+    return args
+
+
+def parse_gaps_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="""inbac-gaps - remove or insert gaps in the crop numbers of cropped images (<name>_crop<number>)\n
+Renames are planned up front and logged to the directory, so an interrupted run can be resumed or rolled back."""
+    )
+    parser.add_argument(
+        "directories",
+        nargs="+",
+        help="directories containing cropped images")
+    parser.add_argument(
+        "-i",
+        "--insert_after",
+        type=int,
+        help="insert a gap after this crop number instead of removing gaps",
+        default=None)
+    parser.add_argument(
+        "-g",
+        "--gap_size",
+        type=int,
+        help="size of the inserted gap (default is 100)",
+        default=100)
+    parser.add_argument(
+        "-l",
+        "--latest_only",
+        action="store_true",
+        help="only process the crops of the latest image in each directory")
+    parser.add_argument(
+        "-R",
+        "--recursive",
+        action="store_true",
+        help="also process all subdirectories")
+    parser.add_argument(
+        "-n",
+        "--dry_run",
+        action="store_true",
+        help="only print the planned renames")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="finish interrupted runs")
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="revert interrupted runs")
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def validate_reducing_gap(parser: argparse.ArgumentParser, args):
+    if 0 < args.reducing_gap < 1:
+        parser.error("--reducing_gap must be 0 or at least 1")
+    if args.reducing_gap == 0:
+        args.reducing_gap = None
+
+
+def parse_positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
+def parse_non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {value}")
+    return number
+
+
+def parse_rendition(value: str) -> Rendition:
+    fields = value.split(":")
+    if len(fields) > 4:
+        raise argparse.ArgumentTypeError(f"invalid rendition: {value}")
+    size_field, image_format, quality_field, subfolder = fields + [""] * (4 - len(fields))
+    size = None
+    if size_field:
+        match = re.fullmatch(r"(\d+)x(\d+)", size_field)
+        if match is None or int(match.group(1)) == 0 or int(match.group(2)) == 0:
+            raise argparse.ArgumentTypeError(f"invalid rendition size: {size_field}")
+        size = (int(match.group(1)), int(match.group(2)))
+    if quality_field and not quality_field.isdigit():
+        raise argparse.ArgumentTypeError(f"invalid rendition quality: {quality_field}")
+    subfolder = subfolder or size_field or image_format.lower()
+    if not subfolder:
+        raise argparse.ArgumentTypeError(f"rendition needs a size, a format or a subfolder: {value}")
+    return Rendition(size, image_format or None, int(quality_field) if quality_field else None, subfolder)
@@ -0,0 +1,71 @@
+import re
+import threading
+from typing import Iterable
+
+# Matches the first byte with a bit which isn't set, i.e. a group of 8 images with an unprocessed one
+NOT_ALL_SET = re.compile(b"[^\xff]")
+
+
+class ProcessedImages():
+    """
+    Bitmap over the positions of the image list, with a bit set for every image which already has crops. Needs one
+    bit per image and finds the next unprocessed image scanning 8 images per byte. Built in the background,
+    positions which aren't built yet read as unprocessed
+    """
+
+    def __init__(self):
+        self.bits: bytearray = bytearray()
+        # Number of positions from the start of the list whose state is known
+        self.built: int = 0
+        self.count: int = 0
+        self.stopped: bool = False
+        self.lock: threading.Lock = threading.Lock()
+
+    def stop(self):
+        self.stopped = True
+
+    def is_processed(self, position: int) -> bool:
+        byte: int = position >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (position & 7)))
+
+    def mark(self, position: int):
+        with self.lock:
+            self.set_bit(position)
+
+    def set_bit(self, position: int):
+        byte: int = position >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        bit: int = 1 << (position & 7)
+        if not self.bits[byte] & bit:
+            self.bits[byte] |= bit
+            self.count += 1
+
+    def add_built(self, states: Iterable[bool]):
+        """
+        Appends the states of the next positions of the list. Positions marked in the meantime stay processed
+        """
+        with self.lock:
+            for processed in states:
+                if processed:
+                    self.set_bit(self.built)
+                self.built += 1
+
+    def find_unprocessed(self, start: int) -> int:
+        """
+        Returns the first position from start on which isn't marked as processed, which may be beyond the list
+        """
+        with self.lock:
+            position: int = start
+            while position >> 3 < len(self.bits):
+                if not self.is_processed(position):
+                    return position
+                if position & 7 == 7:
+                    # Whole bytes of processed images are skipped at once
+                    match = NOT_ALL_SET.search(self.bits, (position >> 3) + 1)
+                    if match is None:
+                        return len(self.bits) * 8
+                    position = match.start() * 8
+                else:
+                    position += 1
+            return position
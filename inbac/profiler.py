@@ -0,0 +1,163 @@
+import contextlib
+import csv
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
+
+# Returned by span while profiling is disabled, so instrumented code only pays for one function call
+NULL_SPAN: ContextManager = contextlib.nullcontext()
+
+# Spans kept for the trace, older ones are dropped so a long session doesn't keep every span in memory
+MAX_EVENTS: int = 100000
+
+# (stage, start in ns, duration in ns, thread id)
+Event = Tuple[str, int, int, int]
+
+
+class Span():
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler: "Profiler" = profiler
+        self.name: str = name
+        self.start_ns: int = 0
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start_ns, time.perf_counter_ns() - self.start_ns)
+
+
+class Profiler():
+    """
+    Collects timing spans of the processing stages from all threads. The latest max_events spans are kept for the
+    trace and the percentiles, the number, total and maximum duration of the spans are counted over the whole session
+    """
+
+    def __init__(self, max_events: int = MAX_EVENTS):
+        self.events: "deque[Event]" = deque(maxlen=max_events)
+        # Number, total and maximum duration in ns of all spans of every stage
+        self.totals: Dict[str, Tuple[int, int, int]] = {}
+        self.thread_names: Dict[int, str] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.origin_ns: int = time.perf_counter_ns()
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def record(self, name: str, start_ns: int, duration_ns: int):
+        thread: threading.Thread = threading.current_thread()
+        with self.lock:
+            self.events.append((name, start_ns, duration_ns, thread.ident))
+            count, total_ns, max_ns = self.totals.get(name, (0, 0, 0))
+            self.totals[name] = (count + 1, total_ns + duration_ns, max(max_ns, duration_ns))
+            self.thread_names[thread.ident] = thread.name
+
+    def write_trace(self, path: str):
+        """
+        Writes the spans in the Chrome trace event format, which can be opened in Perfetto or chrome://tracing
+        """
+        pid: int = os.getpid()
+        with self.lock:
+            events: List[Event] = list(self.events)
+            thread_names: Dict[int, str] = dict(self.thread_names)
+        trace_events: List[Dict[str, Any]] = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+            for tid, thread_name in thread_names.items()]
+        trace_events += [{
+            "name": name,
+            "cat": "inbac",
+            "ph": "X",
+            "ts": (start_ns - self.origin_ns) / 1000,
+            "dur": duration_ns / 1000,
+            "pid": pid,
+            "tid": tid,
+        } for name, start_ns, duration_ns, tid in events]
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+    def write_summary(self, path: str):
+        """
+        Writes the number of spans and their duration percentiles (in milliseconds) per stage as CSV
+        """
+        durations: Dict[str, List[int]] = {}
+        with self.lock:
+            totals: Dict[str, Tuple[int, int, int]] = dict(self.totals)
+            for name, _, duration_ns, _ in self.events:
+                durations.setdefault(name, []).append(duration_ns)
+        with open(path, "w", encoding="utf-8", newline="") as summary_file:
+            writer = csv.writer(summary_file)
+            writer.writerow(["stage", "count", "total_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            for name, (count, total_ns, max_ns) in sorted(totals.items()):
+                # Percentiles of the spans still kept, a stage may have no recent spans left
+                stage_durations: List[int] = sorted(durations.get(name, [max_ns]))
+                writer.writerow([
+                    name,
+                    count,
+                    f"{total_ns / 1e6:.3f}",
+                    f"{percentile(stage_durations, 50) / 1e6:.3f}",
+                    f"{percentile(stage_durations, 95) / 1e6:.3f}",
+                    f"{percentile(stage_durations, 99) / 1e6:.3f}",
+                    f"{max_ns / 1e6:.3f}",
+                ])
+
+    def write(self, trace_path: str):
+        """
+        Writes the trace and, next to it, the summary with the same name and the .csv extension
+        """
+        self.write_trace(trace_path)
+        self.write_summary(get_summary_path(trace_path))
+
+
+def percentile(sorted_values: List[int], percent: float) -> int:
+    # Nearest-rank method
+    rank: int = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def get_summary_path(trace_path: str) -> str:
+    return os.path.splitext(trace_path)[0] + ".csv"
+
+
+active_profiler: Optional[Profiler] = None
+
+
+def enable() -> Profiler:
+    global active_profiler
+    if active_profiler is None:
+        active_profiler = Profiler()
+    return active_profiler
+
+
+def disable():
+    global active_profiler
+    active_profiler = None
+
+
+def span(name: str) -> ContextManager:
+    """
+    Times the enclosed block as a span of the given stage, if profiling is enabled
+    """
+    if active_profiler is None:
+        return NULL_SPAN
+    return active_profiler.span(name)
+
+
+def profiled(name: str) -> Callable[[Callable], Callable]:
+    """
+    Decorator timing every call of the function as a span of the given stage, if profiling is enabled
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active_profiler is None:
+                return function(*args, **kwargs)
+            with active_profiler.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,253 @@
+import json
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from natsort import os_sort_keygen
+
+from inbac.cropping import CROPPED_IMAGE_PATTERN, IMAGE_FILE_EXTENSIONS
+
+DEFAULT_GAP_SIZE: int = 100
+# Prefix used to temporarily assign a file a unique name while breaking rename cycles
+TMP_FILENAME_PREFIX: str = "tmp_"
+# Written to the directory before any file is renamed and removed once all renames are done
+INTENT_LOG_FILENAME: str = ".inbac_rename_log.jsonl"
+INTENT_LOG_VERSION: int = 1
+
+# (crop number, suffix, extension, filename)
+CroppedFile = Tuple[int, str, str, str]
+RenameStep = Tuple[str, str]
+
+
+class RenameConflictError(Exception):
+    """
+    Raised when a rename plan would overwrite a file which isn't renamed itself
+    """
+
+
+class InterruptedRenameError(Exception):
+    """
+    Raised when new renames are planned in a directory with an interrupted run, which has to be resumed or rolled back first
+    """
+
+
+def collect_cropped_files(directory: str,
+                          process_all: bool = True,
+                          extensions: Tuple[str, ...] = IMAGE_FILE_EXTENSIONS) -> Dict[str, List[CroppedFile]]:
+    """
+    Groups the cropped images of the directory by their base name (<name>_crop), each group sorted by crop number.
+    When process_all is False, only the group of the last file (in the order of the operating system) is returned
+    """
+    files_dict: Dict[str, List[CroppedFile]] = {}
+    sort_key = os_sort_keygen()
+    last_key = None
+    latest_file_base_name: Optional[str] = None
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            filename: str = entry.name
+            if not filename.lower().endswith(extensions):
+                continue
+            # Every filename is matched only once
+            match = CROPPED_IMAGE_PATTERN.match(filename)
+            if not match:
+                continue
+            base_name: str = match.group(1)
+            files_dict.setdefault(base_name, []).append(
+                (int(match.group(2)), match.group(3), match.group(4), filename))
+            if not process_all:
+                key = sort_key(filename)
+                if last_key is None or key > last_key:
+                    last_key = key
+                    latest_file_base_name = base_name
+
+    if not process_all:
+        files_dict = {latest_file_base_name: files_dict[latest_file_base_name]} if latest_file_base_name else {}
+
+    for files in files_dict.values():
+        files.sort(key=lambda cropped_file: (cropped_file[0], sort_key(cropped_file[3])))
+    return files_dict
+
+
+def build_filename(base_name: str, crop_number: int, suffix: str, extension: str) -> str:
+    return f"{base_name}{crop_number}{suffix}{extension}"
+
+
+def plan_remove_gaps(files_dict: Dict[str, List[CroppedFile]]) -> Dict[str, str]:
+    """
+    Returns the renames (old name -> new name) numbering the crops of every base name consecutively from 1
+    """
+    renames: Dict[str, str] = {}
+    for base_name, files in files_dict.items():
+        for new_number, (_, suffix, extension, filename) in enumerate(files, start=1):
+            renames[filename] = build_filename(base_name, new_number, suffix, extension)
+    return renames
+
+
+def plan_insert_gaps(files_dict: Dict[str, List[CroppedFile]], gap_after: int, gap_size: int) -> Dict[str, str]:
+    """
+    Returns the renames (old name -> new name) shifting all crops numbered after gap_after by gap_size
+    """
+    renames: Dict[str, str] = {}
+    for base_name, files in files_dict.items():
+        for crop_number, suffix, extension, filename in files:
+            if crop_number > gap_after:
+                renames[filename] = build_filename(base_name, crop_number + gap_size, suffix, extension)
+    return renames
+
+
+def order_renames(renames: Dict[str, str], existing_files: Set[str]) -> List[RenameStep]:
+    """
+    Orders the renames so that no file is ever overwritten. A file is renamed once its target name is free,
+    rename cycles are broken by moving one of the files to a temporary name first
+    """
+    pending: Dict[str, str] = {old: new for old, new in renames.items() if old != new}
+
+    targets: Dict[str, str] = {}
+    for old, new in pending.items():
+        if new in targets:
+            raise RenameConflictError(f"{targets[new]} and {old} would both be renamed to {new}")
+        if new in existing_files and new not in pending:
+            raise RenameConflictError(f"Renaming {old} to {new} would overwrite an existing file")
+        targets[new] = old
+
+    occupied: Set[str] = set(existing_files) | set(pending)
+    ready: Deque[str] = deque(old for old, new in pending.items() if new not in occupied)
+    steps: List[RenameStep] = []
+
+    while pending:
+        while ready:
+            old = ready.popleft()
+            new = pending.pop(old)
+            steps.append((old, new))
+            occupied.discard(old)
+            occupied.add(new)
+            # The file waiting for the name which just became free can follow
+            waiting: Optional[str] = targets.pop(old, None)
+            if waiting is not None:
+                ready.append(waiting)
+        if pending:
+            # Only cycles are left, move one file out of the way
+            old, new = next(iter(pending.items()))
+            tmp_name: str = TMP_FILENAME_PREFIX + old
+            while tmp_name in occupied:
+                tmp_name = TMP_FILENAME_PREFIX + tmp_name
+            steps.append((old, tmp_name))
+            del pending[old]
+            pending[tmp_name] = new
+            targets[new] = tmp_name
+            occupied.discard(old)
+            occupied.add(tmp_name)
+            waiting = targets.pop(old, None)
+            if waiting is not None:
+                ready.append(waiting)
+    return steps
+
+
+class RenamePlan():
+    """
+    Ordered renames of files in one directory, executed with an intent log so an interrupted run can be resumed
+    or rolled back
+    """
+
+    def __init__(self, directory: str, steps: List[RenameStep], completed: int = 0):
+        self.directory: str = directory
+        self.steps: List[RenameStep] = steps
+        # Number of steps already performed (when loaded from an intent log)
+        self.completed: int = completed
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.directory, INTENT_LOG_FILENAME)
+
+    def execute(self):
+        if not self.steps:
+            return
+        resumed_at: int = self.completed
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, "w", encoding="utf-8") as log:
+                log.write(json.dumps({"version": INTENT_LOG_VERSION, "steps": self.steps}) + "\n")
+                log.flush()
+                os.fsync(log.fileno())
+        elif self.is_unmarked_step_done():
+            resumed_at += 1
+        with open(self.log_path, "a", encoding="utf-8") as log:
+            for index in range(resumed_at, len(self.steps)):
+                old, new = self.steps[index]
+                os.rename(os.path.join(self.directory, old), os.path.join(self.directory, new))
+                # Every performed step is marked in the log
+                log.write(f"{index}\n")
+                log.flush()
+                self.completed = index + 1
+        os.remove(self.log_path)
+
+    def rollback(self):
+        """
+        Reverts the performed steps of an interrupted run, in reverse order
+        """
+        completed: int = self.completed
+        if self.is_unmarked_step_done():
+            completed += 1
+        for index in range(completed - 1, -1, -1):
+            old, new = self.steps[index]
+            os.rename(os.path.join(self.directory, new), os.path.join(self.directory, old))
+        self.completed = 0
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def is_unmarked_step_done(self) -> bool:
+        """
+        The step after the last marked one may have been performed without being marked, before the run was interrupted
+        """
+        if self.completed >= len(self.steps):
+            return False
+        old, new = self.steps[self.completed]
+        return (not os.path.exists(os.path.join(self.directory, old)) and
+                os.path.exists(os.path.join(self.directory, new)))
+
+    @staticmethod
+    def load_interrupted(directory: str) -> Optional["RenamePlan"]:
+        """
+        Returns the plan of an interrupted run in the directory, if there is one
+        """
+        log_path: str = os.path.join(directory, INTENT_LOG_FILENAME)
+        try:
+            with open(log_path, "r", encoding="utf-8") as log:
+                header_line: str = log.readline()
+                if not header_line.endswith("\n"):
+                    # Interrupted while writing the plan, before any file was renamed
+                    log.close()
+                    os.remove(log_path)
+                    return None
+                header = json.loads(header_line)
+                completed: int = 0
+                for line in log:
+                    # A marker may be incomplete if the run was killed while writing it
+                    if line.endswith("\n"):
+                        completed = int(line) + 1
+        except FileNotFoundError:
+            return None
+        if header.get("version") != INTENT_LOG_VERSION:
+            raise ValueError(f"Unsupported rename log in {directory}")
+        return RenamePlan(directory, [(old, new) for old, new in header["steps"]], completed)
+
+
+def create_plan(directory: str, renames: Dict[str, str]) -> RenamePlan:
+    if os.path.exists(os.path.join(directory, INTENT_LOG_FILENAME)):
+        raise InterruptedRenameError(f"Renaming files in {directory} was interrupted, resume or roll it back first (inbac-gaps --resume or --rollback)")
+    with os.scandir(directory) as entries:
+        existing_files: Set[str] = {entry.name for entry in entries}
+    return RenamePlan(directory, order_renames(renames, existing_files))
+
+
+def plan_remove_filename_gaps(directory: str, process_all: bool = True) -> RenamePlan:
+    return create_plan(directory, plan_remove_gaps(collect_cropped_files(directory, process_all=process_all)))
+
+
+def plan_insert_filename_gaps(directory: str,
+                              gap_after: int,
+                              gap_size: int = DEFAULT_GAP_SIZE,
+                              process_all: bool = False) -> RenamePlan:
+    return create_plan(
+        directory,
+        plan_insert_gaps(collect_cropped_files(directory, process_all=process_all), gap_after, gap_size))
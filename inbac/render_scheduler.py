@@ -0,0 +1,35 @@
+from typing import Any, Callable
+
+# Roughly one frame of a 60 Hz display
+FRAME_INTERVAL_MS: int = 16
+
+
+class RenderScheduler():
+    """
+    Merges redraw requests (e.g. from mouse motion or mouse wheel events) into at most one redraw per display frame
+    """
+
+    def __init__(self,
+                 schedule: Callable[[int, Callable[[], None]], Any],
+                 render: Callable[[], None],
+                 frame_interval_ms: int = FRAME_INTERVAL_MS):
+        self.schedule: Callable[[int, Callable[[], None]], Any] = schedule
+        self.render: Callable[[], None] = render
+        self.frame_interval_ms: int = frame_interval_ms
+        self.scheduled: bool = False
+
+    def request(self):
+        if self.scheduled:
+            return
+        self.scheduled = True
+        self.schedule(self.frame_interval_ms, self.run)
+
+    def run(self):
+        self.scheduled = False
+        self.render()
+
+    def flush(self):
+        """
+        Renders pending changes immediately, the already scheduled frame then finds nothing left to render
+        """
+        self.render()
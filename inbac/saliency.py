@@ -0,0 +1,121 @@
+from typing import Callable, Dict, Tuple
+
+from PIL import Image
+
+from inbac.cropping import NO_ORIENTATION, Orientation, orient_image
+
+try:
+    import numpy
+except ImportError:
+    # Optional dependency, the initial selection box stays in the corner without it
+    numpy = None
+
+# Longer side of the map the image content is scored on, in pixels
+SCORE_MAP_SIZE: int = 96
+# Number of gray levels the local entropy is computed from
+ENTROPY_LEVELS: int = 16
+# Radius of the neighbourhood the local entropy is computed in, in pixels of the score map
+ENTROPY_RADIUS: int = 3
+
+
+def is_available() -> bool:
+    return numpy is not None
+
+
+def box_sum(values, radius: int):
+    """
+    Sums the values in the (2 * radius + 1) square around every element, the edges are extended
+    """
+    padded = numpy.pad(values, radius, mode="edge")
+    table = numpy.zeros((padded.shape[0] + 1, padded.shape[1] + 1))
+    table[1:, 1:] = padded.cumsum(axis=0).cumsum(axis=1)
+    size: int = 2 * radius + 1
+    return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+
+def score_edges(gray):
+    """
+    Edge energy: sum of the absolute differences to the neighbouring pixels
+    """
+    energy = numpy.zeros_like(gray)
+    horizontal = numpy.abs(numpy.diff(gray, axis=1))
+    vertical = numpy.abs(numpy.diff(gray, axis=0))
+    energy[:, :-1] += horizontal
+    energy[:, 1:] += horizontal
+    energy[:-1, :] += vertical
+    energy[1:, :] += vertical
+    return energy
+
+
+def score_entropy(gray):
+    """
+    Entropy of the gray levels in the neighbourhood of every pixel, high in textured and detailed regions
+    """
+    levels = numpy.minimum((gray * (ENTROPY_LEVELS / 256)).astype(numpy.intp), ENTROPY_LEVELS - 1)
+    area: int = (2 * ENTROPY_RADIUS + 1) ** 2
+    entropy = numpy.zeros(gray.shape)
+    for level in range(ENTROPY_LEVELS):
+        probability = box_sum((levels == level).astype(numpy.float64), ENTROPY_RADIUS) / area
+        entropy -= probability * numpy.log2(numpy.where(probability > 0, probability, 1))
+    return entropy
+
+
+def score_saliency(gray):
+    """
+    Spectral residual saliency: the parts of the log amplitude spectrum which differ from its local average are
+    what stands out of the image
+    """
+    spectrum = numpy.fft.fft2(gray)
+    log_amplitude = numpy.log(numpy.abs(spectrum) + 1e-9)
+    residual = log_amplitude - box_sum(log_amplitude, 1) / 9
+    saliency = numpy.abs(numpy.fft.ifft2(numpy.exp(residual + 1j * numpy.angle(spectrum)))) ** 2
+    return box_sum(saliency, 2)
+
+
+SCORING_METHODS: Dict[str, Callable] = {
+    "edges": score_edges,
+    "entropy": score_entropy,
+    "saliency": score_saliency,
+}
+
+
+def score_image(image: Image.Image, method: str):
+    """
+    Scores the content of the (already downscaled) image on a small map, higher values are more interesting.
+    The map has the orientation of the image
+    """
+    gray: Image.Image = image.convert("L")
+    gray.thumbnail((SCORE_MAP_SIZE, SCORE_MAP_SIZE), Image.BILINEAR)
+    return SCORING_METHODS[method](numpy.asarray(gray, dtype=numpy.float32)).astype(numpy.float32)
+
+
+def find_best_position(scores, box_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Returns the top left corner of the box with the highest sum of scores, the first one if several are equal
+    """
+    height, width = scores.shape
+    box_width: int = min(max(box_size[0], 1), width)
+    box_height: int = min(max(box_size[1], 1), height)
+    table = numpy.zeros((height + 1, width + 1))
+    table[1:, 1:] = scores.cumsum(axis=0).cumsum(axis=1)
+    sums = (table[box_height:, box_width:] - table[:height + 1 - box_height, box_width:] -
+            table[box_height:, :width + 1 - box_width] + table[:height + 1 - box_height, :width + 1 - box_width])
+    top, left = numpy.unravel_index(numpy.argmax(sums), sums.shape)
+    return int(left), int(top)
+
+
+def suggest_position(scores,
+                     image_size: Tuple[int, int],
+                     box_size: Tuple[int, int],
+                     orientation: Orientation = NO_ORIENTATION) -> Tuple[int, int]:
+    """
+    Returns where to place a box of box_size on the displayed image of image_size, which is the scored image in the
+    orientation. The box stays within the image
+    """
+    oriented_scores = numpy.asarray(orient_image(Image.fromarray(scores), orientation))
+    scale_x: float = oriented_scores.shape[1] / image_size[0]
+    scale_y: float = oriented_scores.shape[0] / image_size[1]
+    left, top = find_best_position(
+        oriented_scores, (round(box_size[0] * scale_x), round(box_size[1] * scale_y)))
+    return (min(round(left / scale_x), max(image_size[0] - box_size[0], 0)),
+            min(round(top / scale_y), max(image_size[1] - box_size[1], 0)))
@@ -0,0 +1,172 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, Set, Tuple, Union
+
+from PIL import Image
+
+from inbac.cropping import (DEFAULT_REDUCING_GAP, NO_ORIENTATION, Orientation, Rendition, render_crop,
+                            render_renditions)
+from inbac.output_sink import OutputSink
+
+# A rendition and the path it's saved to
+RenditionOutput = Tuple[Rendition, str]
+
+
+class SaveTask():
+    """
+    A crop being saved, finished once the crop and all of its renditions are written
+    """
+
+    def __init__(self, output_path: str, encodes: int, sink: OutputSink, on_saved: Optional[Callable[[], None]]):
+        self.output_path: str = output_path
+        self.sink: OutputSink = sink
+        self.remaining: int = encodes
+        self.failed: bool = False
+        self.on_saved: Optional[Callable[[], None]] = on_saved
+
+
+class SaveQueue():
+    """
+    Crops, resizes, encodes and writes images on a pool of background threads, so saving doesn't block the UI.
+    When max_pending saves are in flight, submitting blocks until one of them finishes (backpressure). An image still
+    being decoded is given as a function returning it, which is called by the worker
+    """
+
+    def __init__(self, max_pending: int, workers: int, on_change: Optional[Callable[[], None]] = None):
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inbac-save")
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(max_pending)
+        self.lock: threading.Lock = threading.Lock()
+        self.idle: threading.Condition = threading.Condition(self.lock)
+        # Called from the worker threads whenever the queue depth or failures change
+        self.on_change: Optional[Callable[[], None]] = on_change
+        self.pending: int = 0
+        # Crops and renditions not handed to their output sink yet
+        self.encoding: int = 0
+        # Sinks which were handed crops since they were flushed last, sinks batching writes may still hold them
+        self.sinks: Set[OutputSink] = set()
+        self.failures: List[Tuple[str, str]] = []
+
+    def submit(self,
+               image: Union[Image.Image, Callable[[], Image.Image]],
+               box: Tuple[int, int, int, int],
+               output_path: str,
+               resize: Optional[Tuple[int, int]],
+               image_format: Optional[str],
+               image_quality: int,
+               resample: int = Image.LANCZOS,
+               reducing_gap: Optional[float] = DEFAULT_REDUCING_GAP,
+               orientation: Orientation = NO_ORIENTATION,
+               rendition_outputs: Sequence[RenditionOutput] = (),
+               on_saved: Optional[Callable[[], None]] = None,
+               sink: Optional[OutputSink] = None):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+            self.encoding += 1 + len(rendition_outputs)
+        self.notify()
+        task: SaveTask = SaveTask(output_path, 1 + len(rendition_outputs), sink or OutputSink(os.path.dirname(output_path)), on_saved)
+        self.executor.submit(self.run, task, image, box, resize, image_format, image_quality,
+                             resample, reducing_gap, orientation, rendition_outputs)
+
+    def run(self,
+            task: SaveTask,
+            image: Union[Image.Image, Callable[[], Image.Image]],
+            box: Tuple[int, int, int, int],
+            resize: Optional[Tuple[int, int]],
+            image_format: Optional[str],
+            image_quality: int,
+            resample: int,
+            reducing_gap: Optional[float],
+            orientation: Orientation,
+            rendition_outputs: Sequence[RenditionOutput]):
+        try:
+            if callable(image):
+                # The image is still being decoded, waited for here instead of on the submitting thread
+                image = image()
+            cropped_image: Image.Image = render_crop(image, box, resize, resample, reducing_gap, orientation)
+            rendition_images: List[Image.Image] = render_renditions(
+                image, box, cropped_image, [rendition.size for rendition, _ in rendition_outputs],
+                resample, reducing_gap, orientation)
+        except Exception as error:
+            with self.lock:
+                self.failures.append((task.output_path, str(error)))
+                task.failed = True
+                self.encoding -= task.remaining
+                self.idle.notify_all()
+            self.finish(task)
+            return
+        # The renditions are encoded concurrently by the other workers, the crop itself by this one
+        for rendition_image, (rendition, rendition_path) in zip(rendition_images, rendition_outputs):
+            self.executor.submit(self.encode, task, rendition_image, rendition_path, rendition.image_format,
+                                 rendition.image_quality or image_quality)
+        self.encode(task, cropped_image, task.output_path, image_format, image_quality)
+
+    def encode(self,
+               task: SaveTask,
+               image: Image.Image,
+               output_path: str,
+               image_format: Optional[str],
+               image_quality: int):
+        try:
+            task.sink.save(image, output_path, image_format, image_quality,
+                           lambda error: self.written(task, output_path, error))
+        except Exception as error:
+            self.written(task, output_path, error)
+        with self.lock:
+            self.encoding -= 1
+            self.sinks.add(task.sink)
+            self.idle.notify_all()
+
+    def written(self, task: SaveTask, output_path: str, error: Optional[Exception]):
+        """
+        Called by the output sink once the encoded image is written, which may be later than it's encoded
+        """
+        with self.lock:
+            if error is not None:
+                self.failures.append((output_path, str(error)))
+                task.failed = True
+            task.remaining -= 1
+            finished: bool = task.remaining == 0
+        if finished:
+            self.finish(task)
+
+    def finish(self, task: SaveTask):
+        try:
+            # Called on the worker thread, once the crop and all its renditions are completely written
+            if not task.failed and task.on_saved is not None:
+                task.on_saved()
+        except Exception as error:
+            with self.lock:
+                self.failures.append((task.output_path, str(error)))
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.idle.notify_all()
+            self.slots.release()
+            self.notify()
+
+    def status(self) -> Tuple[int, List[Tuple[str, str]]]:
+        with self.lock:
+            return self.pending, list(self.failures)
+
+    def notify(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def flush(self):
+        """
+        Blocks until all submitted saves are finished, crops collected by sinks batching writes are written
+        """
+        with self.lock:
+            self.idle.wait_for(lambda: self.encoding == 0)
+            sinks: List[OutputSink] = list(self.sinks)
+            self.sinks.clear()
+        for sink in sinks:
+            sink.flush()
+        with self.lock:
+            self.idle.wait_for(lambda: self.pending == 0)
+
+    def shutdown(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional, Sequence, Set, Union
+
+from PIL import Image, ImageOps
+
+from inbac.duplicates import ImageStat
+
+# Longer side of the thumbnails, in pixels
+THUMBNAIL_SIZE: int = 96
+THUMBNAIL_QUALITY: int = 85
+# Thumbnails kept in memory after they were loaded, so scrolling back doesn't read them again
+THUMBNAIL_MEMORY_ENTRIES: int = 512
+THUMBNAIL_WORKERS: int = 4
+
+
+def get_default_thumbnail_dir() -> str:
+    cache_home: str = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "inbac", "thumbnails")
+
+
+def create_thumbnail(image_file: Union[str, BinaryIO], size: int = THUMBNAIL_SIZE) -> Image.Image:
+    """
+    Scales the image down to fit a size x size square, in the orientation given by its EXIF data
+    """
+    with Image.open(image_file) as image:
+        # JPEG is decoded at up to 1/8 scale right away
+        image.draft("RGB", (size, size))
+        image.thumbnail((size, size), Image.BILINEAR, reducing_gap=2.0)
+        return ImageOps.exif_transpose(image).convert("RGB")
+
+
+class ThumbnailCache():
+    """
+    Thumbnails stored in the cache directory, named by a hash of the image path together with its size and
+    modification time: a modified image gets a new thumbnail. Without a cache directory thumbnails are only created
+    """
+
+    def __init__(self, cache_dir: Optional[str], size: int = THUMBNAIL_SIZE):
+        self.cache_dir: Optional[str] = cache_dir
+        self.size: int = size
+
+    def get_path(self, path: str, stat: ImageStat) -> str:
+        key: str = hashlib.sha1(
+            f"{os.path.abspath(path)}\0{stat[0]}\0{stat[1]}\0{self.size}".encode("utf-8", "surrogateescape")).hexdigest()
+        # Spread over subdirectories, so no directory grows too big
+        return os.path.join(self.cache_dir, key[:2], key + ".jpg")
+
+    def get(self, path: str, stat: ImageStat, open_image: Callable[[], Union[str, BinaryIO]]) -> Image.Image:
+        if self.cache_dir is None:
+            return create_thumbnail(open_image(), self.size)
+        thumbnail_path: str = self.get_path(path, stat)
+        try:
+            with Image.open(thumbnail_path) as cached_thumbnail:
+                cached_thumbnail.load()
+                return cached_thumbnail
+        except (OSError, ValueError):
+            pass
+        thumbnail: Image.Image = create_thumbnail(open_image(), self.size)
+        tmp_path: str = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            thumbnail.save(tmp_path, "JPEG", quality=THUMBNAIL_QUALITY)
+            os.replace(tmp_path, thumbnail_path)
+        except OSError:
+            # The cache is only an optimization
+            pass
+        return thumbnail
+
+
+class ThumbnailLoader():
+    """
+    Loads thumbnails on a pool of threads. Only the thumbnails requested last are loaded, requests of cells which were
+    scrolled away before a worker got to them are dropped. Loaded thumbnails are kept in a small LRU in memory
+    """
+
+    def __init__(self, workers: int = THUMBNAIL_WORKERS, max_entries: int = THUMBNAIL_MEMORY_ENTRIES):
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inbac-thumbnail")
+        self.max_entries: int = max_entries
+        self.lock: threading.Lock = threading.Lock()
+        self.wanted: Set[str] = set()
+        self.pending: Set[str] = set()
+        self.loaded: "OrderedDict[str, Image.Image]" = OrderedDict()
+
+    def request(self,
+                names: Sequence[str],
+                load: Callable[[str], Image.Image],
+                on_loaded: Callable[[str, Optional[Image.Image]], None]):
+        """
+        Replaces the requested thumbnails, on_loaded is called with every thumbnail (None if the image can't be read),
+        right away for the ones in memory
+        """
+        loaded: list = []
+        with self.lock:
+            self.wanted = set(names)
+            for name in names:
+                if name in self.loaded:
+                    self.loaded.move_to_end(name)
+                    loaded.append((name, self.loaded[name]))
+                elif name not in self.pending:
+                    self.pending.add(name)
+                    self.executor.submit(self.load_thumbnail, name, load, on_loaded)
+        for name, thumbnail in loaded:
+            on_loaded(name, thumbnail)
+
+    def load_thumbnail(self,
+                       name: str,
+                       load: Callable[[str], Image.Image],
+                       on_loaded: Callable[[str, Optional[Image.Image]], None]):
+        with self.lock:
+            if name not in self.wanted:
+                self.pending.discard(name)
+                return
+        thumbnail: Optional[Image.Image] = None
+        try:
+            thumbnail = load(name)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            pass
+        with self.lock:
+            self.pending.discard(name)
+            if thumbnail is not None:
+                self.loaded[name] = thumbnail
+                while len(self.loaded) > self.max_entries:
+                    self.loaded.popitem(last=False)
+        on_loaded(name, thumbnail)
+
+    def clear(self):
+        with self.lock:
+            self.wanted = set()
+            self.loaded.clear()
+
+    def shutdown(self):
+        self.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
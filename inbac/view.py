@@ -1,17 +1,34 @@
+import queue
 import tkinter as tk
 import types
 from tkinter import Tk, Frame, Canvas, Event, Menu, messagebox, filedialog, Toplevel
-from typing import Tuple, Any
+from typing import Tuple, Any, Callable, Optional
+from PIL import Image
 from PIL.ImageTk import PhotoImage
 import inbac
+from inbac.filmstrip import Filmstrip
+from inbac.rename_planner import InterruptedRenameError, RenameConflictError
+
+# How often callbacks queued by worker threads are run on the UI thread
+UI_CALLBACK_POLL_INTERVAL_MS: int = 15
 
 
 class View():
-    def __init__(self, master: Tk, controller, initial_window_size: Tuple[int, int], no_fullscreen: bool):
+    def __init__(self,
+                 master: Tk,
+                 controller,
+                 initial_window_size: Tuple[int, int],
+                 no_fullscreen: bool,
+                 filmstrip: bool = False):
         self.controller = controller
         self.master: Tk = master
         self.frame: Frame = tk.Frame(self.master, relief=tk.FLAT)
         self.frame.pack(fill=tk.BOTH, expand=tk.YES)
+        self.filmstrip: Optional[Filmstrip] = None
+        if filmstrip:
+            # Packed first, so the image canvas doesn't take its space
+            self.filmstrip = Filmstrip(self.frame, self.controller.go_to_image, self.controller.request_thumbnails)
+            self.filmstrip.pack()
         self.image_canvas: Canvas = Canvas(self.frame, highlightthickness=0)
         self.image_canvas.pack(fill=tk.BOTH, expand=tk.YES)
         self.master.geometry(
@@ -24,6 +41,10 @@ class View():
         self.bind_events()
         self.create_menu()
 
+        # Tkinter must only be used from the UI thread, worker threads queue their callbacks here
+        self.ui_callbacks: queue.Queue = queue.Queue()
+        self.process_ui_callbacks()
+
     def bind_events(self):
         self.master.bind('z', self.save_next)
         self.master.bind('<space>', self.save)
@@ -31,6 +52,9 @@ class View():
         self.master.bind('y', self.save)
         self.master.bind('c', self.rotate_image)
         self.master.bind('r', self.rotate_aspect_ratio)
+        self.master.bind('a', self.place_selection_box)
+        self.master.bind('d', self.skip_duplicate_group)
+        self.master.bind('n', self.next_unprocessed_image)
         self.master.bind('<Left>', self.previous_image)
         self.master.bind('<Right>', self.next_image)
         self.master.bind('<ButtonPress-3>', self.next_image)
@@ -61,12 +85,20 @@ class View():
             label="Settings", command=self.create_settings_window)
         self.menu.add_command(label="About", command=self.show_about_dialog)
         self.menu.add_separator()
-        self.menu.add_command(label="Exit", command=self.master.quit)
+        self.menu.add_command(label="Exit", command=self.exit)
         self.menu.add_command(label="\u22EE", activebackground=self.menu.cget("background"))
         self.menu.add_separator()
-        self.menu.add_command(label="Filename Gaps", command=self.show_filename_gaps_window)
+        # Gaps are renamed in a flat output directory, not inside of hashed subdirectories or shards
+        self.menu.add_command(
+            label="Filename Gaps",
+            command=self.show_filename_gaps_window,
+            state=tk.NORMAL if self.controller.supports_filename_gaps() else tk.DISABLED)
 
         self.master.config(menu=self.menu)
+        self.master.protocol("WM_DELETE_WINDOW", self.exit)
+
+    def exit(self):
+        self.controller.exit()
 
     def ask_directory(self) -> str:
         return filedialog.askdirectory(parent=self.master)
@@ -216,10 +248,18 @@ class View():
         messagebox.showinfo("About", "inbac " + inbac.__version__, parent=self.master)
     
     def remove_gaps_latest(self):
-        self.controller.remove_filename_gaps(self.controller.model.args.output_dir, process_all=False)
+        self.controller.invalidate_output_index()
+        try:
+            self.controller.remove_filename_gaps(self.controller.model.args.output_dir, process_all=False)
+        except (RenameConflictError, InterruptedRenameError) as error:
+            self.show_error("Filename Gaps", str(error))
     
     def remove_gaps_all(self):
-        self.controller.remove_filename_gaps(self.controller.model.args.output_dir)
+        self.controller.invalidate_output_index()
+        try:
+            self.controller.remove_filename_gaps(self.controller.model.args.output_dir)
+        except (RenameConflictError, InterruptedRenameError) as error:
+            self.show_error("Filename Gaps", str(error))
     
     def show_filename_gaps_window(self):
         insert_gaps_window = tk.Toplevel(self.master)
@@ -299,11 +339,40 @@ class View():
         gap_size = settings.gap_size.get()
         
         # Actually insert the gaps
-        self.controller.insert_filename_gaps(
-            self.controller.model.args.output_dir,
-            gap_index,
-            gap_size = gap_size
-        )
+        self.controller.invalidate_output_index()
+        try:
+            self.controller.insert_filename_gaps(
+                self.controller.model.args.output_dir,
+                gap_index,
+                gap_size = gap_size
+            )
+        except (RenameConflictError, InterruptedRenameError) as error:
+            self.show_error("Filename Gaps", str(error))
+
+    def run_on_ui_thread(self, callback: Callable[[], Any]):
+        """
+        Can be called from any thread, the callback is run on the UI thread as soon as possible
+        """
+        self.ui_callbacks.put(callback)
+
+    def process_ui_callbacks(self):
+        try:
+            while True:
+                callback = self.ui_callbacks.get_nowait()
+                callback()
+        except queue.Empty:
+            pass
+        finally:
+            self.master.after(UI_CALLBACK_POLL_INTERVAL_MS, self.process_ui_callbacks)
+
+    def schedule(self, delay_ms: int, callback: Callable[[], Any]) -> Any:
+        return self.master.after(delay_ms, callback)
+
+    def schedule_idle(self, callback: Callable[[], Any]) -> Any:
+        return self.master.after_idle(callback)
+
+    def cancel_scheduled(self, job: Any):
+        self.master.after_cancel(job)
 
     def show_error(self, title: str, message: str):
         messagebox.showerror(title, message, parent=self.master)
@@ -318,8 +387,8 @@ class View():
         return self.image_canvas.create_line(coords[0], coords[1], coords[2], coords[3], fill=fill, dash=dash)
 
     def create_rectangle(
-            self, box: Tuple[int, int, int, int], outline_color: str) -> Any:
-        return self.image_canvas.create_rectangle(box, outline=outline_color)
+            self, box: Tuple[int, int, int, int], outline_color: str, dash: Tuple[int, ...] = ()) -> Any:
+        return self.image_canvas.create_rectangle(box, outline=outline_color, dash=dash)
     
     def create_overlay(
             self, box: Tuple[int, int, int, int], outline="", fill="black", stipple="gray25") -> Any:
@@ -367,7 +436,7 @@ class View():
         self.controller.start_selection((event.x, event.y))
 
     def on_mouse_drag(self, event: Event):
-        self.controller.move_selection((event.x, event.y))
+        self.controller.request_move_selection((event.x, event.y))
 
     def on_mouse_up(self, event: Event):
         self.controller.stop_selection()
@@ -377,6 +446,7 @@ class View():
 
     def on_escape(self, event: Event):
         self.controller.clear_selection_box()
+        self.controller.clear_placed_boxes()
 
     def on_tab(self, event: Event):
         new_stipple = "gray25" if self.controller.model.overlay_stipple == "" else ""
@@ -390,9 +460,7 @@ class View():
         self.controller.previous_image()
 
     def on_resize(self, event: Event = None):
-        if self.controller.model.current_image is not None:
-            self.controller.display_image_on_canvas(
-                self.controller.model.current_image)
+        self.controller.on_canvas_resize()
 
     def save_next(self, event: Event = None):
         self.controller.save_next()
@@ -403,8 +471,25 @@ class View():
     def set_title(self, title: str):
         self.master.title(title)
 
+    def update_filmstrip(self, count: int, current: int, reset: bool):
+        if self.filmstrip is not None:
+            self.filmstrip.set_images(count, current, reset)
+
+    def show_thumbnail(self, position: int, thumbnail: Image.Image):
+        if self.filmstrip is not None:
+            self.filmstrip.show_thumbnail(position, thumbnail)
+
     def rotate_image(self, event: Event = None):
         self.controller.rotate_image()
 
     def rotate_aspect_ratio(self, event: Event = None):
         self.controller.rotate_aspect_ratio()
+
+    def place_selection_box(self, event: Event = None):
+        self.controller.place_selection_box()
+
+    def skip_duplicate_group(self, event: Event = None):
+        self.controller.skip_duplicate_group()
+
+    def next_unprocessed_image(self, event: Event = None):
+        self.controller.next_unprocessed_image()
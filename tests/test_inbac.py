@@ -1,12 +1,39 @@
+import contextlib
+import csv
+import hashlib
+import io
+import json
 import os
+import queue
+import tarfile
+import tempfile
+import threading
 import unittest
 import unittest.mock as mock
+import zipfile
 
+from benchmarks.bench_inbac import calculate_scaling, compare_results
 from inbac.inbac import Application
 from inbac.controller import Controller
+from inbac.directory_watcher import DirectoryWatcher, load_inotify
+from inbac import cropping, duplicates, gaps, image_index, image_source, profiler, saliency
+from inbac.batch import read_manifest
+from inbac.image_archive import ImageArchive, is_archive
+from inbac.journal import CropJournal, JOURNAL_FILENAME
+from inbac.large_image import LargeImage, MemoryBudget
+from inbac.image_cache import CachedImage, ImageCache, ImagePyramid, Prefetcher
 from inbac.model import Model
+from inbac.output_index import OutputIndex
+from inbac.output_sink import ShardSink, TarShardSink, ZipShardSink
+from inbac.parse_arguments import parse_arguments, parse_gaps_arguments
+from inbac.processed_images import ProcessedImages
+from inbac import rename_planner
+from inbac.rename_planner import RenamePlan, order_renames
+from inbac.save_queue import SaveQueue
+from inbac.thumbnail_cache import ThumbnailCache, ThumbnailLoader
+from inbac.filmstrip import CELL_SIZE, clamp_offset, get_visible_range
 
-from PIL import Image
+from PIL import Image, ImageOps
 
 
 class TestInbac(unittest.TestCase):
@@ -69,18 +96,18 @@ class TestInbac(unittest.TestCase):
             selected_box, (10, 10), (5, 5))
         self.assertEqual(expected_real_box, returned_real_box)
 
-    @mock.patch('inbac.inbac.os.listdir')
-    def test_load_images_with_wrong_filetype(self, mock_listdir):
-        mock_listdir.return_value = ["test.txt", "test2"]
-        returned_images = Controller.load_image_list("/home/test/")
-        self.assertListEqual([], returned_images)
+    def test_load_images_with_wrong_filetype(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["test.txt", "test2"])
+            returned_images = Controller.load_image_list(directory)
+            self.assertListEqual([], list(returned_images))
 
-    @mock.patch('inbac.inbac.os.listdir')
-    def test_load_images(self, mock_listdir):
-        mock_listdir.return_value = ["test.txt", "test2.jpg"]
-        directory = "/home/test/"
-        returned_images = Controller.load_image_list(directory)
-        self.assertListEqual(["test2.jpg"], returned_images)
+    def test_load_images(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["test.txt", "test2.jpg", "test10.JPG", "test1.png"])
+            os.mkdir(os.path.join(directory, "folder.jpg"))
+            returned_images = Controller.load_image_list(directory)
+            self.assertListEqual(["test1.png", "test2.jpg", "test10.JPG"], list(returned_images))
 
     @mock.patch('inbac.controller.Image.open')
     @mock.patch('inbac.controller.Controller.display_image_on_canvas')
@@ -172,7 +199,933 @@ class TestInbac(unittest.TestCase):
         mock_display_image.assert_called()
         self.assertEqual(rotated_image.width, 4)
         self.assertEqual(rotated_image.height, 8)
-        
+
+    def test_image_cache_evicts_least_recently_used_entries(self):
+        image = Image.new("RGB", (10, 10))
+        entry_size = CachedImage(image, image, (10, 10)).size_in_bytes
+        cache = ImageCache(entry_size * 2)
+        cache.put("a.jpg", CachedImage(image, image, (10, 10)))
+        cache.put("b.jpg", CachedImage(image, image, (10, 10)))
+        cache.get("a.jpg")
+        cache.put("c.jpg", CachedImage(image, image, (10, 10)))
+        self.assertIn("a.jpg", cache)
+        self.assertNotIn("b.jpg", cache)
+        self.assertIn("c.jpg", cache)
+        self.assertEqual(entry_size * 2, cache.used_bytes)
+
+    def test_prefetcher_serves_prefetched_images_from_cache(self):
+        image = Image.new("RGB", (10, 10))
+        loader = mock.Mock(side_effect=lambda name, canvas_size: CachedImage(image, image, canvas_size))
+        prefetcher = Prefetcher(ImageCache(1024 * 1024), loader, 1, workers=1)
+        images = ["a.jpg", "b.jpg", "c.jpg"]
+        prefetcher.get("a.jpg", (5, 5))
+        prefetcher.prefetch(images, 0, (5, 5))
+        prefetcher.get("b.jpg", (5, 5))
+        prefetcher.shutdown()
+        self.assertEqual(1, prefetcher.hits)
+        self.assertEqual(1, prefetcher.misses)
+        self.assertEqual(2, loader.call_count)
+
+    def test_prefetcher_decodes_images_too_big_for_cache_once(self):
+        image = Image.new("RGB", (10, 10))
+        loader = mock.Mock(side_effect=lambda name, canvas_size: CachedImage(image, image, canvas_size))
+        prefetcher = Prefetcher(ImageCache(1), loader, 1, workers=1)
+        images = ["a.jpg", "b.jpg", "c.jpg"]
+        prefetcher.get("a.jpg", (5, 5))
+        prefetcher.prefetch(images, 0, (5, 5))
+        prefetcher.get("b.jpg", (5, 5))
+        prefetcher.prefetch(images, 1, (5, 5))
+        prefetcher.get("a.jpg", (5, 5))
+        prefetcher.prefetch(images, 0, (5, 5))
+        prefetcher.get("b.jpg", (5, 5))
+        prefetcher.executor.shutdown(wait=True)
+        decoded = [call[0][0] for call in loader.call_args_list]
+        # c.jpg may have been cancelled before it was decoded, but no image is decoded twice
+        self.assertEqual(len(set(decoded)), len(decoded))
+        self.assertTrue({"a.jpg", "b.jpg"} <= set(decoded))
+        prefetcher.shutdown()
+
+    def test_prepare_draft_image_decodes_jpeg_at_reduced_scale(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jpeg_path = os.path.join(directory, "test.jpg")
+            png_path = os.path.join(directory, "test.png")
+            Image.new("RGB", (1600, 1200)).save(jpeg_path)
+            Image.new("RGB", (1600, 1200)).save(png_path)
+            draft_image = Controller.prepare_draft_image(jpeg_path, (400, 300))
+            self.assertEqual((400, 300), draft_image.size)
+            draft_image.close()
+            self.assertIsNone(Controller.prepare_draft_image(png_path, (400, 300)))
+
+    def test_save_queue_saves_in_background_and_records_failures(self):
+        with tempfile.TemporaryDirectory() as directory:
+            save_queue = SaveQueue(2, 2)
+            image = Image.new("RGB", (100, 100))
+            output_path = os.path.join(directory, "test_crop1.jpg")
+            save_queue.submit(image, (0, 0, 50, 50), output_path, (10, 10), None, 90)
+            save_queue.submit(image, (0, 0, 50, 50), os.path.join(directory, "missing", "test_crop2.jpg"), None, None, 90)
+            save_queue.shutdown()
+            pending, failures = save_queue.status()
+            self.assertEqual(0, pending)
+            self.assertEqual(1, len(failures))
+            with Image.open(output_path) as saved_image:
+                self.assertEqual((10, 10), saved_image.size)
+
+    def test_queue_and_cache_sizes_are_validated(self):
+        args = parse_arguments(["--save_queue_size", "1", "--save_workers", "1", "--prefetch", "0", "--cache_size", "0"])
+        self.assertEqual((1, 1, 0, 0), (args.save_queue_size, args.save_workers, args.prefetch, args.cache_size))
+        for option, value in (("--save_queue_size", "0"), ("--save_workers", "0"), ("--prefetch", "-1"),
+                              ("--cache_size", "-1")):
+            with mock.patch("sys.stderr", new_callable=io.StringIO), self.assertRaises(SystemExit):
+                parse_arguments([option, value])
+
+    def test_image_pyramid_scales_from_nearest_level(self):
+        pyramid = ImagePyramid(Image.new("RGB", (1000, 800)))
+        level = pyramid.nearest_level((200, 160))
+        self.assertEqual((250, 200), level.size)
+        self.assertEqual((200, 160), pyramid.scale((200, 160)).size)
+        self.assertEqual((1000, 800), pyramid.nearest_level((900, 700)).size)
+
+    @mock.patch('inbac.controller.Controller.move_selection')
+    def test_mouse_motion_is_rendered_once_per_frame(self, mock_move_selection):
+        controller = Controller(Model(parse_arguments([])))
+        controller.view = mock.Mock()
+        controller.request_move_selection((1, 1))
+        controller.request_move_selection((5, 7))
+        controller.view.schedule.assert_called_once()
+        _, render_frame = controller.view.schedule.call_args[0]
+        render_frame()
+        mock_move_selection.assert_called_once_with((5, 7))
+        controller.prefetcher.shutdown()
+
+    def test_read_manifest_skips_invalid_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            manifest_path = os.path.join(directory, "manifest.csv")
+            with open(manifest_path, "w") as manifest:
+                manifest.write("source,left,top,right,bottom,rotation,resize_width,resize_height\n")
+                manifest.write("a.jpg,0,0,10,20,90,5,10\n")
+                manifest.write("b.jpg,x,0,10,20,,,\n")
+                manifest.write("c.jpg,1,2,3,4,,,\n")
+            invalid_lines = []
+            records = list(read_manifest(manifest_path, lambda line, error: invalid_lines.append(line)))
+            self.assertEqual(["a.jpg", "c.jpg"], [record.source for record in records])
+            self.assertEqual((0, 0, 10, 20), records[0].box)
+            self.assertEqual(90, records[0].rotation)
+            self.assertEqual((5, 10), records[0].resize)
+            self.assertIsNone(records[1].resize)
+            self.assertEqual([3], invalid_lines)
+
+    def test_crop_journal_returns_last_complete_entry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = CropJournal(directory)
+            for index in range(1000):
+                journal.append(f"image{index}.jpg", (0, 0, 10, 10), 0, None, None, 100, f"image{index}_crop1.jpg")
+            journal.close()
+            # Simulate a crash while writing the last entry
+            with open(os.path.join(directory, JOURNAL_FILENAME), "a") as journal_file:
+                journal_file.write('{"source": "image1000.j')
+            last_entry = CropJournal.read_last_entry(directory)
+            self.assertEqual("image999.jpg", last_entry["source"])
+            self.assertEqual([0, 0, 10, 10], last_entry["box"])
+            self.assertIsNone(CropJournal.read_last_entry(os.path.join(directory, "missing")))
+            journal.append("image1001.jpg", (0, 0, 10, 10), 0, None, None, 100, "image1001_crop1.jpg")
+            journal.close()
+            self.assertEqual("image1001.jpg", CropJournal.read_last_entry(directory)["source"])
+            last_entries = CropJournal.read_last_entries(directory, 100)
+            self.assertEqual(["image1001.jpg"] + [f"image{index}.jpg" for index in range(999, 900, -1)],
+                             [entry["source"] for entry in last_entries])
+            self.assertEqual(1001, len(CropJournal.read_last_entries(directory, 2000)))
+
+    def test_resume_position_is_after_furthest_saved_image(self):
+        with tempfile.TemporaryDirectory() as directory:
+            controller = Controller(Model(parse_arguments([directory, directory, "--prefetch", "0"])))
+            controller.model.images = image_index.NameList([f"image{index}.jpg" for index in range(10)])
+            journal = CropJournal(directory)
+            # Saves finish out of order on the save workers
+            for index in (3, 5, 4):
+                journal.append(f"image{index}.jpg", (0, 0, 10, 10), 0, None, None, 100, f"image{index}_crop1.jpg")
+            journal.close()
+            self.assertEqual(6, controller.find_resume_position())
+            controller.prefetcher.shutdown()
+
+    def test_image_index_is_invalidated_by_directory_changes(self):
+        with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as cache_dir:
+            create_files(directory, ["b.jpg", "a.jpg"])
+            self.assertEqual(["a.jpg", "b.jpg"], list(image_index.list_images(directory, cache_dir)))
+            self.assertEqual(["a.jpg", "b.jpg"], list(image_index.load_index(cache_dir, directory)))
+            create_files(directory, ["c.jpg"])
+            os.utime(directory, ns=(0, 0))
+            self.assertIsNone(image_index.load_index(cache_dir, directory))
+            self.assertEqual(["a.jpg", "b.jpg", "c.jpg"], list(image_index.list_images(directory, cache_dir)))
+
+    def test_name_list(self):
+        names = image_index.NameList(["a.jpg", "b.jpg", "c d.png"])
+        self.assertEqual(3, len(names))
+        self.assertEqual("c d.png", names[2])
+        self.assertEqual("c d.png", names[-1])
+        self.assertEqual(1, names.index("b.jpg"))
+        self.assertIn("a.jpg", names)
+        self.assertNotIn("a", names)
+        self.assertEqual(["a.jpg", "b.jpg", "c d.png"], list(names))
+
+    def test_output_index_allocates_next_crop_number(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["test_crop1.jpg", "test_crop7.png", "other_crop2.jpg", "test.jpg", "test_crop8.webp"])
+            output_index = OutputIndex(directory)
+            # Crops in every output format are counted
+            self.assertEqual(8, output_index.highest_crop_number("test.jpg"))
+            self.assertEqual("test_crop9.webp", output_index.allocate("test.jpg", "webp"))
+            self.assertEqual("test_crop10.jpg", output_index.allocate("test.jpg"))
+            self.assertEqual("other_crop3.png", output_index.allocate("other.jpg", "PNG"))
+            self.assertEqual("new_crop1.jpg", output_index.allocate("new.jpg"))
+
+    def test_output_index_of_missing_directory_is_empty(self):
+        output_index = OutputIndex("/home/test/missing/")
+        self.assertEqual("test_crop1.jpg", output_index.allocate("test.jpg"))
+
+    def test_find_available_name_scans_output_directory_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["test_crop1.jpg"])
+            controller = Controller(Model(parse_arguments([directory, directory, "--prefetch", "0"])))
+            with mock.patch("os.scandir", side_effect=os.scandir) as mock_scandir:
+                self.assertEqual("test_crop2.jpg", controller.find_available_name(directory, "test.jpg"))
+                self.assertEqual("test_crop3.jpg", controller.find_available_name(directory, "test.jpg"))
+                self.assertEqual("test_crop4.jpg", controller.get_output_index().allocate("test.jpg"))
+            self.assertEqual(1, mock_scandir.call_count)
+            controller.prefetcher.shutdown()
+
+    def test_order_renames_breaks_cycles(self):
+        renames = {"a_crop1.jpg": "a_crop2.jpg", "a_crop2.jpg": "a_crop1.jpg", "a_crop3.jpg": "a_crop4.jpg"}
+        steps = order_renames(renames, set(renames))
+        files = set(renames)
+        for old, new in steps:
+            self.assertNotIn(new, files)
+            files.remove(old)
+            files.add(new)
+        self.assertEqual({"a_crop1.jpg", "a_crop2.jpg", "a_crop4.jpg"}, files)
+
+    def test_order_renames_refuses_to_overwrite(self):
+        with self.assertRaises(rename_planner.RenameConflictError):
+            order_renames({"a_crop1.jpg": "a_crop2.jpg"}, {"a_crop1.jpg", "a_crop2.jpg"})
+
+    def test_remove_filename_gaps_keeps_suffix(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["a_crop2.jpg", "a_crop5_x.png", "b_crop3.jpg", "notes.txt"])
+            rename_planner.plan_remove_filename_gaps(directory).execute()
+            self.assertEqual(["a_crop1.jpg", "a_crop2_x.png", "b_crop1.jpg", "notes.txt"],
+                             sorted(os.listdir(directory)))
+
+    def test_insert_filename_gaps_resumes_interrupted_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["a_crop1.jpg", "a_crop2.jpg", "a_crop3.jpg"])
+            self.interrupt_insert_filename_gaps(directory)
+            with self.assertRaises(rename_planner.InterruptedRenameError):
+                rename_planner.plan_remove_filename_gaps(directory)
+            interrupted = RenamePlan.load_interrupted(directory)
+            self.assertEqual(1, interrupted.completed)
+            interrupted.rollback()
+            self.assertEqual(["a_crop1.jpg", "a_crop2.jpg", "a_crop3.jpg"], sorted(os.listdir(directory)))
+
+            self.interrupt_insert_filename_gaps(directory)
+            RenamePlan.load_interrupted(directory).execute()
+            self.assertIsNone(RenamePlan.load_interrupted(directory))
+            self.assertEqual(["a_crop1.jpg", "a_crop3.jpg", "a_crop4.jpg"], sorted(os.listdir(directory)))
+
+    def interrupt_insert_filename_gaps(self, directory):
+        plan = rename_planner.plan_insert_filename_gaps(directory, 1, gap_size=1)
+        rename = os.rename
+        renames = iter([rename, mock.Mock(side_effect=OSError("interrupted"))])
+        with mock.patch("os.rename", side_effect=lambda old, new: next(renames)(old, new)):
+            with self.assertRaises(OSError):
+                plan.execute()
+
+    def test_gaps_exits_with_error_when_renames_fail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            create_files(directory, ["a_crop1.jpg", "a_crop2.jpg", "a_crop3.jpg"])
+            self.interrupt_insert_filename_gaps(directory)
+            with mock.patch("sys.stderr", new_callable=io.StringIO):
+                self.assertFalse(gaps.process_directory(directory, parse_gaps_arguments([directory])))
+                with mock.patch("sys.argv", ["inbac-gaps", directory]):
+                    with self.assertRaises(SystemExit) as raised:
+                        gaps.main()
+            self.assertEqual(1, raised.exception.code)
+            with mock.patch("sys.stdout", new_callable=io.StringIO):
+                self.assertTrue(gaps.process_directory(directory, parse_gaps_arguments(["--rollback", directory])))
+
+    def test_benchmark_results_report_scaling_and_regressions(self):
+        baseline = [{"stage": "save", "params": {"megapixels": 2.0}, "median": 0.1},
+                    {"stage": "save", "params": {"megapixels": 8.0}, "median": 0.4}]
+        results = [{"stage": "save", "params": {"megapixels": 2.0}, "median": 0.11},
+                   {"stage": "save", "params": {"megapixels": 8.0}, "median": 0.8}]
+        regressions = compare_results(results, baseline, 1.25)
+        self.assertEqual([{"megapixels": 8.0}], [regression["params"] for regression in regressions])
+        self.assertAlmostEqual(1.0, calculate_scaling(baseline)[0]["exponent"])
+
+    def test_profiler_writes_trace_and_percentile_summary(self):
+        self.assertIs(profiler.NULL_SPAN, profiler.span("decode"))
+        active_profiler = profiler.enable()
+        try:
+            for _ in range(3):
+                with profiler.span("decode"):
+                    pass
+            with tempfile.TemporaryDirectory() as directory:
+                trace_path = os.path.join(directory, "trace.json")
+                active_profiler.write(trace_path)
+                with open(trace_path) as trace_file:
+                    trace = json.load(trace_file)
+                with open(os.path.join(directory, "trace.csv")) as summary_file:
+                    summary = list(csv.DictReader(summary_file))
+        finally:
+            profiler.disable()
+        self.assertEqual(3, len([event for event in trace["traceEvents"] if event["ph"] == "X"]))
+        self.assertEqual(["decode"], [row["stage"] for row in summary])
+        self.assertEqual("3", summary[0]["count"])
+
+    def test_profiler_keeps_only_latest_spans(self):
+        bounded_profiler = profiler.Profiler(max_events=2)
+        for duration_ns in (1000000, 2000000, 3000000):
+            bounded_profiler.record("decode", 0, duration_ns)
+        bounded_profiler.record("save", 0, 4000000)
+        self.assertEqual([("decode", 3000000), ("save", 4000000)],
+                         [(name, duration_ns) for name, _, duration_ns, _ in bounded_profiler.events])
+        with tempfile.TemporaryDirectory() as directory:
+            summary_path = os.path.join(directory, "trace.csv")
+            bounded_profiler.write_summary(summary_path)
+            with open(summary_path) as summary_file:
+                summary = {row["stage"]: row for row in csv.DictReader(summary_file)}
+        self.assertEqual(("3", "6.000", "3.000"),
+                         (summary["decode"]["count"], summary["decode"]["total_ms"], summary["decode"]["max_ms"]))
+        self.assertEqual("3.000", summary["decode"]["p50_ms"])
+
+    def test_crop_image_reads_box_without_copying_the_image(self):
+        image = Image.new("RGB", (400, 300), "red")
+        image.paste("blue", (0, 0, 200, 300))
+        cropped_image = cropping.crop_image(image, (0, 0, 200, 200), (20, 20))
+        self.assertEqual((20, 20), cropped_image.size)
+        self.assertEqual((0, 0, 255), cropped_image.getpixel((10, 10)))
+        padded_image = cropping.crop_image(image, (300, 200, 500, 400), (20, 20))
+        self.assertEqual((0, 0, 0), padded_image.getpixel((15, 15)))
+
+    def test_draft_for_resize_decodes_jpeg_at_reduced_scale(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.jpg")
+            Image.new("RGB", (2000, 1600), "red").save(path)
+            with Image.open(path) as image:
+                self.assertTrue(cropping.draft_for_resize(image, (0, 0, 1600, 1600), (100, 100)))
+                self.assertEqual((500, 400), image.size)
+                self.assertEqual((0, 0, 400, 400), cropping.scale_box((0, 0, 1600, 1600), (2000, 1600), image.size))
+            with Image.open(path) as image:
+                self.assertFalse(cropping.draft_for_resize(image, (0, 0, 1600, 1600), (1000, 1000)))
+                self.assertEqual((2000, 1600), image.size)
+
+    def test_large_image_decodes_only_the_cropped_region(self):
+        with tempfile.TemporaryDirectory() as directory:
+            original = Image.effect_noise((100, 80), 50).convert("RGB").resize((301, 201))
+            for filename in ("test.bmp", "test.ppm", "test.tif", "test.png"):
+                path = os.path.join(directory, filename)
+                original.save(path)
+                # Uncompressed images must never be decoded completely, this fails if Pillow describes them differently
+                full_decode = mock.patch("PIL.ImageFile.ImageFile.load", side_effect=AssertionError(filename)) \
+                    if filename != "test.png" else contextlib.nullcontext()
+                with full_decode, mock.patch("inbac.large_image.PREVIEW_BAND_BYTES", 301 * 3 * 7):
+                    image = LargeImage.open(path, (100, 60), MemoryBudget(1024 * 1024))
+                    self.assertEqual(original.reduce(3).tobytes(), image.preview.tobytes())
+                    box = (20, 10, 320, 150)
+                    self.assertEqual(original.crop(box).tobytes(), image.crop(box).tobytes())
+
+    def test_prepare_image_keeps_only_preview_of_large_images(self):
+        with tempfile.TemporaryDirectory() as directory:
+            Image.new("RGB", (1200, 900)).save(os.path.join(directory, "test.bmp"))
+            controller = Controller(Model(parse_arguments([directory, "--memory_limit", "16"])))
+            cached_image = controller.prepare_image("test.bmp", (200, 150))
+            controller.prefetcher.shutdown()
+            self.assertIsInstance(cached_image.image, LargeImage)
+            self.assertEqual((600, 450), cached_image.image.preview.size)
+            self.assertEqual((200, 150), cached_image.display_image.size)
+            cropped_image = cropping.crop_image(cached_image.image, (100, 100, 700, 500), (60, 40))
+            self.assertEqual((60, 40), cropped_image.size)
+
+    def test_save_cropped_image_transforms_only_the_region(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exif = Image.Exif()
+            exif[cropping.EXIF_ORIENTATION_TAG] = 5
+            path = os.path.join(directory, "test.png")
+            Image.effect_noise((40, 30), 50).save(path, exif=exif)
+            output_path = os.path.join(directory, "test_crop1.png")
+            with Image.open(path) as image:
+                orientation = cropping.rotate_orientation(cropping.get_exif_orientation(image), 90)
+                self.assertEqual((True, 180), orientation)
+                box = (5, 10, 25, 20)
+                cropping.save_cropped_image(
+                    image, cropping.unorient_box(box, orientation, image.size), output_path, None, None, 90,
+                    orientation=orientation)
+                expected_image = ImageOps.exif_transpose(image).transpose(Image.ROTATE_90).crop(box)
+            with Image.open(output_path) as saved_image:
+                self.assertEqual(expected_image.tobytes(), saved_image.tobytes())
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_rotate_image_keeps_original_and_rotates_display(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            Image.new("RGB", (400, 200)).save(os.path.join(directory, "test.png"))
+            controller = Controller(Model(parse_arguments([directory, "--prefetch", "0", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            controller.load_images()
+            original = controller.model.current_image
+            controller.rotate_image()
+            controller.prefetcher.shutdown()
+            self.assertIs(original, controller.model.current_image)
+            self.assertEqual((400, 200), original.size)
+            self.assertEqual((100, 200), controller.model.canvas_image_dimensions)
+            self.assertEqual((100, 200), mock_photo_image.call_args[0][0].size)
+            self.assertEqual({"test.png": 90}, controller.model.rotations)
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_save_exports_placed_boxes_and_selection_together(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            image = Image.new("RGB", (400, 200))
+            image.paste((255, 0, 0), (0, 0, 200, 200))
+            image.save(os.path.join(directory, "test.png"))
+            output_dir = os.path.join(directory, "crops")
+            controller = Controller(Model(parse_arguments(
+                [directory, output_dir, "--prefetch", "0", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            controller.load_images()
+            controller.model.selection_box = mock.Mock()
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+            controller.place_selection_box()
+            self.assertEqual([(0, 0, 100, 100)], controller.model.placed_boxes)
+            self.assertIsNone(controller.model.selection_box)
+            controller.model.selection_box = mock.Mock()
+            controller.view.get_canvas_object_coords.return_value = (150, 50, 200, 100)
+            self.assertTrue(controller.save())
+            controller.save_queue.flush()
+            controller.prefetcher.shutdown()
+            self.assertEqual([], controller.model.placed_boxes)
+            self.assertEqual(["test_crop1.png", "test_crop2.png"],
+                             sorted(name for name in os.listdir(output_dir) if name != JOURNAL_FILENAME))
+            with Image.open(os.path.join(output_dir, "test_crop1.png")) as first_crop:
+                self.assertEqual((255, 0, 0), first_crop.getpixel((50, 50)))
+            with Image.open(os.path.join(output_dir, "test_crop2.png")) as second_crop:
+                self.assertEqual((0, 0, 0), second_crop.getpixel((50, 50)))
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_save_of_draft_waits_for_decode_on_save_worker(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            Image.new("RGB", (1600, 1200), (0, 128, 0)).save(os.path.join(directory, "test.jpg"))
+            controller = Controller(Model(parse_arguments(
+                [directory, os.path.join(directory, "crops"), "--progressive", "--prefetch", "0", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            decode = threading.Event()
+            prepare_image = controller.prepare_image
+            controller.prefetcher.loader = lambda name, canvas_size: decode.wait() and prepare_image(name, canvas_size)
+            try:
+                controller.load_images()
+                draft_original = controller.model.current_image
+                draft_original.load = mock.Mock()
+                controller.model.selection_box = mock.Mock()
+                controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+                self.assertTrue(controller.save())
+                # The draft original isn't decoded on the UI thread
+                draft_original.load.assert_not_called()
+            finally:
+                decode.set()
+            controller.save_queue.flush()
+            controller.prefetcher.shutdown()
+            controller.journal.close()
+            self.assertEqual([], controller.save_queue.status()[1])
+            with Image.open(os.path.join(directory, "crops", "test_crop1.jpg")) as crop:
+                red, green, blue = crop.getpixel((crop.width // 2, crop.height // 2))
+                self.assertTrue(red < 10 and 118 < green < 138 and blue < 10, (red, green, blue))
+
+    def test_save_queue_saves_renditions_of_the_crop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "previews"))
+            save_queue = SaveQueue(2, 2)
+            on_saved = mock.Mock()
+            rendition_outputs = [
+                (cropping.Rendition((10, 20), subfolder="thumbnails"), os.path.join(directory, "missing", "test_crop1.jpg")),
+                (cropping.Rendition((40, 80), "PNG", subfolder="previews"), os.path.join(directory, "previews", "test_crop1.png")),
+            ]
+            resize = Image.Image.resize
+            with mock.patch("PIL.Image.Image.resize", autospec=True, side_effect=resize) as mock_resize:
+                save_queue.submit(Image.new("RGB", (400, 400)), (0, 0, 200, 400), os.path.join(directory, "test_crop1.jpg"),
+                                  (100, 200), None, 90, rendition_outputs=rendition_outputs, on_saved=on_saved)
+                save_queue.flush()
+            save_queue.shutdown()
+            # Every rendition is resized from the next bigger one
+            self.assertEqual([(400, 400), (100, 200), (40, 80)], [call[0][0].size for call in mock_resize.call_args_list])
+            with Image.open(os.path.join(directory, "previews", "test_crop1.png")) as preview:
+                self.assertEqual(("PNG", (40, 80)), (preview.format, preview.size))
+            self.assertEqual([os.path.join(directory, "missing", "test_crop1.jpg")],
+                             [path for path, _ in save_queue.status()[1]])
+            on_saved.assert_not_called()
+
+    @mock.patch("inbac.directory_watcher.POLL_INTERVAL", 0.02)
+    def test_directory_watcher_reports_added_removed_and_renamed_images(self):
+        for use_inotify in (True, False):
+            with tempfile.TemporaryDirectory() as directory:
+                Image.new("RGB", (10, 10)).save(os.path.join(directory, "a.png"))
+                changes = queue.Queue()
+                watcher = DirectoryWatcher(directory, lambda added, removed: changes.put((added, removed)), use_inotify)
+                Image.new("RGB", (10, 10)).save(os.path.join(directory, "b.png"))
+                self.assertEqual(({"b.png"}, set()), changes.get(timeout=5))
+                os.rename(os.path.join(directory, "a.png"), os.path.join(directory, "c.png"))
+                self.assertEqual(({"c.png"}, {"a.png"}), changes.get(timeout=5))
+                watcher.stop()
+                watcher.thread.join()
+
+    @mock.patch("inbac.directory_watcher.POLL_INTERVAL", 0.02)
+    def test_directory_watcher_polls_without_inotify(self):
+        with mock.patch("sys.platform", "win32"):
+            self.assertIsNone(load_inotify())
+        with mock.patch("sys.platform", "linux"), mock.patch("ctypes.util.find_library", return_value=None):
+            self.assertIsNone(load_inotify())
+        with tempfile.TemporaryDirectory() as directory, mock.patch("sys.platform", "win32"):
+            watcher = DirectoryWatcher(directory, lambda added, removed: None)
+            self.assertIsNone(watcher.inotify_fd)
+            watcher.stop()
+            watcher.thread.join()
+
+    @mock.patch('inbac.controller.Controller.load_image')
+    def test_directory_changes_are_merged_keeping_position(self, mock_load_image):
+        controller = Controller(Model(parse_arguments([])))
+        controller.view = mock.Mock()
+        controller.model.images = image_index.NameList(["img1.jpg", "img3.jpg", "img10.jpg"])
+        controller.model.current_file = 1
+        controller.model.current_image = Image.new("RGB", (10, 10))
+        controller.model.canvas_image_dimensions = (10, 10)
+        generation = controller.model.images_generation
+        controller.apply_directory_changes({"img2.jpg", "img20.jpg"}, {"img1.jpg"}, generation)
+        self.assertEqual(["img2.jpg", "img3.jpg", "img10.jpg", "img20.jpg"], list(controller.model.images))
+        self.assertEqual(1, controller.model.current_file)
+        mock_load_image.assert_not_called()
+        controller.apply_directory_changes(set(), {"img3.jpg"}, generation)
+        self.assertEqual(1, controller.model.current_file)
+        mock_load_image.assert_called_once_with("img10.jpg")
+        controller.apply_directory_changes({"img4.jpg"}, set(), generation + 1)
+        self.assertNotIn("img4.jpg", controller.model.images)
+        controller.prefetcher.shutdown()
+
+    def test_image_sources_walk_tree_lazily_with_filters(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for path in ("b.jpg", "a10.jpg", "a2.jpg", "notes.txt", "sub/x.png", "sub/skip/y.jpg", "crops/c.jpg",
+                         "raw/z.jpg"):
+                os.makedirs(os.path.dirname(os.path.join(directory, path)), exist_ok=True)
+                open(os.path.join(directory, path), "w").close()
+            names = image_source.LazyNameList(image_source.walk_image_tree(
+                directory, exclude=["raw", "*/skip"], skipped_directories={os.path.join(directory, "crops")}))
+            names.thread.join()
+            self.assertEqual(["a2.jpg", "a10.jpg", "b.jpg", os.path.join("sub", "x.png")], list(names))
+            self.assertEqual(3, names.index(os.path.join("sub", "x.png")))
+            self.assertEqual(["b.jpg"], list(image_source.walk_image_tree(directory, include=["b*"])))
+            file_list = os.path.join(directory, "list.txt")
+            with open(file_list, "w", encoding="utf-8") as list_file:
+                list_file.write(f"{os.path.join(directory, 'sub', 'x.png')}\nb.jpg\nnotes.txt\n")
+            self.assertEqual([os.path.join("sub", "x.png"), "b.jpg"],
+                             list(image_source.read_file_list(file_list, directory)))
+        self.assertEqual("", image_source.get_output_subdirectory(os.path.join(os.pardir, "x.png")))
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_recursive_save_mirrors_the_input_tree(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, "day1"))
+            Image.new("RGB", (200, 200)).save(os.path.join(directory, "day1", "test.png"))
+            output_dir = os.path.join(directory, "crops")
+            controller = Controller(Model(parse_arguments(
+                [directory, output_dir, "--recursive", "--prefetch", "0"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            controller.load_images()
+            controller.image_source.thread.join()
+            self.assertEqual([os.path.join("day1", "test.png")], list(controller.model.images))
+            controller.model.selection_box = mock.Mock()
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+            self.assertTrue(controller.save())
+            controller.save_queue.flush()
+            controller.prefetcher.shutdown()
+            controller.journal.close()
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, "day1", "test_crop1.png")))
+            self.assertEqual(os.path.join("day1", "test.png"), CropJournal.read_last_entry(output_dir)["source"])
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_resume_is_applied_once_recursive_listing_is_complete(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            names = ["a.png", "b.png", "c.png"]
+            for name in names:
+                Image.new("RGB", (20, 20)).save(os.path.join(directory, name))
+            output_dir = os.path.join(directory, "crops")
+            os.makedirs(output_dir)
+            journal = CropJournal(output_dir)
+            journal.append("b.png", (0, 0, 10, 10), 0, None, None, 100, "b_crop1.png")
+            journal.close()
+            listed_first = threading.Event()
+
+            def list_slowly(*args):
+                yield names[0]
+                listed_first.wait()
+                yield from names[1:]
+
+            controller = Controller(Model(parse_arguments([directory, output_dir, "--recursive", "--prefetch", "0"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            with mock.patch("inbac.image_source.create_image_source", side_effect=list_slowly):
+                controller.load_images()
+            # b.png isn't listed yet
+            self.assertEqual(0, controller.model.current_file)
+            listed_first.set()
+            controller.image_source.thread.join()
+            for call in controller.view.run_on_ui_thread.call_args_list:
+                call[0][0]()
+            self.assertEqual(2, controller.model.current_file)
+            self.assertFalse(controller.model.resume_pending)
+            controller.prefetcher.shutdown()
+
+    def test_image_archive_reads_members_in_list_order_with_read_ahead(self):
+        with self.assertRaises(TypeError):
+            ImageArchive("images.zip")
+        with tempfile.TemporaryDirectory() as directory:
+            contents = {"b.jpg": b"b", os.path.join("day", "a10.png"): b"a10", os.path.join("day", "a2.png"): b"a2"}
+            zip_path = os.path.join(directory, "images.zip")
+            with zipfile.ZipFile(zip_path, "w") as zip_file:
+                for name, data in contents.items():
+                    zip_file.writestr(name, data)
+                zip_file.writestr("notes.txt", b"notes")
+            for tar_mode, tar_name in (("w", "images.tar"), ("w:gz", "images.tar.gz")):
+                with tarfile.open(os.path.join(directory, tar_name), tar_mode) as tar_file:
+                    for name, data in contents.items():
+                        member = tarfile.TarInfo(name)
+                        member.size = len(data)
+                        tar_file.addfile(member, io.BytesIO(data))
+            self.assertFalse(is_archive(directory))
+            for archive_name in ("images.zip", "images.tar", "images.tar.gz"):
+                self.assertTrue(is_archive(os.path.join(directory, archive_name)))
+                archive = ImageArchive.open(os.path.join(directory, archive_name))
+                self.assertEqual(["b.jpg", os.path.join("day", "a2.png"), os.path.join("day", "a10.png")],
+                                 list(archive.names))
+                self.assertEqual(b"b", archive.read("b.jpg"))
+                self.assertEqual([os.path.join("day", "a2.png"), os.path.join("day", "a10.png")], list(archive.buffer))
+                self.assertEqual(b"a10", archive.open_member(os.path.join("day", "a10.png")).read())
+                self.assertEqual(b"a2", archive.read(os.path.join("day", "a2.png")))
+                self.assertEqual(0, archive.buffered_bytes)
+                archive.close()
+            with mock.patch("inbac.image_archive.HAS_PREAD", False):
+                archive = ImageArchive.open(os.path.join(directory, "images.tar"))
+            self.assertEqual(-1, archive.fd)
+            self.assertEqual(b"a10", archive.read(os.path.join("day", "a10.png")))
+            self.assertEqual(b"b", archive.read("b.jpg"))
+            self.assertEqual(b"a2", archive.read(os.path.join("day", "a2.png")))
+            archive.close()
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_images_are_cropped_from_archive(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            archive_path = os.path.join(directory, "delivery.tar")
+            image_file = io.BytesIO()
+            Image.new("RGB", (200, 200), (255, 0, 0)).save(image_file, "PNG")
+            with tarfile.open(archive_path, "w") as tar_file:
+                member = tarfile.TarInfo("day1/test.png")
+                member.size = len(image_file.getvalue())
+                tar_file.addfile(member, io.BytesIO(image_file.getvalue()))
+            output_dir = os.path.join(directory, "crops")
+            controller = Controller(Model(parse_arguments([archive_path, output_dir, "--prefetch", "0"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            controller.load_images()
+            self.assertEqual(["day1/test.png"], list(controller.model.images))
+            self.assertEqual((200, 200), controller.model.current_image.size)
+            controller.model.selection_box = mock.Mock()
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+            self.assertTrue(controller.save())
+            controller.save_queue.flush()
+            controller.prefetcher.shutdown()
+            controller.journal.close()
+            controller.close_image_archive()
+            with Image.open(os.path.join(output_dir, "day1", "test_crop1.png")) as crop:
+                self.assertEqual((255, 0, 0), crop.getpixel((0, 0)))
+
+    def test_shard_sinks_write_batches_into_rolling_shards(self):
+        with self.assertRaises(TypeError):
+            ShardSink(tempfile.gettempdir(), 1)
+        for sink_class in (ZipShardSink, TarShardSink):
+            with tempfile.TemporaryDirectory() as directory:
+                sink = sink_class(directory, 1024 * 1024)
+                errors = []
+                with mock.patch("inbac.output_sink.SHARD_BATCH_MEMBERS", 3):
+                    for name in ("img_crop1.png", "img_crop2.png"):
+                        sink.save(Image.new("RGB", (8, 8)), os.path.join(directory, name), None, 90, errors.append)
+                    self.assertEqual([], os.listdir(directory))
+                    sink.save(Image.new("RGB", (8, 8)), os.path.join(directory, "img_crop3.png"), None, 90, errors.append)
+                self.assertEqual([None, None, None], errors)
+                self.assertEqual([f"crops-00001{sink_class.extension}"], os.listdir(directory))
+                sink.close()
+            with tempfile.TemporaryDirectory() as directory:
+                # Every crop fills a shard
+                sink = sink_class(directory, 1)
+                errors = []
+                for name in ("img_crop1.png", "img_crop2.png", os.path.join("sub", "img_crop1.png")):
+                    sink.save(Image.new("RGB", (8, 8)), os.path.join(directory, name), None, 90, errors.append)
+                sink.close()
+                self.assertEqual([None, None, None], errors)
+                shards = sorted(os.listdir(directory))
+                self.assertEqual([f"crops-0000{number}{sink_class.extension}" for number in (1, 2, 3)], shards)
+                reopened_sink = sink_class(directory, 1024 * 1024)
+                self.assertEqual(["sub/img_crop1.png"], reopened_sink.list_members(os.path.join(directory, shards[2])))
+                self.assertEqual("img_crop3.png", reopened_sink.create_output_index("").allocate("img.png"))
+                self.assertEqual("img_crop2.png", reopened_sink.create_output_index("sub").allocate("img.png"))
+                reopened_sink.close()
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_save_writes_crops_into_output_sink(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            Image.new("RGB", (200, 200)).save(os.path.join(directory, "test.png"))
+            for layout in ("hashed", "zip"):
+                output_dir = os.path.join(directory, layout)
+                controller = Controller(Model(parse_arguments(
+                    [directory, output_dir, "--output_layout", layout, "--prefetch", "0", "--no_index_cache"])))
+                controller.view = mock.Mock()
+                controller.view.image_canvas.winfo_width.return_value = 200
+                controller.view.image_canvas.winfo_height.return_value = 200
+                controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+                controller.load_images()
+                # The gap tools only rename files of a flat output directory
+                self.assertFalse(controller.supports_filename_gaps())
+                controller.model.selection_box = mock.Mock()
+                controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+                self.assertTrue(controller.save())
+                self.assertTrue(controller.save())
+                controller.save_queue.flush()
+                controller.prefetcher.shutdown()
+                controller.output_sink.close()
+                controller.journal.close()
+                if layout == "hashed":
+                    crop_directory = os.path.join(output_dir, hashlib.md5(b"test").hexdigest()[:2])
+                    self.assertEqual(["test_crop1.png", "test_crop2.png"], sorted(os.listdir(crop_directory)))
+                else:
+                    with zipfile.ZipFile(os.path.join(output_dir, "crops-00001.zip")) as shard:
+                        self.assertEqual(["test_crop1.png", "test_crop2.png"], sorted(shard.namelist()))
+
+    @unittest.skipUnless(saliency.is_available(), "requires numpy")
+    def test_initial_box_is_placed_on_detailed_content(self):
+        image = Image.new("L", (200, 100), 128)
+        image.paste(Image.effect_noise((60, 60), 80), (130, 20))
+        for method in saliency.SCORING_METHODS:
+            scores = saliency.score_image(image, method)
+            self.assertEqual((48, 96), scores.shape)
+            # The box covers the noise, on the right side of the image and on the bottom when it's rotated clockwise
+            left, top = saliency.suggest_position(scores, (200, 100), (100, 100))
+            self.assertTrue(90 <= left <= 100 and top == 0, (method, left, top))
+            left, top = saliency.suggest_position(scores, (100, 200), (100, 100), (False, 270))
+            self.assertTrue(left == 0 and 90 <= top <= 100, (method, left, top))
+        self.assertEqual((0, 0), saliency.suggest_position(
+            saliency.score_image(Image.new("L", (200, 100)), "edges"), (200, 100), (100, 100)))
+
+    @unittest.skipUnless(saliency.is_available(), "requires numpy")
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_initial_selection_box_uses_scores_of_prefetched_image(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            image = Image.new("RGB", (400, 200), (128, 128, 128))
+            image.paste(Image.effect_noise((120, 120), 80).convert("RGB"), (260, 40))
+            image.save(os.path.join(directory, "test.png"))
+            controller = Controller(Model(parse_arguments(
+                [directory, "--initial_box", "edges", "-a", "1", "1", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 100, 100)
+            controller.load_images()
+            controller.prefetcher.shutdown()
+            self.assertIsNotNone(controller.model.image_scores)
+            selection_box, offset_x, offset_y = controller.view.move_canvas_object_by_offset.call_args[0]
+            self.assertIs(controller.model.selection_box, selection_box)
+            self.assertTrue(90 <= offset_x <= 100 and offset_y == 0, (offset_x, offset_y))
+
+    def test_duplicate_scan_groups_near_duplicates_and_caches_hashes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            burst = Image.effect_noise((64, 48), 60).resize((640, 480))
+            burst.save(os.path.join(directory, "a.png"))
+            burst.point(lambda value: min(value + 3, 255)).save(os.path.join(directory, "b.png"))
+            Image.effect_noise((64, 48), 60).resize((640, 480)).save(os.path.join(directory, "c.png"))
+            burst.save(os.path.join(directory, "d.png"))
+            found = {}
+            scan = lambda: duplicates.scan_duplicates(
+                ["a.png", "b.png", "c.png", "d.png", "missing.png"],
+                lambda name: (os.stat(os.path.join(directory, name)).st_size,
+                              os.stat(os.path.join(directory, name)).st_mtime_ns),
+                lambda name: os.path.join(directory, name),
+                duplicates.HashCache(os.path.join(directory, "cache"), directory),
+                4, found.update, lambda: False)
+            scan()
+            self.assertEqual({"b.png": "a.png", "d.png": "a.png"}, found)
+            found.clear()
+            with mock.patch("inbac.duplicates.compute_hash", side_effect=AssertionError):
+                scan()
+            self.assertEqual({"b.png": "a.png", "d.png": "a.png"}, found)
+        index = duplicates.MultiIndexHash(6)
+        hashes = [int.from_bytes(os.urandom(8), "big") for _ in range(500)]
+        hashes += [value ^ (1 << 5) ^ (1 << 40) for value in hashes[:50]]
+        for position, value in enumerate(hashes):
+            index.add(str(position), value)
+        for value in hashes[:60]:
+            self.assertEqual(
+                [str(position) for position, other in enumerate(hashes)
+                 if duplicates.hamming_distance(value, other) <= 6],
+                [key for _, key in index.find(value)])
+
+    @mock.patch('inbac.controller.Controller.load_image')
+    def test_navigation_collapses_and_skips_duplicate_groups(self, mock_load_image):
+        controller = Controller(Model(parse_arguments(["--duplicates", "collapse"])))
+        controller.view = mock.Mock()
+        controller.model.images = ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+        controller.model.duplicate_of = {"b.jpg": "a.jpg", "c.jpg": "a.jpg", "e.jpg": "d.jpg"}
+        controller.next_image()
+        self.assertEqual(3, controller.model.current_file)
+        controller.next_image()
+        self.assertEqual(3, controller.model.current_file)
+        controller.previous_image()
+        self.assertEqual(0, controller.model.current_file)
+        controller.model.args.duplicates = "mark"
+        controller.next_image()
+        self.assertEqual(1, controller.model.current_file)
+        controller.skip_duplicate_group()
+        self.assertEqual(3, controller.model.current_file)
+        mock_load_image.assert_called_with("d.jpg")
+        controller.prefetcher.shutdown()
+
+    def test_processed_images_finds_next_unprocessed_position(self):
+        processed = ProcessedImages()
+        processed.add_built([True] * 20 + [False, True])
+        processed.mark(21)
+        processed.mark(30)
+        self.assertEqual(22, processed.count)
+        self.assertEqual(22, processed.built)
+        self.assertEqual(20, processed.find_unprocessed(0))
+        self.assertEqual(22, processed.find_unprocessed(21))
+        self.assertEqual(31, processed.find_unprocessed(30))
+        self.assertEqual(100, processed.find_unprocessed(100))
+        processed.add_built([True] * 9)
+        self.assertEqual(30, processed.count)
+        self.assertEqual(20, processed.find_unprocessed(0))
+        self.assertEqual(31, processed.find_unprocessed(21))
+        self.assertTrue(processed.is_processed(30))
+        self.assertFalse(processed.is_processed(31))
+
+    @mock.patch('inbac.controller.Controller.load_image')
+    def test_next_unprocessed_image_skips_images_with_crops(self, mock_load_image):
+        with tempfile.TemporaryDirectory() as directory:
+            for filename in ("a_crop1.jpg", "b_crop2.png", "d_crop1.jpg", "e_crop1.webp", "notes.txt"):
+                open(os.path.join(directory, filename), "w").close()
+            controller = Controller(Model(parse_arguments([".", directory])))
+            controller.view = mock.Mock()
+            controller.model.images = ["a.jpg", "b.png", "c.jpg", "d.jpg", "e.jpg"]
+            # Positions which aren't scanned yet are looked up on demand
+            controller.next_unprocessed_image()
+            self.assertEqual(2, controller.model.current_file)
+            controller.scan_processed_images(
+                controller.model.processed_images, controller.model.images, controller.get_output_sink())
+            self.assertEqual(4, controller.model.processed_images.count)
+            controller.next_unprocessed_image()
+            self.assertEqual(2, controller.model.current_file)
+            controller.model.current_file = 0
+            controller.next_unprocessed_image()
+            self.assertEqual(2, controller.model.current_file)
+            mock_load_image.assert_called_with("c.jpg")
+            controller.prefetcher.shutdown()
+
+    @mock.patch('inbac.controller.ImageTk.PhotoImage')
+    def test_failed_save_does_not_mark_image_processed(self, mock_photo_image):
+        with tempfile.TemporaryDirectory() as directory:
+            Image.new("RGB", (200, 200)).save(os.path.join(directory, "test.png"))
+            controller = Controller(Model(parse_arguments(
+                [directory, os.path.join(directory, "crops"), "--prefetch", "0", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.run_on_ui_thread.side_effect = lambda callback: callback()
+            controller.view.image_canvas.winfo_width.return_value = 200
+            controller.view.image_canvas.winfo_height.return_value = 200
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 0, 0)
+            controller.load_images()
+            controller.model.selection_box = mock.Mock()
+            controller.view.get_canvas_object_coords.return_value = (0, 0, 50, 50)
+            with mock.patch("inbac.output_sink.encode_image", side_effect=OSError("disk full")):
+                self.assertTrue(controller.save())
+                controller.save_queue.flush()
+            self.assertEqual(0, controller.model.processed_images.count)
+            self.assertTrue(controller.save())
+            controller.save_queue.flush()
+            controller.prefetcher.shutdown()
+            controller.journal.close()
+            self.assertEqual(1, controller.model.processed_images.count)
+            self.assertIn("Processed: 1", controller.model.image_title)
+
+    def test_thumbnail_cache_reuses_thumbnails_until_image_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            image_path = os.path.join(directory, "test.png")
+            Image.new("RGB", (400, 200), (200, 0, 0)).save(image_path)
+            cache = ThumbnailCache(os.path.join(directory, "thumbnails"))
+            thumbnail = cache.get(image_path, (100, 1), lambda: image_path)
+            self.assertEqual((96, 48), thumbnail.size)
+            self.assertTrue(os.path.isfile(cache.get_path(image_path, (100, 1))))
+            open_image = mock.Mock(side_effect=AssertionError)
+            self.assertEqual((96, 48), cache.get(image_path, (100, 1), open_image).size)
+            self.assertNotEqual(cache.get_path(image_path, (100, 1)), cache.get_path(image_path, (100, 2)))
+            loader = ThumbnailLoader(workers=1, max_entries=1)
+            loaded = []
+            gate = threading.Event()
+            load = lambda name: gate.wait() and Image.new("RGB", (8, 8))
+            loader.request(["a.png", "b.png"], load, lambda name, image: loaded.append(name))
+            # b.png was scrolled away before the worker got to it
+            loader.request(["a.png", "c.png"], load, lambda name, image: loaded.append(name))
+            gate.set()
+            loader.executor.shutdown(wait=True)
+            self.assertEqual(["a.png", "c.png"], loaded)
+            self.assertEqual(["c.png"], list(loader.loaded))
+
+    def test_filmstrip_only_shows_visible_cells(self):
+        self.assertEqual(range(0, 4), get_visible_range(0, 3 * CELL_SIZE + 1, 100000))
+        self.assertEqual(range(49999, 50002), get_visible_range(49999 * CELL_SIZE + 10, 2 * CELL_SIZE, 100000))
+        self.assertEqual(range(99998, 100000), get_visible_range(99998 * CELL_SIZE, 5 * CELL_SIZE, 100000))
+        self.assertEqual(range(0, 0), get_visible_range(0, 500, 0))
+        self.assertEqual(100000 * CELL_SIZE - 500, clamp_offset(10 ** 9, 500, 100000))
+        self.assertEqual(0, clamp_offset(-10, 500, 100000))
+        self.assertEqual(0, clamp_offset(100, 500, 2))
+
+    @mock.patch('inbac.controller.Controller.load_image')
+    def test_filmstrip_thumbnails_are_loaded_for_visible_positions(self, mock_load_image):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("a.png", "b.png", "c.png"):
+                Image.new("RGB", (300, 300)).save(os.path.join(directory, name))
+            controller = Controller(Model(parse_arguments([directory, "--filmstrip", "--no_index_cache"])))
+            controller.view = mock.Mock()
+            controller.view.run_on_ui_thread.side_effect = lambda callback: callback()
+            controller.model.images = ["a.png", "b.png", "c.png"]
+            controller.request_thumbnails(range(1, 5))
+            controller.thumbnail_loader.executor.shutdown(wait=True)
+            shown = sorted((args[0], args[1].size) for args, _ in controller.view.show_thumbnail.call_args_list)
+            self.assertEqual([(1, (96, 96)), (2, (96, 96))], shown)
+            controller.go_to_image(2)
+            mock_load_image.assert_called_with("c.png")
+            controller.prefetcher.shutdown()
+
+
+def create_files(directory, filenames):
+    for filename in filenames:
+        with open(os.path.join(directory, filename), "w"):
+            pass
+
+
 def file_exist(x):
     if x == "/home/test/test.jpg":
         return True